@@ -0,0 +1,305 @@
+# ベンチマーク用のローカルAPIスタブ（Lark カレンダー / Bitable、Google Sheets、LINE Messaging API）
+# 1つのHTTPサーバーでパスごとに振り分け、サービスごとに遅延とエラーを注入できる
+#
+#   stubs = StubServer(latency={"lark": 0.05}, error_rate={"sheets": 0.01}).start()
+#   os.environ["LARK_DOMAIN"] = stubs.url
+import re
+import json
+import time
+import random
+import threading
+from collections import Counter
+from urllib.parse import urlparse, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SERVICES = ("lark", "sheets", "line")
+SHEETS_API_BASE = "https://sheets.googleapis.com"
+
+
+def _column_index(letters):
+    n = 0
+    for ch in letters:
+        n = n * 26 + (ord(ch) - ord("A") + 1)
+    return n - 1
+
+
+def _column_letters(index):
+    letters = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+
+def _parse_range(a1):
+    """
+    "'Sheet1'!A2:F10" / "A:F" / "A1" などを (開始行, 終了行, 開始列, 終了列) に変換する（行は1始まり、None は末尾まで）
+    """
+    a1 = unquote(a1).split("!")[-1]
+    m = re.fullmatch(r"([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?", a1)
+    if not m:
+        return 1, None, 0, None
+    c1, r1, c2, r2 = m.groups()
+    start_row = int(r1) if r1 else 1
+    end_row = int(r2) if r2 else (None if c2 or not r1 else start_row)
+    end_col = _column_index(c2) if c2 else _column_index(c1)
+    return start_row, end_row, _column_index(c1), end_col
+
+
+class StubState:
+    """
+    スタブが保持するデータと呼び出し回数
+    """
+
+    def __init__(self, latency=None, error_rate=None, seed=None):
+        self.latency = {s: 0.0 for s in SERVICES}
+        self.latency.update(latency or {})
+        self.error_rate = {s: 0.0 for s in SERVICES}
+        self.error_rate.update(error_rate or {})
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()   # { (service, operation): 回数 }
+        self.errors = Counter()
+        self.events = {}         # Lark カレンダーの予定 { event_id: event }
+        self.records = []        # Bitable のレコード
+        self.rows = []           # Google Sheets の行
+        self.messages = []       # LINE に送られたメッセージ [(kind, to, texts)]
+        self.replies = {}        # { reply_token: [texts] }
+        self._reply_cond = threading.Condition(self.lock)
+        self._next_id = 0
+
+    def next_id(self, prefix):
+        self._next_id += 1
+        return f"{prefix}{self._next_id}"
+
+    def wait_reply(self, reply_token, timeout):
+        """
+        reply_token への返信が届くまで待つ（届いた本文を返す。タイムアウト時は None）
+        """
+        deadline = time.monotonic() + timeout
+        with self._reply_cond:
+            while reply_token not in self.replies:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._reply_cond.wait(remaining)
+            return self.replies.pop(reply_token)
+
+    def api_calls(self, service=None):
+        with self.lock:
+            return sum(n for (s, op), n in self.calls.items() if service in (None, s) and op != "auth")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method):
+        state = self.server.state
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self._body() if method in ("POST", "PUT") else {}
+
+        if url.path.startswith("/open-apis/"):
+            service, route = "lark", self._lark
+        elif url.path.startswith("/v4/spreadsheets"):
+            service, route = "sheets", self._sheets
+        elif url.path.startswith("/v2/bot/"):
+            service, route = "line", self._line
+        else:
+            return self._send(404, {"message": "not found"})
+
+        if url.path.endswith("tenant_access_token/internal"):
+            with state.lock:
+                state.calls[(service, "auth")] += 1
+            return self._send(200, {"code": 0, "msg": "ok", "tenant_access_token": "t-stub", "expire": 7200})
+
+        if state.latency[service] > 0:
+            time.sleep(state.latency[service])
+        with state.lock:
+            inject = state.random.random() < state.error_rate[service]
+        try:
+            operation, status, payload = route(state, method, url.path, query, body, inject)
+        except Exception as e:
+            operation, status, payload = "unknown", 500, {"message": f"stub error: {e}"}
+        with state.lock:
+            state.calls[(service, operation)] += 1
+            if inject or status >= 400:
+                state.errors[(service, operation)] += 1
+        self._send(status, payload)
+
+    # --- Lark ---
+    def _lark(self, state, method, path, query, body, inject):
+        if "/bitable/" in path:
+            operation = path.rsplit("/", 1)[-1] if "/records/" in path else ("records" if path.endswith("/records") else "tables")
+            if inject:
+                return operation, 200, {"code": 1254290, "msg": "stub: injected error"}
+            if operation == "tables":
+                return operation, 200, {"code": 0, "data": {"items": [{"table_id": "tblStub000000", "name": "stub"}], "has_more": False}}
+            with state.lock:
+                records = []
+                for record in body.get("records") or [body]:
+                    record = dict(record, record_id=record.get("record_id") or state.next_id("rec"))
+                    records.append(record)
+                    if operation != "batch_update":
+                        state.records.append(record)
+                    else:
+                        for stored in state.records:
+                            if stored["record_id"] == record["record_id"]:
+                                stored["fields"] = dict(stored.get("fields") or {}, **(record.get("fields") or {}))
+            return operation, 200, {"code": 0, "data": {"records": records}}
+
+        # カレンダー
+        operation = {"GET": "list_events", "POST": "create_event", "DELETE": "delete_event"}.get(method, "unknown")
+        if inject:
+            return operation, 200, {"code": 99991400, "msg": "stub: injected error"}
+        with state.lock:
+            if method == "POST":
+                event = dict(body, event_id=state.next_id("ev"), status="confirmed")
+                state.events[event["event_id"]] = event
+                return operation, 200, {"code": 0, "data": {"event": event}}
+            if method == "DELETE":
+                state.events.pop(path.rsplit("/", 1)[-1], None)
+                return operation, 200, {"code": 0, "data": {}}
+            if "anchor_time" in query or "sync_token" in query:
+                return operation, 200, {"code": 0, "data": {"items": [], "has_more": False, "sync_token": "stub-sync"}}
+            start = int(query.get("start_time", ["0"])[0])
+            end = int(query.get("end_time", [str(2 ** 40)])[0])
+            items = [e for e in state.events.values()
+                     if int(e["start_time"]["timestamp"]) < end and int(e["end_time"]["timestamp"]) > start]
+        return operation, 200, {"code": 0, "data": {"items": items, "has_more": False}}
+
+    # --- Google Sheets ---
+    def _values(self, state, a1):
+        start_row, end_row, start_col, end_col = _parse_range(a1)
+        rows = state.rows[start_row - 1:end_row]
+        values = [row[start_col:(end_col + 1) if end_col is not None else None] for row in rows]
+        while values and not any(values[-1]):
+            values.pop()
+        return {"range": a1, "majorDimension": "ROWS", "values": values}
+
+    def _sheets(self, state, method, path, query, body, inject):
+        if path.endswith(":append"):
+            operation = "append"
+        elif path.endswith(":batchUpdate"):
+            operation = "batch_update"
+        elif path.endswith("values:batchGet"):
+            operation = "batch_get"
+        elif "/values/" in path:
+            operation = "get"
+        else:
+            operation = "metadata"
+        if inject:
+            return operation, 503, {"error": {"code": 503, "message": "stub: injected error", "status": "UNAVAILABLE"}}
+
+        with state.lock:
+            if operation == "metadata":
+                return operation, 200, {
+                    "spreadsheetId": "stub", "properties": {"title": "SalonReservations"},
+                    "sheets": [{"properties": {"sheetId": 0, "title": "Sheet1", "index": 0,
+                                               "gridProperties": {"rowCount": max(1000, len(state.rows)),
+                                                                  "columnCount": 26}}}]
+                }
+            if operation == "append":
+                first = len(state.rows) + 1
+                state.rows.extend(body.get("values", []))
+                last = len(state.rows)
+                width = max((len(r) for r in body.get("values", [])), default=1)
+                updated = f"Sheet1!A{first}:{_column_letters(width - 1)}{last}"
+                return operation, 200, {"updates": {"updatedRange": updated, "updatedRows": last - first + 1}}
+            if operation == "batch_update":
+                for request in body.get("requests", []):
+                    dim = request.get("deleteDimension", {}).get("range")
+                    if dim:
+                        del state.rows[dim["startIndex"]:dim["endIndex"]]
+                return operation, 200, {"spreadsheetId": "stub", "replies": [{}]}
+            if operation == "batch_get":
+                return operation, 200, {"valueRanges": [self._values(state, r) for r in query.get("ranges", [])]}
+            return operation, 200, self._values(state, unquote(path.split("/values/", 1)[1]))
+
+    # --- LINE ---
+    def _line(self, state, method, path, query, body, inject):
+        operation = path.rsplit("/", 1)[-1]
+        if inject:
+            return operation, 500, {"message": "stub: injected error"}
+        texts = [m.get("text") or m.get("altText") for m in body.get("messages", [])]
+        with state.lock:
+            state.messages.append((operation, body.get("replyToken") or body.get("to"), texts))
+            if operation == "reply":
+                state.replies[body["replyToken"]] = texts
+                state._reply_cond.notify_all()
+        return operation, 200, {"sentMessages": [{"id": state.next_id("m"), "quoteToken": "q"} for _ in texts]}
+
+
+class StubServer:
+    """
+    スタブサーバー本体（バックグラウンドスレッドで動く）
+    """
+
+    def __init__(self, latency=None, error_rate=None, seed=None, port=0):
+        self.state = StubState(latency, error_rate, seed)
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), _Handler)
+        self._server.daemon_threads = True
+        self._server.state = self.state
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="api-stubs", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def sheets_session(self):
+        """
+        Google Sheets APIへのリクエストをスタブに向ける requests.Session（gspread.Client に渡す）
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        stub_url = self.url
+
+        class _Redirect(HTTPAdapter):
+            def send(self, request, **kwargs):
+                request.url = request.url.replace(SHEETS_API_BASE, stub_url, 1)
+                return super().send(request, **kwargs)
+
+        session = requests.Session()
+        session.mount(SHEETS_API_BASE, _Redirect())
+        return session
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+
+import staff
+import scheduler
+import lark_calendar
+import reservation_store
+
+# 検索する日数と、返す候補数のデフォルト
+DEFAULT_SEARCH_DAYS = 14
+DEFAULT_LIMIT = 8
+
+WEEKDAYS = ["月", "火", "水", "木", "金", "土", "日"]
+# カレンダーを取得できず、空き状況が分からないときの返信
+UNAVAILABLE_MESSAGE = "ただいま予約状況を確認できません🙇\nお手数ですが、少し時間をおいてからもう一度お試しください。"
+
+def _loaded(members, events_by_member):
+    """
+    カレンダーを取得できたスタッフだけに絞る（予定が分からないスタッフの枠は空きとして出さない）
+    1人も取得できなかった場合は None
+    """
+    loaded = [member for member, events in zip(members, events_by_member) if events is not None]
+    return loaded if loaded or not members else None
+
+def _occupancies(members, start_date, days):
+    """
+    日ごと・スタッフごとの枠の埋まり具合（カレンダーの分は日別キャッシュで差分更新されているもの）に、
+    そのスタッフが担当する未同期のローカル予約・キャンセルを重ねる
+    戻り値: 日ごとの [スタッフごとの scheduler.DayOccupancy, ...]
+    """
+    store = reservation_store.get_store()
+    dates = [start_date + timedelta(days=offset) for offset in range(days)]
+    by_day = [[] for _ in dates]
+    for member in members:
+        cancelled, pending = store.local_changes(dates[0], dates[-1], member["id"], member["primary"])
+        for d, occupancies in zip(dates, by_day):
+            occupancy = lark_calendar.get_day_occupancy(d, member["calendar_id"], fetch=False, exclude=cancelled)
+            for event in pending:
+                if event["start"].date() == d:
+                    occupancy.add(event)
+            occupancies.append(occupancy)
+    return by_day
+
+def day_availability(required_slots, target_date, roles=None):
+    """
+    指定日の空き枠（メニューを担当できるいずれかのスタッフが通しで担当できる枠）
+    戻り値: scheduler.check_capacity と同じ形式のリスト（カレンダーを取得できなかった場合は None）
+    """
+    members = staff.get_staff(roles)
+    # スタッフ全員のカレンダーを同時に読み込んでから、キャッシュ上の埋まり具合を使う
+    members = _loaded(members, staff.day_events(target_date, members))
+    if members is None:
+        return None
+    return scheduler.capacity_from_occupancy(required_slots, _occupancies(members, target_date, 1)[0])
+
+def search_next_available(required_slots, days=DEFAULT_SEARCH_DAYS, limit=DEFAULT_LIMIT, start_date=None, roles=None):
+    """
+    複数日にまたがる空き検索（例: 今後14日間でカラーの最短8枠）
+    カレンダーはスタッフごとに期間全体を1回の一覧取得で読み込む
+    戻り値: scheduler.check_capacity と同じ形式のリスト（日時の早い順。カレンダーを取得できなかった場合は None）
+    """
+    now = datetime.now()
+    start_date = start_date or now.date()
+    members = staff.get_staff(roles)
+    members = _loaded(members, staff.range_events(start_date, days, members))
+    if members is None:
+        return None
+    return scheduler.next_capacity_from_occupancy(
+        required_slots, _occupancies(members, start_date, days), limit=limit, not_before=now
+    )
+
+def format_next_available(menu_name, available, days=DEFAULT_SEARCH_DAYS):
+    """
+    空き検索の結果をLINEの返信用テキストにする
+    """
+    if available is None:
+        return UNAVAILABLE_MESSAGE
+    if not available:
+        return f"【{menu_name}】今後{days}日間は空きがありません😭\n店舗へ直接お問い合わせください。"
+
+    lines = []
+    for slot in available:
+        start = slot["start_time"]
+        lines.append(f"・{start.month}/{start.day}({WEEKDAYS[start.weekday()]}) {start.strftime('%H:%M')}")
+    return (
+        f"🔎 【{menu_name}】直近の空き:\n" + "\n".join(lines) +
+        "\n\n※ご希望の日付を「2/10」のように入力すると、その日の空き時間を表示します。"
+    )
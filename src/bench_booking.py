@@ -0,0 +1,239 @@
+import os
+import sys
+import json
+import hmac
+import time
+import uuid
+import base64
+import hashlib
+import tempfile
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# ローカルモジュールのインポート設定
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from api_stubs import StubServer, SERVICES
+
+# 予約ベンチマーク: ローカルのAPIスタブに向けた bot.app にWebhookを送り、
+# 返信が届くまでの時間・スループット・予約1件あたりのAPI呼び出し回数を計測する
+#
+#   python src/bench_booking.py --bookings 200 --concurrency 20 --latency lark=0.05,sheets=0.1,line=0.02
+#   python src/bench_booking.py --replay webhooks.jsonl --error-rate lark=0.02
+
+CHANNEL_SECRET = "bench-secret"
+# 1日に入れる予約（カット60分を9:00〜18:00の毎正時）
+BOOKINGS_PER_DAY = 10
+CONFIRMED_MARK = "予約を確定しました"
+
+
+def _parse_service_values(text):
+    """
+    "lark=0.05,line=0.02" -> {"lark": 0.05, "line": 0.02}
+    """
+    values = {}
+    for part in filter(None, (text or "").split(",")):
+        name, value = part.split("=")
+        if name not in SERVICES:
+            raise argparse.ArgumentTypeError(f"unknown service: {name} (choose from {', '.join(SERVICES)})")
+        values[name] = float(value)
+    return values
+
+
+def _configure_env(stubs, crm):
+    # bot を import する前に、外部APIの向き先をすべてスタブにする
+    workdir = tempfile.mkdtemp(prefix="bench_booking_")
+    os.environ.update({
+        "RESERVATION_DB_PATH": os.path.join(workdir, "reservations.db"),
+        "SHEET_JOURNAL_DIR": workdir,
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench-token",
+        "LINE_API_HOST": stubs.url,
+        "LARK_DOMAIN": stubs.url,
+        "LARK_APP_ID": "cli_bench",
+        "LARK_APP_SECRET": "bench",
+        "LARK_CALENDAR_ID": "bench-calendar",
+        "LARK_BASE_APP_TOKEN": "bench-base",
+        "LARK_BASE_TABLE_ID": "tblBench000000",
+        "LARK_CRM_ENABLED": "1" if crm else "",
+        "GOOGLE_SPREADSHEET_ID": "bench-sheet",
+        "CALENDAR_SYNC_INTERVAL": "0",
+        "SESSION_BACKEND": "memory",
+        "REMINDER_SERVICE_ENABLED": "",
+    })
+
+
+def _install_sheets_client(stubs):
+    # 認証を通さず、スタブに向けたセッションで gspread のクライアントを作る
+    import gspread
+    import google_sheets
+    google_sheets._client = gspread.Client(auth=None, session=stubs.sheets_session())
+    google_sheets._client_loaded = True
+
+
+def _message_event(user_id, text):
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": uuid.uuid4().hex,
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": "",
+        "message": {"type": "text", "id": uuid.uuid4().hex[:16], "quoteToken": "q", "text": text},
+    }
+
+
+def synthetic_conversations(bookings):
+    """
+    予約の会話（メニュー選択 → 日付 → 時間）を bookings 人分作る。予約が重ならないよう日時をずらす
+    """
+    start = datetime.now().date() + timedelta(days=1)
+    conversations = []
+    for i in range(bookings):
+        day = start + timedelta(days=i // BOOKINGS_PER_DAY)
+        hour = 9 + i % BOOKINGS_PER_DAY
+        user_id = f"Ubench{i:06d}"
+        conversations.append([
+            _message_event(user_id, "メニュー: カット"),
+            _message_event(user_id, day.strftime("%Y/%m/%d")),
+            _message_event(user_id, f"{hour:02d}:00"),
+        ])
+    return conversations
+
+
+def load_recorded(path):
+    """
+    記録したWebhookの本文（1行1リクエストのJSONL）を、送信者ごとの会話にまとめる
+    """
+    by_user = defaultdict(list)
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for event in json.loads(line).get("events", []):
+                by_user[(event.get("source") or {}).get("userId", "")].append(event)
+    return list(by_user.values())
+
+
+def _sign(body):
+    digest = hmac.new(CHANNEL_SECRET.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+def run_conversation(app, state, events, timeout):
+    """
+    1人分の会話を順に送る。各イベントについて (送信→返信の秒数, 返信本文) を返す
+    """
+    client = app.test_client()
+    results = []
+    for event in events:
+        expects_reply = "replyToken" in event
+        event = dict(event, replyToken=uuid.uuid4().hex) if expects_reply else event
+        body = json.dumps({"destination": "Ubench", "events": [event]}, ensure_ascii=False)
+        started = time.perf_counter()
+        resp = client.post("/callback", data=body, headers={
+            "X-Line-Signature": _sign(body), "Content-Type": "application/json"
+        })
+        if resp.status_code != 200:
+            results.append((None, None))
+            continue
+        texts = state.wait_reply(event["replyToken"], timeout) if expects_reply else []
+        results.append((time.perf_counter() - started if texts is not None else None, texts))
+    return results
+
+
+def _drain_sync(timeout):
+    """
+    予約ストアの送信キューが空になるまで外部への反映を進める
+    """
+    import reservation_store
+    import reservation_sync
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        reservation_sync.sync_once()
+        if not reservation_store.get_store().outbox_stats().get("pending"):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def _percentile(samples, q):
+    return samples[min(len(samples) - 1, int(len(samples) * q))] if samples else 0.0
+
+
+def run(conversations, concurrency=10, latency=None, error_rate=None, crm=False, timeout=30.0, seed=0):
+    stubs = StubServer(latency=latency, error_rate=error_rate, seed=seed).start()
+    _configure_env(stubs, crm)
+    _install_sheets_client(stubs)
+    import bot
+    import google_sheets
+    import lark_crm
+    import reservation_store
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(run_conversation, bot.app, stubs.state, c, timeout) for c in conversations]
+        results = [r for f in futures for r in f.result()]
+    elapsed = time.perf_counter() - started
+
+    # 予約ストアからの同期と、バッファに残った書き込みも呼び出し回数に含める
+    _drain_sync(timeout)
+    google_sheets.flush()
+    if crm:
+        lark_crm.writer.flush()
+    stubs.stop()
+
+    latencies = sorted(seconds for seconds, _ in results if seconds is not None)
+    bookings = sum(1 for _, texts in results if texts and any(CONFIRMED_MARK in (t or "") for t in texts))
+    per_booking = max(bookings, 1)
+    state = stubs.state
+    return {
+        "conversations": len(conversations),
+        "events": len(results),
+        "timeouts": sum(1 for seconds, _ in results if seconds is None),
+        "bookings": bookings,
+        "elapsed": elapsed,
+        "bookings_per_second": bookings / elapsed if elapsed else 0.0,
+        "latency_p50": _percentile(latencies, 0.5),
+        "latency_p99": _percentile(latencies, 0.99),
+        "latency_max": latencies[-1] if latencies else 0.0,
+        "api_calls_per_booking": {s: state.api_calls(s) / per_booking for s in SERVICES},
+        "api_calls": {f"{s}.{op}": n for (s, op), n in sorted(state.calls.items())},
+        "errors": {f"{s}.{op}": n for (s, op), n in sorted(state.errors.items())},
+        "sync": reservation_store.get_store().outbox_stats(),
+    }
+
+
+def print_report(report):
+    print("📊 予約ベンチマーク結果")
+    print(f"   会話 {report['conversations']}件 / イベント {report['events']}件 / 予約確定 {report['bookings']}件 / 返信なし {report['timeouts']}件")
+    print(f"   所要時間 {report['elapsed']:.2f}秒 / スループット {report['bookings_per_second']:.1f} 予約/秒")
+    print(f"   送信→返信: p50 {report['latency_p50'] * 1000:.1f}ms / p99 {report['latency_p99'] * 1000:.1f}ms / max {report['latency_max'] * 1000:.1f}ms")
+    print("   予約1件あたりのAPI呼び出し: " + ", ".join(f"{s} {n:.2f}" for s, n in report["api_calls_per_booking"].items()))
+    print("   API呼び出し内訳: " + (", ".join(f"{k} {n}" for k, n in report["api_calls"].items()) or "なし"))
+    print("   予約ストアの同期: " + ", ".join(f"{k} {n}" for k, n in report["sync"].items()))
+    if report["errors"]:
+        print("   注入・発生したエラー: " + ", ".join(f"{k} {n}" for k, n in report["errors"].items()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the booking flow against local API stubs.')
+    parser.add_argument('--bookings', type=int, default=100, help='Number of synthetic booking conversations')
+    parser.add_argument('--replay', help='JSONL file of recorded webhook bodies to replay instead of synthetic traffic')
+    parser.add_argument('--concurrency', type=int, default=10, help='Number of users talking to the bot at the same time')
+    parser.add_argument('--latency', type=_parse_service_values, default={}, help='Per-service stub latency in seconds, e.g. lark=0.05,line=0.02')
+    parser.add_argument('--error-rate', type=_parse_service_values, default={}, help='Per-service injected error rate, e.g. sheets=0.01')
+    parser.add_argument('--crm', action='store_true', help='Also write bookings to Lark Base (LARK_CRM_ENABLED)')
+    parser.add_argument('--timeout', type=float, default=30.0, help='Seconds to wait for each reply')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for error injection')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    conversations = load_recorded(args.replay) if args.replay else synthetic_conversations(args.bookings)
+    report = run(conversations, args.concurrency, args.latency, args.error_rate, args.crm, args.timeout, args.seed)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
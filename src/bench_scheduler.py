@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import statistics
+import tracemalloc
+from datetime import datetime, timedelta, date
+
+# ローカルモジュールのインポート設定
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import scheduler
+
+# 空き判定エンジンのマイクロベンチマークと性質テスト
+# - 0〜500件の予定を持つ合成日、複数の SLOT_UNIT_MINUTES、複数スロットのメニューで計測する
+# - 結果は総当たりの素朴な判定（オラクル）と毎回突き合わせる
+#
+#   python src/bench_scheduler.py
+#   python src/bench_scheduler.py --save-baseline bench_scheduler.json
+#   python src/bench_scheduler.py --baseline bench_scheduler.json --max-regression 1.5
+
+BASE_DATE = date(2026, 3, 2)
+
+
+def random_events(rng, count, target_date, days=1):
+    """
+    合成の予定を作る（重なり・長さ0・営業時間外・日をまたぐ予定を含む）
+    """
+    day_start = datetime.combine(target_date, scheduler.OPEN_TIME) - timedelta(hours=2)
+    span_minutes = int((days - 1) * 24 * 60 + (scheduler.CLOSE_TIME.hour - scheduler.OPEN_TIME.hour + 4) * 60)
+    events = []
+    for _ in range(count):
+        start = day_start + timedelta(minutes=rng.randrange(0, span_minutes, 5))
+        kind = rng.random()
+        if kind < 0.05:
+            length = 0
+        elif kind < 0.1:
+            length = rng.randrange(240, 24 * 60, 5)
+        else:
+            length = rng.randrange(5, 180, 5)
+        events.append({"start": start, "end": start + timedelta(minutes=length)})
+    return events
+
+
+def oracle_check_availability(required_slots, target_date, existing_events):
+    """
+    総当たりの空き判定（各候補枠とすべての予定の重なりを調べる）
+    """
+    unit = timedelta(minutes=scheduler.SLOT_UNIT_MINUTES)
+    close_dt = datetime.combine(target_date, scheduler.CLOSE_TIME)
+    current_dt = datetime.combine(target_date, scheduler.OPEN_TIME)
+    starts = []
+    while current_dt + unit <= close_dt:
+        starts.append(current_dt)
+        current_dt += unit
+
+    available = []
+    for i in range(len(starts) - required_slots + 1):
+        candidate_start = starts[i]
+        candidate_end = starts[i] + unit * required_slots
+        if not any(candidate_start < e["end"] and candidate_end > e["start"] for e in existing_events):
+            available.append((candidate_start, candidate_end))
+    return available
+
+
+def oracle_find_next_available(required_slots, start_date, days, existing_events, limit, not_before):
+    results = []
+    for offset in range(days):
+        for s, e in oracle_check_availability(required_slots, start_date + timedelta(days=offset), existing_events):
+            if not_before and s < not_before:
+                continue
+            results.append((s, e))
+    return results[:limit]
+
+
+def oracle_check_capacity(required_slots, target_date, events_by_resource):
+    """
+    リソースごとに総当たりで判定し、開始時刻ごとに空いているリソースを集める
+    戻り値: [(開始, 終了, [リソースの添字, ...]), ...]
+    """
+    by_start = {}
+    for r, events in enumerate(events_by_resource):
+        for s, e in oracle_check_availability(required_slots, target_date, events):
+            by_start.setdefault((s, e), []).append(r)
+    return [(s, e, resources) for (s, e), resources in sorted(by_start.items())]
+
+
+def _pairs(available):
+    return [(a["start_time"], a["end_time"]) for a in available]
+
+
+def check_properties(trials, seed, units, slot_counts, max_events):
+    """
+    ランダムな入力で scheduler の結果をオラクルと突き合わせる。食い違った入力のリストを返す
+    """
+    rng = random.Random(seed)
+    original_unit = scheduler.SLOT_UNIT_MINUTES
+    failures = []
+    try:
+        for trial in range(trials):
+            scheduler.SLOT_UNIT_MINUTES = rng.choice(units)
+            required_slots = rng.choice(slot_counts)
+            count = rng.choice([0, 1, 2, 5, 20, rng.randrange(0, max_events + 1)])
+            if trial % 4 == 2:
+                # 複数リソース（席・スタッフ）の空き数（check_capacity）
+                resources = rng.randrange(1, 5)
+                events = [random_events(rng, count, BASE_DATE) for _ in range(resources)]
+                got = [(a["start_time"], a["end_time"], a["resources"])
+                       for a in scheduler.check_capacity(required_slots, BASE_DATE, events)]
+                expected = oracle_check_capacity(required_slots, BASE_DATE, events)
+                events = [e for resource_events in events for e in resource_events]
+            elif trial % 4 == 3:
+                # 複数日の検索（find_next_available）
+                days = rng.randrange(1, 5)
+                events = random_events(rng, count, BASE_DATE, days)
+                limit = rng.choice([1, 8, 1000])
+                not_before = datetime.combine(BASE_DATE, scheduler.OPEN_TIME) + timedelta(minutes=rng.randrange(0, 600, 5)) \
+                    if rng.random() < 0.5 else None
+                got = _pairs(scheduler.find_next_available(required_slots, BASE_DATE, days, events, limit, not_before))
+                expected = oracle_find_next_available(required_slots, BASE_DATE, days, events, limit, not_before)
+            else:
+                events = random_events(rng, count, BASE_DATE)
+                got = _pairs(scheduler.check_availability(required_slots, BASE_DATE, events))
+                expected = oracle_check_availability(required_slots, BASE_DATE, events)
+            if got != expected:
+                failures.append({
+                    "trial": trial,
+                    "unit": scheduler.SLOT_UNIT_MINUTES,
+                    "required_slots": required_slots,
+                    "events": len(events),
+                })
+    finally:
+        scheduler.SLOT_UNIT_MINUTES = original_unit
+    return failures
+
+
+def _time_call(func, repeat):
+    # 1回あたりの秒数の中央値（短い処理は複数回まとめて測る）
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        if time.perf_counter() - started >= 0.005 or loops >= 10000:
+            break
+        loops *= 10
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        samples.append((time.perf_counter() - started) / loops)
+    return statistics.median(samples)
+
+
+def _peak_allocation(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmarks(event_counts, units, slot_counts, repeat, seed):
+    """
+    各条件での処理時間とメモリ確保量を計測する
+    戻り値: { "check_availability/events=100/unit=30/slots=2": {"seconds", "peak_bytes", "oracle_seconds"}, ... }
+    """
+    rng = random.Random(seed)
+    original_unit = scheduler.SLOT_UNIT_MINUTES
+    results = {}
+    try:
+        for unit in units:
+            scheduler.SLOT_UNIT_MINUTES = unit
+            results[f"generate_slots/unit={unit}"] = {
+                "seconds": _time_call(lambda: scheduler.generate_slots(BASE_DATE), repeat),
+                "peak_bytes": _peak_allocation(lambda: scheduler.generate_slots(BASE_DATE)),
+            }
+            for count in event_counts:
+                events = random_events(rng, count, BASE_DATE)
+                for required_slots in slot_counts:
+                    check = lambda: scheduler.check_availability(required_slots, BASE_DATE, events)
+                    oracle = lambda: oracle_check_availability(required_slots, BASE_DATE, events)
+                    results[f"check_availability/events={count}/unit={unit}/slots={required_slots}"] = {
+                        "seconds": _time_call(check, repeat),
+                        "peak_bytes": _peak_allocation(check),
+                        "oracle_seconds": _time_call(oracle, max(1, repeat // 2)),
+                    }
+            staff_events = [random_events(rng, count, BASE_DATE) for count in event_counts]
+            results[f"check_capacity/resources={len(event_counts)}/unit={unit}/slots=2"] = {
+                "seconds": _time_call(lambda: scheduler.check_capacity(2, BASE_DATE, staff_events), repeat),
+                "peak_bytes": _peak_allocation(lambda: scheduler.check_capacity(2, BASE_DATE, staff_events)),
+            }
+            # カレンダーのキャッシュ上に作り済みの埋まり具合からの判定（通常の予約時はこちら）
+            occupancies = [scheduler.DayOccupancy(BASE_DATE, events) for events in staff_events]
+            results[f"capacity_from_occupancy/resources={len(event_counts)}/unit={unit}/slots=2"] = {
+                "seconds": _time_call(lambda: scheduler.capacity_from_occupancy(2, occupancies), repeat),
+                "peak_bytes": _peak_allocation(lambda: scheduler.capacity_from_occupancy(2, occupancies)),
+            }
+            events = random_events(rng, max(event_counts), BASE_DATE, days=14)
+            results[f"find_next_available/days=14/events={max(event_counts)}/unit={unit}"] = {
+                "seconds": _time_call(lambda: scheduler.find_next_available(2, BASE_DATE, 14, events, limit=8), repeat),
+                "peak_bytes": _peak_allocation(lambda: scheduler.find_next_available(2, BASE_DATE, 14, events, limit=8)),
+            }
+    finally:
+        scheduler.SLOT_UNIT_MINUTES = original_unit
+    return results
+
+
+def compare_baseline(results, baseline, max_regression):
+    """
+    基準値より max_regression 倍以上遅くなった項目を返す
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base and base["seconds"] > 0 and result["seconds"] > base["seconds"] * max_regression:
+            regressions.append((name, base["seconds"], result["seconds"]))
+    return regressions
+
+
+def _int_list(text):
+    return [int(v) for v in text.split(",") if v.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark and property-check the availability engine.')
+    parser.add_argument('--events', type=_int_list, default=[0, 10, 50, 100, 250, 500], help='Event counts per synthetic day')
+    parser.add_argument('--units', type=_int_list, default=[15, 30, 60], help='SLOT_UNIT_MINUTES values to test')
+    parser.add_argument('--slots', type=_int_list, default=[1, 2, 4], help='Required slot counts (menu lengths)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timing repetitions per case')
+    parser.add_argument('--trials', type=int, default=2000, help='Random property-check trials against the oracle')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--save-baseline', help='Write timings to this JSON file')
+    parser.add_argument('--baseline', help='Compare timings with this JSON file')
+    parser.add_argument('--max-regression', type=float, default=1.5, help='Fail when a case is this many times slower than the baseline')
+    args = parser.parse_args()
+
+    print(f"🔍 オラクルとの突き合わせ: {args.trials}回")
+    failures = check_properties(args.trials, args.seed, args.units, args.slots, max(args.events))
+    for failure in failures[:10]:
+        print(f"❌ 不一致: {failure}")
+    if not failures:
+        print("✅ すべて一致しました")
+
+    print("⏱️ 計測中...")
+    results = run_benchmarks(args.events, args.units, args.slots, args.repeat, args.seed)
+    print(f"{'case':60} {'time':>10} {'oracle':>10} {'peak':>10}")
+    for name, result in results.items():
+        oracle = f"{result['oracle_seconds'] * 1e6:8.1f}µs" if "oracle_seconds" in result else ""
+        print(f"{name:60} {result['seconds'] * 1e6:8.1f}µs {oracle:>10} {result['peak_bytes'] / 1024:7.1f}KiB")
+
+    exit_code = 1 if failures else 0
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 基準値を保存しました: {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_baseline(results, json.load(f), args.max_regression)
+        for name, before, after in regressions:
+            print(f"🐢 性能低下: {name} {before * 1e6:.1f}µs -> {after * 1e6:.1f}µs")
+        if regressions:
+            exit_code = 1
+    sys.exit(exit_code)
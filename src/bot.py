@@ -1,10 +1,7 @@
-from flask import Flask, request, abort
+from flask import Flask, request, abort, jsonify, Response
 from linebot.v3 import WebhookHandler
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
     ReplyMessageRequest,
     TextMessage,
     PushMessageRequest
@@ -15,6 +12,7 @@ from linebot.v3.webhooks import (
 )
 import os
 import sys
+import sqlite3
 from datetime import datetime, timedelta, time
 from dotenv import load_dotenv
 
@@ -25,27 +23,44 @@ load_dotenv()
 # このファイルが src/bot.py にあると仮定
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import scheduler
-import lark_calendar
+import staff
 import lark_crm
 import google_sheets # 追加
 
 import messages
+import menu_catalog
+import router
+import line_client
+import event_queue
+import availability
+import fanout
+import metrics
+import reminder_service
 
-# 簡易的なセッション管理（メモリ上）
-# { user_id: { "menu": "カット", "slots": 2 } }
-user_sessions = {}
+import session_store
+import reservation_store
+import reservation_sync
+
+# セッション管理（SESSION_BACKEND=sqlite なら複数ワーカーで共有）
+# { user_id: { "menu": "カット", "slots": 2, "step": "waiting_date", "date": date } }
+user_sessions = session_store.create_store()
+# 予約の記録先（外部サービスより先にここへ書く）
+reservations = reservation_store.get_store()
 
 app = Flask(__name__)
 
 # 環境変数の取得
 CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
+# 予約をLark Base（CRM）にも保存するか
+LARK_CRM_ENABLED = os.getenv('LARK_CRM_ENABLED', '').lower() in ('1', 'true', 'yes')
+# Botプロセス内でリマインドを送る（有効にする場合はcronの remind_scheduler.py は止める）
+REMINDER_SERVICE_ENABLED = os.getenv('REMINDER_SERVICE_ENABLED', '').lower() in ('1', 'true', 'yes')
 
 if not CHANNEL_ACCESS_TOKEN or not CHANNEL_SECRET:
     print("Error: LINE_CHANNEL_ACCESS_TOKEN or LINE_CHANNEL_SECRET is not set.")
     sys.exit(1)
 
-configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(CHANNEL_SECRET)
 
 @app.route("/callback", methods=['POST'])
@@ -57,112 +72,298 @@ def callback():
     body = request.get_data(as_text=True)
     app.logger.info("Request body: " + body)
 
-    # handle webhook body
+    # 署名検証だけ同期で行い、イベント処理はワーカープールに任せてすぐに200を返す
     try:
-        handler.handle(body, signature)
+        payload = handler.parser.parse(body, signature, as_payload=True)
     except InvalidSignatureError:
         app.logger.info("Invalid signature. Please check your channel access token/channel secret.")
         abort(400)
 
+    # gunicornのfork後に起動するよう、最初のリクエストでバックグラウンド処理を立ち上げる
+    reservation_sync.start()
+    if REMINDER_SERVICE_ENABLED:
+        reminder_service.start()
+
+    for event in payload.events:
+        # 同じユーザーのイベントは同じワーカーで順番に処理する
+        event_queue.submit(dispatch_event, event, key=getattr(event.source, "user_id", None))
+
     return 'OK'
 
+@app.route("/stats", methods=['GET'])
+def stats():
+    return jsonify({
+        "event_queue": event_queue.get_stats(),
+        "sessions": user_sessions.size(),
+        "line_client": line_client.get_stats(),
+        "reminders": reminder_service.get_stats(),
+        "message_templates": messages.templates.stats(),
+        "reservation_sync": reservation_sync.get_stats()
+    })
+
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+    queue_stats = event_queue.get_stats()
+    body = metrics.render({
+        "salon_event_queue_depth": queue_stats["queue_depth"],
+        "salon_event_queue_failed": queue_stats["failed"],
+        "salon_sessions": user_sessions.size(),
+        "salon_reminders_pending": reminder_service.get_stats()["pending"]
+    })
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+def dispatch_event(event):
+    """
+    WebhookHandlerに登録されたハンドラを探してイベントを処理する（ワーカースレッドで実行）
+    """
+    func = None
+    if isinstance(event, MessageEvent):
+        func = handler._handlers.get(f"{event.__class__.__name__}_{event.message.__class__.__name__}")
+    if func is None:
+        func = handler._handlers.get(event.__class__.__name__)
+    if func is None:
+        app.logger.info(f"No handler of {event.__class__.__name__}")
+        return
+    with metrics.span(func.__name__):
+        func(event)
+
+def _default_session():
+    menu = menu_catalog.default_menu()
+    return {"menu": menu["name"], "slots": menu["slots"]} if menu else {"menu": "カット", "slots": 2}
+
+def _menu_roles(session):
+    # メニューを担当できる役職（メニュー一覧に無い・指定なしなら誰でも担当できる）
+    menu = menu_catalog.find_menu(session.get("menu", ""))
+    return menu["roles"] if menu else None
+
+text_router = router.Router()
+
 @handler.add(MessageEvent, message=TextMessageContent)
 def handle_message(event):
-    text = event.message.text
-    user_id = event.source.user_id
+    # セッションは1イベントにつき1回だけ読み込み、入力と状態に応じたハンドラに振り分ける
+    session = user_sessions.get(event.source.user_id)
+    text_router.dispatch(router.Context(event, session, line_client.get_messaging_api()))
+
+@text_router.exact("予約")
+def reserve(ctx):
+    # 1. 「予約」とだけ打たれた場合 → メニュー選択へ
+    event = ctx.event
+    line_bot_api = ctx.api
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[messages.get_menu_flex_message()]
+        )
+    )
+
+@text_router.prefix("メニュー:")
+def select_menu(ctx):
+    # 2. メニューが選択された場合
+    event = ctx.event
+    text = ctx.text
+    user_id = ctx.user_id
+    line_bot_api = ctx.api
+    # メニュー名・別名からメニューを引く（所要時間はメニュー一覧の定義から）
+    menu = menu_catalog.find_menu(text.split(":", 1)[1])
+    if menu is None:
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[messages.templates.get("menu_not_found"), messages.get_menu_flex_message()]
+            )
+        )
+        return
+    menu_name = menu["name"]
+
+    # セッションに保存 & 状態を日付選択待ちへ
+    user_sessions.set(user_id, {
+        "menu": menu_name,
+        "slots": menu["slots"],
+        "step": "waiting_date"
+    })
     
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[messages.templates.get("menu_selected", menu_name=menu_name)]
+        )
+    )
+
+@text_router.exact("空き", "最短", "空き状況")
+def next_available(ctx):
+    # 2-2. 直近の空きを複数日まとめて検索する場合
+    event = ctx.event
+    user_id = ctx.user_id
+    session = ctx.session
+    line_bot_api = ctx.api
+    session = session or _default_session() # メニュー未選択ならデフォルト
+    session["step"] = "waiting_date"
+    user_sessions.set(user_id, session)
 
-        # 1. 「予約」とだけ打たれた場合 → メニュー選択へ
-        if text == "予約":
+    available = availability.search_next_available(session["slots"], roles=_menu_roles(session))
+    reply_msg = availability.format_next_available(session["menu"], available)
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=reply_msg)]
+        )
+    )
+
+@text_router.state("waiting_date")
+def input_date(ctx):
+    # 3. 日付が入力された場合（状態: waiting_date）
+    event = ctx.event
+    text = ctx.text
+    user_id = ctx.user_id
+    session = ctx.session
+    line_bot_api = ctx.api
+    input_date_str = text.strip()
+    target_date = None
+    
+    # 日付パース
+    try:
+        current_year = datetime.now().year
+        if input_date_str in ["明日", "あした"]:
+            target_date = datetime.now().date() + timedelta(days=1)
+        elif input_date_str in ["今日", "きょう"]:
+            target_date = datetime.now().date()
+        else:
+             # 2/10, 2-10, 2026/02/10 などを簡易パース
+            normalized = input_date_str.replace("月", "/").replace("日", "").replace("-", "/")
+            if normalized.count("/") == 1: # "2/10" format
+                month, day = map(int, normalized.split("/"))
+                target_date = datetime(current_year, month, day).date()
+                # もし過去の日付なら来年にする？（今回は単純に現在年）
+                if target_date < datetime.now().date():
+                     # 過去ならエラーにするか、来年にするか。一旦そのまま
+                     pass
+            elif normalized.count("/") == 2: # "2026/2/10"
+                target_date = datetime.strptime(normalized, "%Y/%m/%d").date()
+            else:
+                raise ValueError("Invalid date format")
+
+        # セッションに日付を保存 & 状態更新
+        session["date"] = target_date
+        session["step"] = "waiting_time"
+        
+        # 空き状況検索（スタッフ全員のカレンダーを日別キャッシュ経由で同時に取得）
+        required_slots = session["slots"]
+
+        # まだカレンダーに反映されていないローカルの予約・キャンセルも重ねる
+        available = availability.day_availability(required_slots, target_date, _menu_roles(session))
+        
+        if available is None:
+            reply_msg = availability.UNAVAILABLE_MESSAGE
+            session["step"] = "waiting_date"
+        elif not available:
+            reply_msg = f"{target_date.strftime('%Y/%m/%d')} は満席です😭\n別の日程を入力してください。"
+            session["step"] = "waiting_date" # 日付選択やり直し
+        else:
+            slots_str = "\n".join([f"・{s['label'].split('(')[0]}" for s in available[:8]])
+            reply_msg = f"📅 {target_date.strftime('%m/%d')} の空き状況:\n{slots_str}\n\n※予約したい時間を「10:00」のように入力して送信してください。"
+
+        user_sessions.set(user_id, session)
+        reply = TextMessage(text=reply_msg)
+
+    except Exception as e:
+        reply = messages.templates.get("date_invalid")
+    
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[reply]
+        )
+    )
+
+@text_router.pattern(r"\d{1,2}:\d{1,2}")
+def input_time(ctx):
+    # 4. 時間が入力された場合（予約実行）
+    event = ctx.event
+    text = ctx.text
+    user_id = ctx.user_id
+    session = ctx.session
+    line_bot_api = ctx.api
+    # セッションチェック（日付が決まっているか？）
+    if not session or "date" not in session:
+         # いきなり時間入力された場合は、デフォルトで明日とみなすか、メニュー選択へ誘導
+         # 今回は旧仕様との互換性で「明日」扱いにする（またはエラー）
+         target_date = datetime.now().date() + timedelta(days=1)
+         session = _default_session() # デフォルト
+    else:
+         target_date = session["date"]
+
+    try:
+        target_time_str = text.strip()
+        target_hour, target_minute = map(int, target_time_str.split(":"))
+        
+        menu_name = session["menu"]
+        required_slots = session["slots"]
+        
+        # 時間計算
+        start_dt = datetime.combine(target_date, time(target_hour, target_minute))
+        # スロット数から終了時間を計算
+        duration_minutes = required_slots * scheduler.SLOT_UNIT_MINUTES
+        end_dt = start_dt + timedelta(minutes=duration_minutes)
+
+        if not scheduler.is_valid_start(start_dt, end_dt):
+            # 枠の区切りでない時刻（10:15 など）や営業時間外は受け付けない
+            reply_msg = (
+                f"{target_hour}:{target_minute:02d} からはご予約いただけません🙇\n"
+                f"営業時間 {scheduler.OPEN_TIME.strftime('%H:%M')}〜{scheduler.CLOSE_TIME.strftime('%H:%M')} の"
+                f"{scheduler.SLOT_UNIT_MINUTES}分単位で、終了が閉店までに収まる時間を「10:00」のように入力してください。"
+            )
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[messages.get_menu_flex_message()]
+                    messages=[TextMessage(text=reply_msg)]
                 )
             )
+            return
 
-        # 2. メニューが選択された場合
-        elif text.startswith("メニュー:"):
-            # メニュー名を取得
-            menu_name = text.split(":")[1].strip()
-            
-            # 所要時間（スロット数）の判定
-            required_slots = 2
-            if "カラー" in menu_name:
-                required_slots = 3
-            elif "ヘッドスパ" in menu_name:
-                required_slots = 1
-            
-            # セッションに保存 & 状態を日付選択待ちへ
-            user_sessions[user_id] = {
-                "menu": menu_name,
-                "slots": required_slots,
-                "step": "waiting_date"
-            }
-            
-            reply_msg = (
-                f"【選択: {menu_name}】\n"
-                "ご希望の日付を入力してください。\n"
-                "例: 2/10, 2月10日, 明日"
-            )
+        # ローカルのストアに書いた時点で確定する（Lark Calendar / Sheets / CRM へは reservation_sync が後から反映する）
+        targets = [reservation_store.TARGET_CALENDAR, reservation_store.TARGET_SHEETS]
+        if LARK_CRM_ENABLED:
+            targets.append(reservation_store.TARGET_CRM)
+        # 空き確認と登録は同じトランザクションで行う（同じ枠への同時予約は1人だけが通る）
+        # カレンダーの予定は日付入力時に読み込んだ日別キャッシュを使い、空いているスタッフを割り当てる
+        members = staff.get_staff(_menu_roles(session))
+        # カレンダーを取得できなかったスタッフには割り当てない（実際の予定と重なるおそれがある）
+        candidates = [
+            {"id": member["id"], "calendar_id": member["calendar_id"], "events": events,
+             "primary": member["primary"]}
+            for member, events in zip(members, staff.day_events(target_date, members))
+            if events is not None
+        ]
+        if members and not candidates:
+            print(f"❌ カレンダーを取得できないため予約を受け付けませんでした: {target_date}")
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
-                    messages=[TextMessage(text=reply_msg)]
+                    messages=[TextMessage(text=availability.UNAVAILABLE_MESSAGE)]
                 )
             )
+            return
+        try:
+            reservation = reservations.create_reservation(
+                user_id, menu_name, start_dt, end_dt, targets, staff=candidates
+            )
+            taken = reservation is None
+        except sqlite3.Error as e:
+            print(f"❌ 予約の保存に失敗しました: {e}")
+            reservation = None
+            taken = False
 
-        # 3. 日付が入力された場合（状態: waiting_date）
-        elif user_sessions.get(user_id, {}).get("step") == "waiting_date":
-            input_date_str = text.strip()
-            target_date = None
-            
-            # 日付パース
-            try:
-                current_year = datetime.now().year
-                if input_date_str in ["明日", "あした"]:
-                    target_date = datetime.now().date() + timedelta(days=1)
-                elif input_date_str in ["今日", "きょう"]:
-                    target_date = datetime.now().date()
-                else:
-                     # 2/10, 2-10, 2026/02/10 などを簡易パース
-                    normalized = input_date_str.replace("月", "/").replace("日", "").replace("-", "/")
-                    if normalized.count("/") == 1: # "2/10" format
-                        month, day = map(int, normalized.split("/"))
-                        target_date = datetime(current_year, month, day).date()
-                        # もし過去の日付なら来年にする？（今回は単純に現在年）
-                        if target_date < datetime.now().date():
-                             # 過去ならエラーにするか、来年にするか。一旦そのまま
-                             pass
-                    elif normalized.count("/") == 2: # "2026/2/10"
-                        target_date = datetime.strptime(normalized, "%Y/%m/%d").date()
-                    else:
-                        raise ValueError("Invalid date format")
-
-                # セッションに日付を保存 & 状態更新
-                user_sessions[user_id]["date"] = target_date
-                user_sessions[user_id]["step"] = "waiting_time"
-                
-                # 空き状況検索
-                start_search = datetime.combine(target_date, scheduler.OPEN_TIME)
-                end_search = datetime.combine(target_date, scheduler.CLOSE_TIME)
-                required_slots = user_sessions[user_id]["slots"]
-
-                existing_events = lark_calendar.get_calendar_events(start_search, end_search)
-                available = scheduler.check_availability(required_slots, target_date, existing_events)
-                
-                if not available:
-                    reply_msg = f"{target_date.strftime('%Y/%m/%d')} は満席です😭\n別の日程を入力してください。"
-                    user_sessions[user_id]["step"] = "waiting_date" # 日付選択やり直し
-                else:
-                    slots_str = "\n".join([f"・{s['label'].split('(')[0]}" for s in available[:8]])
-                    reply_msg = f"📅 {target_date.strftime('%m/%d')} の空き状況:\n{slots_str}\n\n※予約したい時間を「10:00」のように入力して送信してください。"
-
-            except Exception as e:
-                reply_msg = "日付を正しく認識できませんでした。「2/10」のように入力してください。"
-            
+        if taken:
+            # 直前に他の方が同じ枠を予約した（日付は選択済みのまま、別の時間を選んでもらう）
+            available = availability.day_availability(required_slots, target_date, _menu_roles(session))
+            slots_str = "\n".join([f"・{s['label'].split('(')[0]}" for s in available[:8]])
+            reply_msg = (
+                f"申し訳ありません。{start_dt.strftime('%m/%d %H:%M')} は直前に埋まってしまいました🙇\n\n"
+                + (f"現在の空き状況:\n{slots_str}\n\n別の時間を「10:00」のように入力してください。" if available
+                   else "この日は満席になりました。別の日付を入力してください。")
+            )
+            session["step"] = "waiting_time" if available else "waiting_date"
+            user_sessions.set(user_id, session)
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
@@ -170,176 +371,154 @@ def handle_message(event):
                 )
             )
 
-        # 4. 時間が入力された場合（予約実行）
-        elif ":" in text and len(text) <= 5:
-            # セッションチェック（日付が決まっているか？）
-            session = user_sessions.get(user_id)
-            if not session or "date" not in session:
-                 # いきなり時間入力された場合は、デフォルトで明日とみなすか、メニュー選択へ誘導
-                 # 今回は旧仕様との互換性で「明日」扱いにする（またはエラー）
-                 target_date = datetime.now().date() + timedelta(days=1)
-                 session = {"menu": "カット", "slots": 2} # デフォルト
-            else:
-                 target_date = session["date"]
-
-            try:
-                target_time_str = text.strip()
-                target_hour, target_minute = map(int, target_time_str.split(":"))
-                
-                menu_name = session["menu"]
-                required_slots = session["slots"]
-                
-                # 時間計算
-                start_dt = datetime.combine(target_date, time(target_hour, target_minute))
-                # スロット数から終了時間を計算
-                duration_minutes = required_slots * scheduler.SLOT_UNIT_MINUTES
-                end_dt = start_dt + timedelta(minutes=duration_minutes)
-                
-                summary = f"【LINE予約】{menu_name} - {user_id[:5]}...様"
-                description = f"LINEからの自動予約\nメニュー: {menu_name}\n希望時間: {target_time_str}"
-                
-                # Larkに登録
-                if lark_calendar.create_calendar_event(summary, start_dt, end_dt, description):
-                    
-                    # 1. お客様（予約者）への返信
-                    reply_msg = f"✅ 予約を確定しました！\n\n📝 メニュー: {menu_name}\n🕘 日時: {start_dt.strftime('%m/%d %H:%M')} - {end_dt.strftime('%H:%M')}\nご来店をお待ちしております。"
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_msg)]
-                        )
-                    )
+        elif reservation:
+            reservation_sync.wake()
 
-                    # セッションクリア
-                    if user_id in user_sessions:
-                        del user_sessions[user_id]
-
-                    # 2. オーナー（管理者）への通知
-                    # 今回はデモとして「予約した本人」に管理者通知も送ります。
-                    # 本番ではオーナーのUser ID (os.getenv('OWNER_LINE_ID')) を指定します。
-                    admin_msg = (
-                        f"🔔 【管理者通知】新しい予約が入りました！\n\n"
-                        f"👤 顧客ID: {user_id[:8]}...\n"
-                        f"📝 メニュー: {menu_name}\n"
-                        f"📅 日時: {start_dt.strftime('%Y/%m/%d %H:%M')}"
-                    )
-                    try:
-                        line_bot_api.push_message(
-                            PushMessageRequest(
-                                to=user_id, # ここをオーナーIDに変えればOK
-                                messages=[TextMessage(text=admin_msg)]
-                            )
-                        )
-                    except Exception as e:
-                        print(f"Failed to send admin notification: {e}")
-
-                    # 3. Lark Base CRM保存 (失敗しても止まらないようにtryで囲むのが安全)
-                    try:
-                        res_date_str = start_dt.strftime('%Y-%m-%d')
-                        res_time_str = start_dt.strftime('%H:%M')
-                        # Lark CRM
-                        # lark_crm.add_reservation_record(user_id, res_date_str, res_time_str, menu=menu_name)
-
-                        # Google Sheets (Optional)
-                        google_sheets.add_reservation_to_sheet(user_id, res_date_str, res_time_str, menu_name)
-                    except Exception as e:
-                        print(f"CRM/Sheets save failed: {e}")
-
-                else:
-                    reply_msg = "申し訳ありません。予約の登録に失敗しました。もう一度お試しいただくか、店舗へ直接ご連絡ください。"
-                    line_bot_api.reply_message(
-                        ReplyMessageRequest(
-                            reply_token=event.reply_token,
-                            messages=[TextMessage(text=reply_msg)]
-                        )
-                    )
-                    
-            except ValueError:
-                 reply_msg = "時間の形式が正しくありません。「10:00」のように入力してください。"
-                 line_bot_api.reply_message(
+            # セッションクリア
+            user_sessions.delete(user_id)
+
+            # 1. お客様（予約者）への返信
+            staff_name = next((m["name"] for m in members if m["id"] == reservation["staff_id"]), "")
+            staff_line = f"👤 担当: {staff_name}\n" if staff_name else ""
+            reply_msg = f"✅ 予約を確定しました！\n\n📝 メニュー: {menu_name}\n🕘 日時: {start_dt.strftime('%m/%d %H:%M')} - {end_dt.strftime('%H:%M')}\n{staff_line}ご来店をお待ちしております。"
+
+            # 2. オーナー（管理者）への通知
+            # 今回はデモとして「予約した本人」に管理者通知も送ります。
+            # 本番ではオーナーのUser ID (os.getenv('OWNER_LINE_ID')) を指定します。
+            admin_msg = (
+                f"🔔 【管理者通知】新しい予約が入りました！\n\n"
+                f"👤 顧客ID: {user_id[:8]}...\n"
+                f"📝 メニュー: {menu_name}\n"
+                f"📅 日時: {start_dt.strftime('%Y/%m/%d %H:%M')}"
+                + (f"\n💇 担当: {staff_name}" if staff_name else "")
+            )
+
+            # 返信と通知は同時に送る（待ち時間は遅い方の分だけ）
+            tasks = {
+                "reply": lambda: line_bot_api.reply_message(
                     ReplyMessageRequest(
                         reply_token=event.reply_token,
                         messages=[TextMessage(text=reply_msg)]
                     )
-                )
-            except Exception as e:
-                reply_msg = f"エラーが発生しました: {str(e)}"
-                line_bot_api.reply_message(
-                    ReplyMessageRequest(
-                        reply_token=event.reply_token,
-                        messages=[TextMessage(text=reply_msg)]
+                ),
+                "admin_push": lambda: line_bot_api.push_message(
+                    PushMessageRequest(
+                        to=user_id, # ここをオーナーIDに変えればOK
+                        messages=[TextMessage(text=admin_msg)]
                     )
                 )
+            }
 
+            result = fanout.run_concurrently(tasks)
+            reminder_service.add_reservation(reservation)
+            for name in result.failed():
+                outcome = result.outcomes[name]
+                print(f"Post-booking task '{name}' {outcome['status']}: {outcome['error']}")
 
-        elif text in ["キャンセル", "予約キャンセル"]:
-            # Google Sheetsからキャンセル
-            canceled_info = google_sheets.cancel_reservation(user_id)
-            
-            if canceled_info:
-                # ユーザー要望: キャンセル内容をわかりやすく返す
-                reply_msg = (
-                    f"✅ 以下の予約をキャンセルしました。\n\n"
-                    f"📅 {canceled_info['date']} {canceled_info['time']}\n"
-                    f"📝 メニュー: {canceled_info['menu']}\n\n"
-                    f"またのご予約をお待ちしております。"
-                )
-
-                # --- 管理者（オーナー）への通知 ---
-                # 本番ではオーナーのUser IDを指定しますが、今はデモとして「操作した人」に通知します
-                try:
-                    admin_msg = (
-                        f"🗑️ 【管理者通知】予約がキャンセルされました。\n\n"
-                        f"👤 顧客ID: {user_id[:8]}...\n"
-                        f"📅 日時: {canceled_info['date']} {canceled_info['time']}\n"
-                        f"📝 メニュー: {canceled_info['menu']}"
-                    )
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id, # ここをオーナーID (os.getenv('OWNER_LINE_ID')) に変更すれば本番OK
-                            messages=[TextMessage(text=admin_msg)]
-                        )
-                    )
-                except Exception as e:
-                    print(f"Failed to send admin notification: {e}")
-                # ----------------------------------
-            else:
-                reply_msg = (
-                    "ℹ️ キャンセル可能な予約が見つかりませんでした。\n"
-                    "（既にキャンセル済みか、もし過去の予約の場合は店舗へ直接ご連絡ください）"
-                )
-            
+        else:
+            reply_msg = "申し訳ありません。予約の登録に失敗しました。もう一度お試しいただくか、店舗へ直接ご連絡ください。"
             line_bot_api.reply_message(
                 ReplyMessageRequest(
                     reply_token=event.reply_token,
                     messages=[TextMessage(text=reply_msg)]
                 )
             )
-
-        elif text == "店舗情報":
-            video_url = "https://example.com/salon_intro.mp4" # ダミーURL、必要であれば実際の動画URLへ
-            info_msg = (
-                "【 Salon Antigravity 】\n\n"
-                "📍 住所\n東京都渋谷区神宮前1-2-3\n\n"
-                "🕘 営業時間\n09:00 - 20:00 (最終受付 19:00)\n\n"
-                "定休日: 火曜日\n\n"
-                "皆様のご来店を心よりお待ちしております✨"
+            
+    except ValueError:
+         reply_msg = "時間の形式が正しくありません。「10:00」のように入力してください。"
+         line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_msg)]
             )
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=info_msg)]
-                )
+        )
+    except Exception as e:
+        reply_msg = f"エラーが発生しました: {str(e)}"
+        line_bot_api.reply_message(
+            ReplyMessageRequest(
+                reply_token=event.reply_token,
+                messages=[TextMessage(text=reply_msg)]
             )
-            
-        else:
-            # エコーバック + 案内
-            line_bot_api.reply_message(
-                ReplyMessageRequest(
-                    reply_token=event.reply_token,
-                    messages=[TextMessage(text=f"「{text}」ですね！\n予約をご希望の場合は「予約」と入力してください。")]
+        )
+
+@text_router.exact("キャンセル", "予約キャンセル")
+def cancel(ctx):
+    # 5. キャンセル（今日以降の一番新しい予約）
+    event = ctx.event
+    user_id = ctx.user_id
+    line_bot_api = ctx.api
+    # ローカルのストアでキャンセルし、外部への反映は reservation_sync に任せる
+    canceled_info = reservations.cancel_latest(user_id)
+    if canceled_info:
+        reservation_sync.wake()
+    else:
+        # ストア導入前の予約はGoogle Sheetsから直接キャンセルする
+        canceled_info = google_sheets.cancel_reservation(user_id)
+    
+    if canceled_info:
+        reminder_service.remove_reservation(dict(canceled_info, user_id=user_id))
+
+        # ユーザー要望: キャンセル内容をわかりやすく返す
+        reply_msg = (
+            f"✅ 以下の予約をキャンセルしました。\n\n"
+            f"📅 {canceled_info['date']} {canceled_info['time']}\n"
+            f"📝 メニュー: {canceled_info['menu']}\n\n"
+            f"またのご予約をお待ちしております。"
+        )
+
+        # --- 管理者（オーナー）への通知 ---
+        # 本番ではオーナーのUser IDを指定しますが、今はデモとして「操作した人」に通知します
+        try:
+            admin_msg = (
+                f"🗑️ 【管理者通知】予約がキャンセルされました。\n\n"
+                f"👤 顧客ID: {user_id[:8]}...\n"
+                f"📅 日時: {canceled_info['date']} {canceled_info['time']}\n"
+                f"📝 メニュー: {canceled_info['menu']}"
+            )
+            line_bot_api.push_message(
+                PushMessageRequest(
+                    to=user_id, # ここをオーナーID (os.getenv('OWNER_LINE_ID')) に変更すれば本番OK
+                    messages=[TextMessage(text=admin_msg)]
                 )
             )
+        except Exception as e:
+            print(f"Failed to send admin notification: {e}")
+        # ----------------------------------
+        reply = TextMessage(text=reply_msg)
+    else:
+        reply = messages.templates.get("no_cancellable")
+    
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[reply]
+        )
+    )
+
+@text_router.exact("店舗情報")
+def store_info(ctx):
+    # 6. 店舗情報（定型文はメッセージの雛形から使い回す）
+    event = ctx.event
+    line_bot_api = ctx.api
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[messages.templates.get("store_info")]
+        )
+    )
+
+@text_router.fallback
+def echo(ctx):
+    # どれにも当たらない場合: エコーバック + 案内
+    event = ctx.event
+    text = ctx.text
+    line_bot_api = ctx.api
+    line_bot_api.reply_message(
+        ReplyMessageRequest(
+            reply_token=event.reply_token,
+            messages=[TextMessage(text=f"「{text}」ですね！\n予約をご希望の場合は「予約」と入力してください。")]
+        )
+    )
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
@@ -0,0 +1,182 @@
+import os
+import queue
+import threading
+import time
+import atexit
+from collections import deque
+
+# --- CONFIGURATION ---
+# Webhookイベントを処理するワーカースレッド数
+EVENT_WORKERS = int(os.getenv('EVENT_WORKERS', '4'))
+# キューに溜められるイベントの上限（ワーカーごとに等分する。超えた場合は呼び出し元で同期処理する）
+EVENT_QUEUE_SIZE = int(os.getenv('EVENT_QUEUE_SIZE', '100'))
+# キュー投入時に空きを待つ最大秒数
+EVENT_ENQUEUE_TIMEOUT = float(os.getenv('EVENT_ENQUEUE_TIMEOUT', '0.05'))
+# レイテンシ統計として保持する直近サンプル数
+LATENCY_SAMPLES = 1000
+
+_STOP = object()
+
+
+class MemoryQueueBackend:
+    """
+    プロセス内の queue.Queue を使うデフォルトのキューバックエンド
+    別のバックエンドを使う場合は put / get / qsize を同じシグネチャで実装する
+    """
+
+    def __init__(self, maxsize=EVENT_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, item, timeout=None):
+        # 満杯の場合は queue.Full を送出する
+        self._queue.put(item, timeout=timeout)
+
+    def get(self, timeout=None):
+        return self._queue.get(timeout=timeout)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+
+class WorkerPool:
+    """
+    Webhookイベントをバックグラウンドで処理する固定サイズのワーカープール
+    ワーカーごとにキューを持ち、同じキー（LINEのユーザーID）のイベントは常に同じワーカーが
+    受け取った順に処理する（日付→時刻のような連続した入力が同じセッションを取り合わないように）
+    backend_factory: ワーカー1つ分のキューを作る関数（maxsize を受け取る）
+    """
+
+    def __init__(self, num_workers=EVENT_WORKERS, backend_factory=MemoryQueueBackend):
+        self.num_workers = num_workers
+        per_worker = max(1, -(-EVENT_QUEUE_SIZE // num_workers))
+        self.backends = [backend_factory(maxsize=per_worker) for _ in range(num_workers)]
+        self._next = 0
+        self._threads = []
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._waits = deque(maxlen=LATENCY_SAMPLES)
+        self._stats = {
+            "submitted": 0,
+            "processed": 0,
+            "failed": 0,
+            "inline": 0,
+        }
+
+    def start(self):
+        """
+        ワーカースレッドを起動する（gunicornのfork後に起動されるよう初回投入時に呼ぶ）
+        """
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.num_workers):
+                t = threading.Thread(target=self._worker, args=(self.backends[i],), name=f"event-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, func, *args, key=None):
+        """
+        処理をキューに投入する。キューが満杯なら呼び出し元スレッドで同期実行する
+        key: 順序を守りたい単位（ユーザーIDなど）。同じキーは同じワーカーに割り当てる
+             （None の場合は順番に割り振る）
+        戻り値: キューに投入できた場合 True
+        """
+        self.start()
+        with self._lock:
+            self._stats["submitted"] += 1
+            if key is None:
+                index = self._next
+                self._next = (self._next + 1) % self.num_workers
+            else:
+                index = hash(key) % self.num_workers
+        try:
+            self.backends[index].put((func, args, time.monotonic()), timeout=EVENT_ENQUEUE_TIMEOUT)
+            return True
+        except queue.Full:
+            # ワーカーが大きく遅れている場合のみ。Webhookの応答を優先するため、この時だけは順序を保証しない
+            print("⚠️ イベントキューが満杯のため同期処理します")
+            with self._lock:
+                self._stats["inline"] += 1
+            self._run(func, args, time.monotonic())
+            return False
+
+    def shutdown(self, timeout=5.0):
+        """
+        残っているイベントを処理し終えてからワーカーを停止する
+        """
+        with self._lock:
+            threads = self._threads
+            self._threads = []
+        if not threads:
+            return
+        deadline = time.monotonic() + timeout
+        for backend in self.backends:
+            try:
+                backend.put(_STOP, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                # キューが空かないまま時間切れ。ワーカーはデーモンスレッドなのでプロセス終了とともに止まる
+                print("⚠️ イベントキューが満杯のため、ワーカーの停止を待たずに終了します")
+        for t in threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+
+    def get_stats(self):
+        """
+        キューの深さと、処理時間・キュー待ち時間（秒）の統計を返す
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            latencies = sorted(self._latencies)
+            waits = sorted(self._waits)
+        stats["queue_depth"] = sum(backend.qsize() for backend in self.backends)
+        stats["workers"] = len(self._threads)
+        for name, samples in (("latency", latencies), ("wait", waits)):
+            if samples:
+                stats[f"{name}_p50"] = samples[len(samples) // 2]
+                stats[f"{name}_p99"] = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+                stats[f"{name}_max"] = samples[-1]
+        return stats
+
+    def _worker(self, backend):
+        while True:
+            item = backend.get()
+            if item is _STOP:
+                return
+            func, args, enqueued_at = item
+            self._run(func, args, enqueued_at)
+
+    def _run(self, func, args, enqueued_at):
+        ok = True
+        started_at = time.monotonic()
+        try:
+            func(*args)
+        except Exception as e:
+            ok = False
+            print(f"❌ イベント処理エラー: {e}")
+        finished_at = time.monotonic()
+        with self._lock:
+            self._stats["processed" if ok else "failed"] += 1
+            self._latencies.append(finished_at - started_at)
+            self._waits.append(started_at - enqueued_at)
+
+
+# プロセス共通のプール
+pool = WorkerPool()
+atexit.register(lambda: pool.shutdown())
+
+
+def configure(num_workers=EVENT_WORKERS, backend_factory=MemoryQueueBackend):
+    """
+    プロセス共通のプールを差し替える（キューバックエンドの変更など）
+    """
+    global pool
+    pool.shutdown()
+    pool = WorkerPool(num_workers=num_workers, backend_factory=backend_factory)
+    return pool
+
+
+def submit(func, *args, key=None):
+    return pool.submit(func, *args, key=key)
+
+
+def get_stats():
+    return pool.get_stats()
@@ -0,0 +1,76 @@
+import os
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+# --- CONFIGURATION ---
+# 副作用（通知・外部保存）を並行実行する共有スレッド数
+FANOUT_WORKERS = int(os.getenv('FANOUT_WORKERS', '8'))
+# タスクごとのデフォルトのタイムアウト（秒）
+FANOUT_TIMEOUT = float(os.getenv('FANOUT_TIMEOUT', '10'))
+
+_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="fanout")
+
+
+class FanoutResult:
+    """
+    並行実行したタスクの結果をまとめたもの
+    outcomes: { name: {"status": "ok" | "failed" | "error" | "timeout", "value", "error", "elapsed"} }
+    """
+
+    def __init__(self):
+        self.outcomes = {}
+        self.elapsed = 0.0
+
+    def ok(self, name):
+        return self.outcomes.get(name, {}).get("status") == "ok"
+
+    def failed(self):
+        return [name for name, o in self.outcomes.items() if o["status"] != "ok"]
+
+    def __repr__(self):
+        parts = [f"{name}={o['status']}({o['elapsed']:.2f}s)" for name, o in self.outcomes.items()]
+        return f"FanoutResult({', '.join(parts)}, total={self.elapsed:.2f}s)"
+
+
+def _timed(func):
+    started = time.monotonic()
+    value = func()
+    return value, time.monotonic() - started
+
+
+def run_concurrently(tasks, timeout=FANOUT_TIMEOUT):
+    """
+    互いに独立した処理を共有スレッドプールで同時に実行し、全体の結果を返す
+    tasks: { name: callable } または { name: (callable, timeout秒) }
+    - 例外は "error"、戻り値が False の場合は "failed" として記録する
+    - タイムアウトしたタスクは待つのをやめるだけで、処理自体はバックグラウンドで続く
+    """
+    started = time.monotonic()
+    futures = {}
+    for name, task in tasks.items():
+        func, task_timeout = task if isinstance(task, tuple) else (task, timeout)
+        # 呼び出し元の計測スパンなどを引き継いで実行する
+        ctx = contextvars.copy_context()
+        futures[name] = (_executor.submit(ctx.run, _timed, func), started + task_timeout)
+
+    result = FanoutResult()
+    for name, (future, deadline) in futures.items():
+        outcome = {"status": "ok", "value": None, "error": None, "elapsed": 0.0}
+        try:
+            value, elapsed = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            outcome["value"] = value
+            outcome["elapsed"] = elapsed
+            if value is False:
+                outcome["status"] = "failed"
+        except FutureTimeoutError:
+            outcome["status"] = "timeout"
+            outcome["elapsed"] = time.monotonic() - started
+        except Exception as e:
+            outcome["status"] = "error"
+            outcome["error"] = e
+            outcome["elapsed"] = time.monotonic() - started
+        result.outcomes[name] = outcome
+
+    result.elapsed = time.monotonic() - started
+    return result
@@ -2,13 +2,54 @@ import gspread
 import os
 import datetime
 import json
+import re
+import atexit
+import time
+import threading
+import requests
+import metrics
 
 # スプレッドシートの名前（共有時にこれと同じ名前にする）
 SPREADSHEET_NAME = 'SalonReservations'
+# スプレッドシートのID（URLの /d/ の後ろ）。設定するとDrive検索を省略できる
+SPREADSHEET_ID = os.environ.get("GOOGLE_SPREADSHEET_ID")
+# ハンドルを開き直して再試行するAPIエラー（認証切れ・シートが見つからない）
+REOPEN_STATUS_CODES = (401, 404)
 
-def get_client():
+# 行インデックスを全件から作り直す間隔（秒）。他プロセスや手作業での編集に追従するため
+INDEX_MAX_AGE_SECONDS = int(os.environ.get("SHEET_INDEX_MAX_AGE", "600"))
+# 予約シートの列範囲（日付, 時間, 顧客ID, メニュー, 名前, 登録タイムスタンプ）
+SHEET_COLUMNS = "A:F"
+
+# プロセス内で使い回すクライアントとワークシート
+_lock = threading.Lock()
+_client = None
+_client_loaded = False
+_sheet = None
+
+# 書き込みバッファ: 予約行をまとめて append_rows する（0なら1件ずつ即時書き込み）
+SHEET_FLUSH_SIZE = int(os.environ.get("SHEET_FLUSH_SIZE", "20"))
+# バッファを書き出す間隔（秒）
+SHEET_FLUSH_INTERVAL = float(os.environ.get("SHEET_FLUSH_INTERVAL", "2"))
+# 書き出し前の行を保存するジャーナルの置き場所（ワーカーが落ちても失われないように）
+SHEET_JOURNAL_DIR = os.environ.get("SHEET_JOURNAL_DIR", ".")
+
+# 日付で絞り込んで読む場合に、日付列を一度に読む行数
+SHEET_SCAN_CHUNK = int(os.environ.get("SHEET_SCAN_CHUNK", "5000"))
+# 末尾から読み進めて、予約日がすべて「探している日付のこの日数前」より古いチャンクに達したら読むのをやめる
+# （行は予約を受けた順に追記されるので、予約日の順には大まかにしか並んでいない。
+#   これより前もって入った予約が更に上の行にあると見落とすので、予約を受ける最長の日数より長くしておく）
+SHEET_SCAN_LOOKBACK_DAYS = int(os.environ.get("SHEET_SCAN_LOOKBACK_DAYS", "90"))
+
+# 予約行のインデックス
+# { "rows": { 行番号: 行データ }, "by_user": { user_id: {行番号} }, "by_date": { date: {行番号} },
+#   "last_row": 読み込み済みの最終行, "built_at": 作成時刻 }
+_index_lock = threading.Lock()
+_index = None
+
+def _build_client():
     """
-    gspreadクライアントを取得する（環境変数 or ファイル）
+    gspreadクライアントを作成する（環境変数 or ファイル）
     """
     # 1. 環境変数から読み込み（Render用）
     json_creds = os.environ.get("GOOGLE_CREDENTIALS_JSON")
@@ -30,6 +71,344 @@ def get_client():
 
     return None
 
+def get_client():
+    """
+    gspreadクライアントを取得する（初回のみ認証情報を読み込み、以降は使い回す）
+    アクセストークンの期限切れはクライアント内部のセッションが自動で更新する
+    """
+    global _client, _client_loaded
+    if not _client_loaded:
+        with _lock:
+            if not _client_loaded:
+                _client = _build_client()
+                _client_loaded = True
+    return _client
+
+def get_sheet():
+    """
+    予約用ワークシート（sheet1）のハンドルを取得する（初回のみ open する）
+    認証情報が無い場合は None、スプレッドシートが無い場合は gspread.SpreadsheetNotFound
+    """
+    global _sheet
+    if _sheet is None:
+        client = get_client()
+        if not client:
+            return None
+        with _lock:
+            if _sheet is None:
+                if SPREADSHEET_ID:
+                    spreadsheet = client.open_by_key(SPREADSHEET_ID)
+                else:
+                    spreadsheet = client.open(SPREADSHEET_NAME)
+                _sheet = metrics.instrument(spreadsheet.sheet1, "google_sheets", [
+                    "get_all_values", "get", "batch_get", "append_row", "append_rows", "delete_rows"
+                ])
+    return _sheet
+
+def reset_sheet():
+    """
+    キャッシュしたワークシートのハンドルを破棄する（次回の利用時に開き直す）
+    """
+    global _sheet
+    with _lock:
+        _sheet = None
+
+def _call_with_reopen(operation, idempotent=False):
+    """
+    ワークシートに対する操作を実行する
+    ハンドルが古くなった可能性のあるエラー（認証切れ・シート削除）の場合は、開き直して1回だけ再試行する
+    idempotent=True（読み取り）の場合は接続切れでも再試行する
+    （書き込みは反映済みの可能性があるので、接続切れでは再試行しない）
+    """
+    sheet = get_sheet()
+    try:
+        return operation(sheet)
+    except gspread.exceptions.APIError as e:
+        if e.code not in REOPEN_STATUS_CODES:
+            raise
+        print(f"⚠️ Google Sheet再接続します: {e.code}")
+    except requests.exceptions.ConnectionError as e:
+        if not idempotent:
+            raise
+        print(f"⚠️ Google Sheet再接続します: {e}")
+    reset_sheet()
+    return operation(get_sheet())
+
+def _row_key(row):
+    # 日付, 時間, 顧客ID, メニュー で同じ行かどうかを判定する
+    return tuple((list(row) + [""] * 4)[:4])
+
+def _index_add(index, row_no, row):
+    index["rows"][row_no] = row
+    if len(row) >= 3 and row[0] != "日付":
+        index["by_user"].setdefault(row[2], set()).add(row_no)
+        index["by_date"].setdefault(row[0], set()).add(row_no)
+
+def _index_discard(index, row_no):
+    row = index["rows"].pop(row_no, None)
+    if row is None or len(row) < 3 or row[0] == "日付":
+        return row
+    for key, value in (("by_user", row[2]), ("by_date", row[0])):
+        rows = index[key].get(value)
+        if rows is not None:
+            rows.discard(row_no)
+            if not rows:
+                del index[key][value]
+    return row
+
+def _index_remove(index, row_no, deleted=True):
+    """
+    行をインデックスから外す
+    deleted: シート上で行が削除された場合 True（それより下の行番号を1つずつ詰める）
+    詰めるのは削除した行より下だけなので、末尾に近い未来の予約のキャンセルは数行分で済む
+    """
+    _index_discard(index, row_no)
+    if not deleted:
+        return
+    for r in range(row_no + 1, index["last_row"] + 1):
+        row = _index_discard(index, r)
+        if row is not None:
+            _index_add(index, r - 1, row)
+    index["last_row"] -= 1
+
+def _build_index():
+    """
+    シート全体を1回読み込んでインデックスを作る
+    """
+    rows = _call_with_reopen(lambda sheet: sheet.get_all_values(), idempotent=True)
+    index = {"rows": {}, "by_user": {}, "by_date": {}, "last_row": len(rows), "built_at": time.monotonic()}
+    for i, row in enumerate(rows):
+        _index_add(index, i + 1, row)
+    return index
+
+def _get_index():
+    global _index
+    if _index is None or time.monotonic() - _index["built_at"] > INDEX_MAX_AGE_SECONDS:
+        _index = _build_index()
+    return _index
+
+def _sync_index(index, row_no=None):
+    """
+    前回以降に追加された末尾の行を読み込む。row_no を指定するとその行も同じリクエストで読む
+    戻り値: row_no の行データ（指定なしなら None）
+    """
+    first_col, last_col = SHEET_COLUMNS.split(":")
+    ranges = [f"{first_col}{index['last_row'] + 1}:{last_col}"]
+    if row_no:
+        ranges.append(f"{first_col}{row_no}:{last_col}{row_no}")
+    results = _call_with_reopen(lambda sheet: sheet.batch_get(ranges), idempotent=True)
+
+    tail = results[0]
+    for i, row in enumerate(tail):
+        _index_add(index, index["last_row"] + 1 + i, row)
+    index["last_row"] += len(tail)
+
+    if row_no:
+        return results[1][0] if results[1] else []
+    return None
+
+def _find_latest_future(index, user_id, today_str, date_str=None, time_str=None):
+    """
+    インデックスから、指定ユーザーの今日以降の予約のうち一番下の行番号を返す
+    date_str / time_str を指定した場合は、その日時の予約だけを対象にする
+    """
+    for row_no in sorted(index["by_user"].get(user_id, ()), reverse=True):
+        row = index["rows"][row_no]
+        if row[0] < today_str:
+            continue
+        if date_str and row[0] != date_str:
+            continue
+        if time_str and (len(row) < 2 or row[1] != time_str):
+            continue
+        return row_no
+    return None
+
+def _updated_row(response):
+    # append のレスポンス（例: "Sheet1!A12:F12"）から追加された行番号を取り出す
+    updated_range = (response or {}).get("updates", {}).get("updatedRange", "")
+    match = re.search(r"![A-Z]+(\d+)", updated_range)
+    return int(match.group(1)) if match else None
+
+def _index_appended(first_row, rows):
+    """
+    シート末尾に追加した行をインデックスに反映する
+    """
+    global _index
+    with _index_lock:
+        if _index is None or first_row is None:
+            return
+        if first_row == _index["last_row"] + 1:
+            for i, row in enumerate(rows):
+                _index_add(_index, first_row + i, row)
+            _index["last_row"] = first_row + len(rows) - 1
+        elif first_row <= _index["last_row"]:
+            # 想定より上に追加された = 他で行が削除されているので作り直す
+            _index = None
+
+# --- 書き込みバッファ ---
+# バッファとジャーナルの更新は _buffer_lock、書き出し処理は _flush_lock で直列化する
+_buffer_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_buffer = []
+_buffer_ready = threading.Event()
+_flusher = None
+
+def _journal_path(pid=None):
+    return os.path.join(SHEET_JOURNAL_DIR, f"sheet_journal.{pid or os.getpid()}.jsonl")
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def _recover_journals():
+    """
+    終了したワーカーが書き出せなかった行をジャーナルから引き継ぐ
+    （書き出し直後に落ちた場合は同じ行が二重に追記されうる: at-least-once）
+    """
+    # 引き継ぎ途中で落ちたワーカーの .recover も拾う（先頭の pid がそのワーカー）
+    pattern = re.compile(r"^sheet_journal\.(\d+)\.jsonl(?:\.\d+\.recover)?$")
+    for file in os.listdir(SHEET_JOURNAL_DIR):
+        match = pattern.match(file)
+        if not match:
+            continue
+        pid = int(match.group(1))
+        if pid != os.getpid() and _pid_alive(pid):
+            continue
+        path = os.path.join(SHEET_JOURNAL_DIR, file)
+        if path == _journal_path() and _buffer:
+            # 自分のジャーナルはバッファと同じ内容
+            continue
+        if path != _journal_path():
+            # 他のワーカーも同時に引き継ごうとするので、先に自分用の名前へ移してから読む
+            # （移せなかった = 他のワーカーが先に引き継いだ）
+            claimed = f"{_journal_path()}.{pid}.recover"
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            path = claimed
+        try:
+            with open(path, encoding="utf-8") as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            continue
+        except (OSError, ValueError) as e:
+            print(f"⚠️ ジャーナル読み込み失敗 ({file}): {e}")
+            continue
+        if path != _journal_path():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if rows:
+            print(f"ℹ️ 未送信の予約 {len(rows)} 件をジャーナルから復元しました ({file})")
+            _buffer.extend(rows)
+    _rewrite_journal()
+
+def _rewrite_journal():
+    # バッファに残っている行だけでジャーナルを置き換える（_buffer_lock 内で呼ぶ）
+    path = _journal_path()
+    if not _buffer:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for row in _buffer:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def _start_flusher():
+    """
+    初回利用時にジャーナルを復元し、バックグラウンドの書き出しスレッドを起動する
+    """
+    global _flusher
+    if _flusher is not None:
+        return
+    with _buffer_lock:
+        if _flusher is not None:
+            return
+        _recover_journals()
+        _flusher = threading.Thread(target=_flush_loop, name="sheet-flusher", daemon=True)
+        _flusher.start()
+        atexit.register(flush)
+
+def _flush_loop():
+    while True:
+        _buffer_ready.wait(SHEET_FLUSH_INTERVAL)
+        _buffer_ready.clear()
+        flush()
+
+def _enqueue_row(row):
+    """
+    行をジャーナルに追記してからバッファに入れる（件数が溜まったら書き出しを起こす）
+    """
+    _start_flusher()
+    with _buffer_lock:
+        with open(_journal_path(), "a", encoding="utf-8") as f:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        _buffer.append(row)
+        if len(_buffer) >= SHEET_FLUSH_SIZE:
+            _buffer_ready.set()
+
+def flush():
+    """
+    バッファに溜まった行を1回の append_rows でシートに書き出す
+    戻り値: 書き出した行数（失敗時は行をバッファに残して次回再試行する）
+    """
+    _start_flusher()
+    with _flush_lock:
+        with _buffer_lock:
+            batch = list(_buffer)
+        if not batch:
+            return 0
+
+        try:
+            response = _call_with_reopen(lambda sheet: sheet.append_rows(batch))
+        except Exception as e:
+            print(f"❌ Google Sheet一括書き込みエラー（{len(batch)}件は次回再送）: {e}")
+            return 0
+
+        with _buffer_lock:
+            del _buffer[:len(batch)]
+            _rewrite_journal()
+        print(f"✅ Google Sheetに{len(batch)}件追加しました")
+        _index_appended(_updated_row(response), batch)
+        return len(batch)
+
+def _discard_buffered(user_id, today_str, date_str=None, time_str=None):
+    """
+    まだ書き出せていない（バッファ・ジャーナルにある）予約行を取り消す
+    書き出しに失敗し続けている間のキャンセルでも、後から予約行が追記されないようにする
+    戻り値: 取り消した行（無ければ None）
+    """
+    # 書き出し中のバッチと取り合わないよう、書き出しのロックも取る（flush は先頭から件数で消すため）
+    with _flush_lock:
+        with _buffer_lock:
+            for i in range(len(_buffer) - 1, -1, -1):
+                row = _buffer[i]
+                if len(row) < 3 or row[2] != user_id or row[0] < today_str:
+                    continue
+                if date_str and row[0] != date_str:
+                    continue
+                if time_str and row[1] != time_str:
+                    continue
+                del _buffer[i]
+                _rewrite_journal()
+                return row
+    return None
+
 def add_reservation_to_sheet(user_id, date_str, time_str, menu, name=None):
     """
     予約情報をGoogleスプレッドシートに追記する
@@ -40,9 +419,9 @@ def add_reservation_to_sheet(user_id, date_str, time_str, menu, name=None):
         return False
 
     try:
-        # シートを開く
+        # シートを開く（キャッシュ済みならAPIを呼ばない）
         try:
-            sheet = client.open(SPREADSHEET_NAME).sheet1
+            get_sheet()
         except gspread.SpreadsheetNotFound:
             print(f"⚠️ スプレッドシート '{SPREADSHEET_NAME}' が見つかりません。Bot（サービスアカウント）に共有されていますか？")
             return False
@@ -52,8 +431,18 @@ def add_reservation_to_sheet(user_id, date_str, time_str, menu, name=None):
         timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         row = [date_str, time_str, user_id, menu, name or "LINE User", timestamp]
         
-        sheet.append_row(row)
+        if SHEET_FLUSH_SIZE > 0:
+            # バッファ経由（ジャーナルに保存した時点で成功とし、書き出しはバックグラウンドで行う）
+            _enqueue_row(row)
+            print(f"✅ Google Sheet書き込み予約: {row}")
+            return True
+
+        response = _call_with_reopen(lambda sheet: sheet.append_row(row))
         print(f"✅ Google Sheetに追加しました: {row}")
+
+        # インデックスが末尾まで読み込み済みなら、追加した行をそのまま反映する
+        # （他プロセスの追加で間が空いた場合は、次回のキャンセル時に末尾の差分として読み込まれる）
+        _index_appended(_updated_row(response), [row])
         return True
 
 
@@ -70,78 +459,177 @@ def get_all_reservations():
     if not client: return []
 
     try:
-        sheet = client.open(SPREADSHEET_NAME).sheet1
+        # バッファ中の予約も含めるため先に書き出す
+        flush()
+
         # 全データを取得（1行目はヘッダーと仮定してスキップしたいが、データのみの場合もあるためそのまま取得して処理側で判断）
-        rows = sheet.get_all_values()
+        rows = _call_with_reopen(lambda sheet: sheet.get_all_values(), idempotent=True)
         
         reservations = []
         for i, row in enumerate(rows):
-            # ヘッダー行っぽい場合（日付などの文字が入っている場合）はスキップする簡易ロジック
-            if len(row) > 0 and row[0] == "日付": continue
-            
-            # データが足りない行はスキップ
-            if len(row) < 3: continue
-
-            # [date, time, user_id, menu, name, timestamp]
-            reservations.append({
-                "row_index": i + 1, # スプレッドシートは1始まり
-                "date": row[0],
-                "time": row[1],
-                "user_id": row[2],
-                "menu": row[3] if len(row) > 3 else "Unknown",
-                "name": row[4] if len(row) > 4 else "Guest"
-            })
+            reservation = _to_reservation(i + 1, row) # スプレッドシートは1始まり
+            if reservation:
+                reservations.append(reservation)
         return reservations
 
     except Exception as e:
         print(f"❌ 予約データ取得エラー: {e}")
         return []
 
-def cancel_reservation(user_id):
+def _to_reservation(row_no, row):
+    """
+    シートの1行を予約データ（辞書）に変換する。予約行でなければ None
+    """
+    # ヘッダー行っぽい場合（日付などの文字が入っている場合）はスキップする簡易ロジック
+    if len(row) > 0 and row[0] == "日付": return None
+
+    # データが足りない行はスキップ
+    if len(row) < 3: return None
+
+    # [date, time, user_id, menu, name, timestamp]
+    return {
+        "row_index": row_no,
+        "date": row[0],
+        "time": row[1],
+        "user_id": row[2],
+        "menu": row[3] if len(row) > 3 else "Unknown",
+        "name": row[4] if len(row) > 4 else "Guest"
+    }
+
+def _row_ranges(row_numbers):
+    """
+    行番号のリストを連続した範囲にまとめる（例: [3, 4, 5, 9] -> [(3, 5), (9, 9)]）
+    """
+    ranges = []
+    for row_no in sorted(row_numbers):
+        if ranges and row_no == ranges[-1][1] + 1:
+            ranges[-1][1] = row_no
+        else:
+            ranges.append([row_no, row_no])
+    return [(a, b) for a, b in ranges]
+
+def iter_reservations(start_date, end_date):
+    """
+    予約日が start_date〜end_date（'YYYY-MM-DD'、両端を含む）の予約だけを順に返すジェネレーター
+    - 行インデックスが読み込み済みなら、末尾の差分だけ読んでインデックスから返す
+    - そうでなければ日付列だけを末尾から SHEET_SCAN_CHUNK 行ずつ読み、該当行だけを取得する
+      （シート全体をメモリに載せず、過去の履歴に入ったところで読むのをやめるので、
+        履歴が増えても読む量は直近の予約の分だけ。返す順は行の順とは限らない）
+    """
+    client = get_client()
+    if not client: return
+
+    # バッファ中の予約も含めるため先に書き出す
+    flush()
+
+    with _index_lock:
+        index = _index
+        if index is not None:
+            _sync_index(index)
+            rows = [(row_no, index["rows"][row_no])
+                    for date, row_numbers in index["by_date"].items() if start_date <= date <= end_date
+                    for row_no in row_numbers]
+    if index is not None:
+        for row_no, row in sorted(rows):
+            reservation = _to_reservation(row_no, row)
+            if reservation:
+                yield reservation
+        return
+
+    first_col, last_col = SHEET_COLUMNS.split(":")
+    oldest = (datetime.datetime.strptime(start_date, '%Y-%m-%d')
+              - datetime.timedelta(days=SHEET_SCAN_LOOKBACK_DAYS)).strftime('%Y-%m-%d')
+    chunk_end = _row_count()
+    while chunk_end >= 1:
+        chunk_start = max(1, chunk_end - SHEET_SCAN_CHUNK + 1)
+        dates = _call_with_reopen(
+            lambda sheet: sheet.get(f"{first_col}{chunk_start}:{first_col}{chunk_end}"), idempotent=True)
+        matched = [chunk_start + i for i, cells in enumerate(dates)
+                   if cells and start_date <= cells[0] <= end_date]
+
+        if matched:
+            ranges = _row_ranges(matched)
+            results = _call_with_reopen(
+                lambda sheet: sheet.batch_get([f"{first_col}{a}:{last_col}{b}" for a, b in ranges]), idempotent=True)
+            for (a, _), values in zip(ranges, results):
+                for i, row in enumerate(values):
+                    reservation = _to_reservation(a + i, row)
+                    if reservation:
+                        yield reservation
+
+        # 予約日の入った行があり、そのどれもが十分古ければ、ここより上は過去の履歴だけとみなす
+        booked = [cells[0] for cells in dates if cells and cells[0][:1].isdigit()]
+        if booked and max(booked) < oldest:
+            return
+        chunk_end = chunk_start - 1
+
+def _row_count():
+    """
+    シートの行数（グリッドの大きさ。データの最終行以上になる）をメタデータから取得する
+    """
+    def fetch(sheet):
+        metadata = sheet.spreadsheet.fetch_sheet_metadata()
+        for item in metadata.get("sheets", []):
+            properties = item.get("properties", {})
+            if properties.get("sheetId") == sheet.id:
+                return properties.get("gridProperties", {}).get("rowCount", 0)
+        return 0
+    return _call_with_reopen(fetch, idempotent=True)
+
+def cancel_reservation(user_id, date_str=None, time_str=None):
     """
-    指定ユーザーの未来の予約を探して削除する
+    指定ユーザーの未来の予約を探して削除する（date_str / time_str で日時を指定できる）
+    行インデックスを使うので、シート全体ではなく末尾の差分と対象行だけを読み込む
     """
     client = get_client()
     if not client: return False
 
+    global _index
     try:
-        sheet = client.open(SPREADSHEET_NAME).sheet1
-        rows = sheet.get_all_values()
-        
         today_str = datetime.datetime.now().strftime('%Y-%m-%d')
-        
-        target_row_index = -1
-        target_date = ""
 
-        # 下から順に探して、一番新しい（未来の）予約を消すのが自然
-        target_reservation = None
+        # 直前に入った予約もキャンセルできるよう、バッファを先に書き出す
+        flush()
+        # 書き出せずにバッファに残っている場合は、シートではなくバッファから取り消す
+        row = _discard_buffered(user_id, today_str, date_str, time_str)
+        if row is not None:
+            print(f"🗑️ 未送信の予約を取り消しました: {row[0]} {row[1]}")
+            return {"date": row[0], "time": row[1], "menu": row[3] if len(row) > 3 else "Unknown"}
 
-        for i in range(len(rows) - 1, -1, -1):
-            row = rows[i]
-            if len(row) < 3: continue
-            
-            r_date = row[0]
-            r_user_id = row[2]
-
-            # ユーザーIDが一致し、かつ日付が今日以降のもの
-            if r_user_id == user_id and r_date >= today_str:
-                target_row_index = i + 1 # 1-based index
-                target_reservation = {
-                    "date": r_date,
-                    "time": row[1],
-                    "menu": row[3] if len(row) > 3 else "Unknown"
-                }
-                break
-        
-        if target_row_index != -1 and target_reservation:
-            sheet.delete_rows(target_row_index)
+        with _index_lock:
+            index = _get_index()
+
+            # 下から順に探して、一番新しい（未来の）予約を消すのが自然
+            candidate = _find_latest_future(index, user_id, today_str, date_str, time_str)
+            fetched = _sync_index(index, candidate)
+            target_row_index = _find_latest_future(index, user_id, today_str, date_str, time_str)
+
+            if target_row_index is not None and target_row_index == candidate \
+                    and _row_key(fetched) != _row_key(index["rows"][candidate]):
+                # 他のプロセスや手作業で行がずれている場合は全件から作り直す
+                print("ℹ️ 予約シートのインデックスを再作成します。")
+                index = _index = _build_index()
+                target_row_index = _find_latest_future(index, user_id, today_str, date_str, time_str)
+
+            if target_row_index is None:
+                print("ℹ️ キャンセル対象の予約が見つかりませんでした。")
+                return None
+
+            row = index["rows"][target_row_index]
+            target_reservation = {
+                "date": row[0],
+                "time": row[1],
+                "menu": row[3] if len(row) > 3 else "Unknown"
+            }
+
+            _call_with_reopen(lambda sheet: sheet.delete_rows(target_row_index))
+            _index_remove(index, target_row_index, deleted=True)
             print(f"🗑️ 予約削除成功: 行{target_row_index} ({target_reservation['date']})")
             return target_reservation
-        else:
-            print("ℹ️ キャンセル対象の予約が見つかりませんでした。")
-            return None
 
     except Exception as e:
         print(f"❌ キャンセル処理エラー: {e}")
+        # インデックスとシートがずれた可能性があるので次回作り直す
+        with _index_lock:
+            _index = None
         return None
-
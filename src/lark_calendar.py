@@ -1,58 +1,364 @@
 import os
+import time
+import threading
 import lark_oapi as lark
 from lark_oapi.api.calendar.v4 import *
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
+import fanout
+import metrics
+import scheduler
 
 # --- CONFIGURATION ---
 LARK_APP_ID = os.getenv('LARK_APP_ID')
 LARK_APP_SECRET = os.getenv('LARK_APP_SECRET')
 CALENDAR_ID = os.getenv('LARK_CALENDAR_ID', 'primary') # Default to user's primary calendar if not set
+# APIのドメイン（ベンチマーク時はローカルのスタブサーバーに向ける）
+LARK_DOMAIN = os.getenv('LARK_DOMAIN', 'https://open.larksuite.com')
+# 日別キャッシュの有効期限（秒）
+CACHE_TTL_SECONDS = int(os.getenv('CALENDAR_CACHE_TTL', '300'))
+# 差分同期（sync_token）の間隔（秒）。0以下なら差分同期しない
+SYNC_INTERVAL_SECONDS = int(os.getenv('CALENDAR_SYNC_INTERVAL', '60'))
 
 # Use explicit URL for Lark (Global)
 client = lark.Client.builder() \
     .app_id(LARK_APP_ID) \
     .app_secret(LARK_APP_SECRET) \
-    .domain("https://open.larksuite.com") \
+    .domain(LARK_DOMAIN) \
     .build()
+metrics.instrument(client.calendar.v4.calendar_event, "lark_calendar", ["list", "create", "delete"])
 
-def get_calendar_events(start_dt, end_dt):
+# 日別の予定キャッシュ
+# { (calendar_id, date): { "fetched_at": monotonic秒, "events": { event_key: event },
+#                          "occupancy": scheduler.DayOccupancy（初回の利用時に作り、以後は差分で更新） } }
+_day_cache = {}
+_cache_lock = threading.Lock()
+# 差分同期するカレンダー（スタッフごとのカレンダーは取得時に追加される）と、その sync_token
+_watched = {CALENDAR_ID}
+_sync_tokens = {}
+_refresher = None
+
+def _to_event(item):
+    """
+    Lark APIのCalendarEventを内部用の辞書に変換する
+    """
+    event = {
+        "event_id": item.event_id,
+        "summary": item.summary,
+        "status": item.status,
+        "start": None,
+        "end": None
+    }
+    # Timestamp to datetime（削除済みの予定は時刻が無いことがある）
+    if item.start_time and item.start_time.timestamp:
+        event["start"] = datetime.fromtimestamp(int(item.start_time.timestamp))
+    if item.end_time and item.end_time.timestamp:
+        event["end"] = datetime.fromtimestamp(int(item.end_time.timestamp))
+    return event
+
+def _list_events(start_dt, end_dt, calendar_id):
+    """
+    指定期間の予定を取得する。API失敗時は None を返す
+    """
+    # Lark API requires timestamp in strings or integers depending on endpoint,
+    # List events usually takes start_time and end_time as unix timestamp string
+
+    # 期間が長い場合に備えてページングしながら全件取得する
+    events = []
+    page_token = None
+    while True:
+        builder = ListCalendarEventRequest.builder() \
+            .calendar_id(calendar_id) \
+            .start_time(str(int(start_dt.timestamp()))) \
+            .end_time(str(int(end_dt.timestamp()))) \
+            .page_size(500)
+        if page_token:
+            builder = builder.page_token(page_token)
+
+        resp = client.calendar.v4.calendar_event.list(builder.build())
+
+        if not resp.success():
+            print(f"Error fetching events: {resp.code}, {resp.msg}")
+            return None
+
+        if resp.data and resp.data.items:
+            for item in resp.data.items:
+                event = _to_event(item)
+                if event["start"] and event["end"] and event["status"] != "cancelled":
+                    events.append(event)
+
+        if not (resp.data and resp.data.has_more and resp.data.page_token):
+            return events
+        page_token = resp.data.page_token
+
+def get_calendar_events(start_dt, end_dt, calendar_id=None):
     """
     Larkカレンダーから指定期間の予定を取得する
     start_dt, end_dt: datetime objects
     """
-    # Lark API requires timestamp in strings or integers depending on endpoint, 
-    # List events usually takes start_time and end_time as unix timestamp string
-    
-    req = ListCalendarEventRequest.builder() \
-        .calendar_id(CALENDAR_ID) \
-        .start_time(str(int(start_dt.timestamp()))) \
-        .end_time(str(int(end_dt.timestamp()))) \
-        .build()
+    return _list_events(start_dt, end_dt, calendar_id or CALENDAR_ID) or []
 
-    resp = client.calendar.v4.calendar_event.list(req)
-    
-    if not resp.success():
-        print(f"Error fetching events: {resp.code}, {resp.msg}")
-        return []
+def _event_key(event):
+    return event.get("event_id") or (event["start"], event["end"], event.get("summary"))
 
-    events = []
-    if resp.data and resp.data.items:
-        for item in resp.data.items:
-            # Timestamp to datetime
-            start_ts = int(item.start_time.timestamp)
-            end_ts = int(item.end_time.timestamp)
-            events.append({
-                "start": datetime.fromtimestamp(start_ts),
-                "end": datetime.fromtimestamp(end_ts),
-                "summary": item.summary
-            })
-            
+def _event_dates(event):
+    """
+    予定が掛かっている日付を列挙する（終了が0:00ちょうどの場合は前日まで）
+    """
+    current = event["start"].date()
+    last = max(current, (event["end"] - timedelta(microseconds=1)).date())
+    while current <= last:
+        yield current
+        current += timedelta(days=1)
+
+def _cache_add(calendar_id, event):
+    # キャッシュ済みの日だけ更新する（未取得の日は次回の取得時に含まれる）
+    with _cache_lock:
+        for d in _event_dates(event):
+            entry = _day_cache.get((calendar_id, d))
+            if entry is not None:
+                key = _event_key(event)
+                previous = entry["events"].get(key)
+                entry["events"][key] = event
+                occupancy = entry.get("occupancy")
+                if occupancy is not None:
+                    if previous is not None:
+                        occupancy.remove(previous)
+                    occupancy.add(event)
+
+def _cache_remove(calendar_id, event_id):
+    with _cache_lock:
+        for (cid, _), entry in _day_cache.items():
+            if cid == calendar_id:
+                removed = entry["events"].pop(event_id, None)
+                if removed is not None and entry.get("occupancy") is not None:
+                    entry["occupancy"].remove(removed)
+
+def get_day_events(target_date, calendar_id=None):
+    """
+    指定日の予定をキャッシュ経由で取得する
+    キャッシュが有効期限内ならAPIを呼ばずにメモリから返す
+    """
+    return _load_day(target_date, calendar_id or CALENDAR_ID) or []
+
+def _load_day(target_date, calendar_id):
+    """
+    get_day_events の本体。取得に失敗し、古いデータも無い場合は None
+    """
+    key = (calendar_id, target_date)
+    _start_refresher()
+
+    with _cache_lock:
+        entry = _day_cache.get(key)
+        if entry is not None and time.monotonic() - entry["fetched_at"] < CACHE_TTL_SECONDS:
+            return list(entry["events"].values())
+
+    start_dt = datetime.combine(target_date, datetime.min.time())
+    events = _list_events(start_dt, start_dt + timedelta(days=1), calendar_id)
+    if events is None:
+        # 取得失敗時はキャッシュせず、古いデータがあればそれを使う
+        with _cache_lock:
+            entry = _day_cache.get(key)
+            return list(entry["events"].values()) if entry else None
+
+    with _cache_lock:
+        _day_cache[key] = {
+            "fetched_at": time.monotonic(),
+            "events": {_event_key(e): e for e in events}
+        }
+    return events
+
+def get_day_occupancy(target_date, calendar_id=None, fetch=True, exclude=()):
+    """
+    指定日の枠の埋まり具合（scheduler.DayOccupancy）を日別キャッシュから返す
+    一度作った後は予定の追加・削除・差分同期のたびに差分で更新する。呼び出し側で重ね書きできるよう複製を返す
+    fetch: False ならAPIを呼ばず、キャッシュに無い日は空として扱う（get_range_events で読み込み済みの場合）
+    exclude: 除いて数える予定ID（ローカルでキャンセル済みでまだ削除が同期されていない予定など）
+    """
+    calendar_id = calendar_id or CALENDAR_ID
+    events = get_day_events(target_date, calendar_id) if fetch else []
+    with _cache_lock:
+        entry = _day_cache.get((calendar_id, target_date))
+        if entry is None:
+            return scheduler.DayOccupancy(target_date, [e for e in events if e.get("event_id") not in exclude])
+        if entry.get("occupancy") is None:
+            entry["occupancy"] = scheduler.DayOccupancy(target_date, entry["events"].values())
+        occupancy = entry["occupancy"].copy()
+        for event_id in exclude:
+            if event_id in entry["events"]:
+                occupancy.remove(entry["events"][event_id])
+        return occupancy
+
+def get_range_events(start_date, days, calendar_id=None):
+    """
+    start_date から days 日間の予定をまとめて取得する
+    全日キャッシュ済みならメモリから返し、そうでなければ1回の（ページング付き）一覧取得で
+    期間全体を取り、日別キャッシュにも格納する
+    """
+    return _load_range(start_date, days, calendar_id or CALENDAR_ID) or []
+
+def _load_range(start_date, days, calendar_id):
+    """
+    get_range_events の本体。取得に失敗した場合は None
+    """
+    dates = [start_date + timedelta(days=i) for i in range(days)]
+    _start_refresher()
+
+    now = time.monotonic()
+    with _cache_lock:
+        entries = [_day_cache.get((calendar_id, d)) for d in dates]
+        if all(e is not None and now - e["fetched_at"] < CACHE_TTL_SECONDS for e in entries):
+            merged = {}
+            for entry in entries:
+                merged.update(entry["events"])
+            return list(merged.values())
+
+    start_dt = datetime.combine(start_date, datetime.min.time())
+    events = _list_events(start_dt, start_dt + timedelta(days=days), calendar_id)
+    if events is None:
+        return None
+
+    by_date = {d: {} for d in dates}
+    for event in events:
+        for d in _event_dates(event):
+            if d in by_date:
+                by_date[d][_event_key(event)] = event
+    fetched_at = time.monotonic()
+    with _cache_lock:
+        for d, day_events in by_date.items():
+            _day_cache[(calendar_id, d)] = {"fetched_at": fetched_at, "events": day_events}
     return events
 
-def create_calendar_event(summary, start_dt, end_dt, description=""):
+def _fetch_many(fetch, calendar_ids):
+    """
+    カレンダーごとに fetch を呼び、{ calendar_id: 予定リスト } を返す
+    取得に失敗・タイムアウトしたカレンダーは None にする（空のリストにすると、実際の予定に重ねて予約を受けてしまう）
+    """
+    calendar_ids = list(dict.fromkeys(cid or CALENDAR_ID for cid in calendar_ids))
+    with _cache_lock:
+        _watched.update(calendar_ids)
+    if len(calendar_ids) == 1:
+        return {calendar_ids[0]: fetch(calendar_ids[0])}
+    # キャッシュに無いカレンダーがあっても、取得は同時に行うので待ち時間は最も遅い1件分で済む
+    result = fanout.run_concurrently({cid: (lambda cid=cid: fetch(cid)) for cid in calendar_ids})
+    return {
+        cid: result.outcomes[cid]["value"] if result.outcomes[cid]["status"] == "ok" else None
+        for cid in calendar_ids
+    }
+
+def get_day_events_multi(target_date, calendar_ids):
+    """
+    複数のカレンダー（スタッフ・席ごと）の指定日の予定をまとめて取得する
+    戻り値: { calendar_id: [予定, ...] }（取得できなかったカレンダーは None）
+    """
+    return _fetch_many(lambda cid: _load_day(target_date, cid), calendar_ids)
+
+def get_range_events_multi(start_date, days, calendar_ids):
+    """
+    get_range_events の複数カレンダー版
+    戻り値: { calendar_id: [予定, ...] }（取得できなかったカレンダーは None）
+    """
+    return _fetch_many(lambda cid: _load_range(start_date, days, cid), calendar_ids)
+
+def invalidate_all(calendar_id=None):
+    with _cache_lock:
+        if calendar_id is None:
+            _day_cache.clear()
+            return
+        for key in [key for key in _day_cache if key[0] == calendar_id]:
+            del _day_cache[key]
+
+def sync_calendar_events(sync_token=None, calendar_id=None):
+    """
+    差分同期: 前回の sync_token 以降に追加・変更・削除された予定を取得する
+    sync_token が無い場合は現在時刻以降を起点に新しい sync_token を取得する
+    戻り値: (変更された予定のリスト, 次回用の sync_token)。失敗時は (None, None)
+    """
+    calendar_id = calendar_id or CALENDAR_ID
+    changed = []
+    page_token = None
+
+    while True:
+        builder = ListCalendarEventRequest.builder() \
+            .calendar_id(calendar_id) \
+            .page_size(500)
+        if page_token:
+            builder = builder.page_token(page_token)
+        elif sync_token:
+            builder = builder.sync_token(sync_token)
+        else:
+            builder = builder.anchor_time(str(int(time.time())))
+
+        resp = client.calendar.v4.calendar_event.list(builder.build())
+        if not resp.success():
+            print(f"Error syncing events: {resp.code}, {resp.msg}")
+            return None, None
+
+        if resp.data and resp.data.items:
+            changed.extend(_to_event(item) for item in resp.data.items)
+
+        if not (resp.data and resp.data.has_more):
+            return changed, resp.data.sync_token if resp.data else None
+        page_token = resp.data.page_token
+
+def _apply_changes(calendar_id, changed):
+    for event in changed:
+        if event["event_id"]:
+            # 日時が変更された可能性があるので一旦すべての日から外す
+            _cache_remove(calendar_id, event["event_id"])
+        if event["status"] != "cancelled" and event["start"] and event["end"]:
+            _cache_add(calendar_id, event)
+
+def _evict_past():
+    """
+    今日より前の日のキャッシュを捨てる（予約で参照されることはない）
+    """
+    today = datetime.now().date()
+    with _cache_lock:
+        for key in [key for key in _day_cache if key[1] < today]:
+            del _day_cache[key]
+
+def _refresh_loop():
+    while True:
+        _evict_past()
+        with _cache_lock:
+            calendar_ids = list(_watched)
+        for calendar_id in calendar_ids:
+            sync_token = _sync_tokens.get(calendar_id)
+            try:
+                changed, token = sync_calendar_events(sync_token, calendar_id)
+            except Exception as e:
+                # 通信・認証エラーで例外になっても同期スレッドは止めない（次回は sync_token を取り直す）
+                print(f"❌ カレンダー差分同期エラー ({calendar_id}): {e}")
+                changed, token = None, None
+            if token is None:
+                # トークン失効などで差分が取れない場合はキャッシュを破棄して取り直す
+                _sync_tokens.pop(calendar_id, None)
+                invalidate_all(calendar_id)
+            else:
+                if sync_token is not None:
+                    _apply_changes(calendar_id, changed)
+                _sync_tokens[calendar_id] = token
+        time.sleep(SYNC_INTERVAL_SECONDS)
+
+def _start_refresher():
+    """
+    差分同期スレッドを起動する（初回のキャッシュ利用時に一度だけ）
+    """
+    global _refresher
+    if _refresher is not None or SYNC_INTERVAL_SECONDS <= 0:
+        return
+    with _cache_lock:
+        if _refresher is not None:
+            return
+        _refresher = threading.Thread(target=_refresh_loop, name="calendar-sync", daemon=True)
+        _refresher.start()
+
+def create_calendar_event(summary, start_dt, end_dt, description="", calendar_id=None):
     """
     Larkカレンダーに予約を登録する
+    戻り値: 成功時は作成した予定のID（IDが返らなかった場合は True）、失敗時は False
     """
+    calendar_id = calendar_id or CALENDAR_ID
     event_info = CalendarEvent.builder() \
         .summary(summary) \
         .start_time(TimeInfo.builder().timestamp(str(int(start_dt.timestamp()))).build()) \
@@ -61,16 +367,43 @@ def create_calendar_event(summary, start_dt, end_dt, description=""):
         .build()
 
     req = CreateCalendarEventRequest.builder() \
-        .calendar_id(CALENDAR_ID) \
+        .calendar_id(calendar_id) \
         .request_body(event_info) \
         .build()
 
     resp = client.calendar.v4.calendar_event.create(req)
-    
+
     if resp.success():
         print(f"✅ Created Lark Calendar event: {summary} at {start_dt}")
-        return True
+        event_id = resp.data.event.event_id if resp.data and resp.data.event else None
+        _cache_add(calendar_id, {
+            "event_id": event_id,
+            "summary": summary,
+            "status": "confirmed",
+            "start": start_dt,
+            "end": end_dt
+        })
+        return event_id or True
     else:
         print(f"❌ Failed to create event: {resp.code}, {resp.msg}, {resp.error}")
         return False
-    return True
+
+def delete_calendar_event(event_id, calendar_id=None):
+    """
+    Larkカレンダーの予定を削除する（キャンセル用）
+    """
+    calendar_id = calendar_id or CALENDAR_ID
+    req = DeleteCalendarEventRequest.builder() \
+        .calendar_id(calendar_id) \
+        .event_id(event_id) \
+        .build()
+
+    resp = client.calendar.v4.calendar_event.delete(req)
+
+    if resp.success():
+        print(f"🗑️ Deleted Lark Calendar event: {event_id}")
+        _cache_remove(calendar_id, event_id)
+        return True
+    else:
+        print(f"❌ Failed to delete event: {resp.code}, {resp.msg}, {resp.error}")
+        return False
@@ -1,7 +1,12 @@
 import os
+import time
+import uuid
+import atexit
+import threading
 import lark_oapi as lark
 from lark_oapi.api.bitable.v1 import *
 from dotenv import load_dotenv
+import metrics
 
 # Load env used by this module
 load_dotenv()
@@ -9,17 +14,42 @@ load_dotenv()
 # Configuration
 LARK_APP_ID = os.getenv('LARK_APP_ID')
 LARK_APP_SECRET = os.getenv('LARK_APP_SECRET')
+# APIのドメイン（ベンチマーク時はローカルのスタブサーバーに向ける）
+LARK_DOMAIN = os.getenv('LARK_DOMAIN', 'https://open.larksuite.com')
 # 顧客管理データベースのID（URLの /base/ の後ろの部分）
 LARK_BASE_APP_TOKEN = os.getenv('LARK_BASE_APP_TOKEN')
 # テーブルID（URLの table= の後ろの部分。通常は自動取得も可能だが指定推奨）
 LARK_BASE_TABLE_ID = os.getenv('LARK_BASE_TABLE_ID')
+# 売上管理テーブル・在庫変動ログテーブルのID
+TABLE_SALES = os.getenv('TABLE_SALES')
+TABLE_INVENTORY_LOGS = os.getenv('TABLE_INVENTORY_LOGS')
+
+# まとめ書き込みの設定
+# 書き込みを溜めてから送信するまでの秒数
+LARK_BATCH_WINDOW = float(os.getenv('LARK_BATCH_WINDOW', '2'))
+# batch_create / batch_update 1回あたりの最大件数（APIの上限）
+LARK_BATCH_MAX_RECORDS = 500
+# 一時的なエラー（レート制限・書き込み競合・タイムアウト）として同じ内容で再送するコード
+LARK_RETRY_CODES = (1254290, 1254291, 1254607, 1255040)
+LARK_MAX_RETRIES = 3
+# 特定のレコードの内容が原因のエラー（リクエストを分割すれば原因のレコードだけを外せる）
+# 認証・権限・テーブル未検出などはどう分割しても直らないので分割しない
+LARK_RECORD_ERROR_CODES = (
+    1254001,  # WrongRequestBody
+    1254002,  # Fail（列名の不一致など）
+    1254006,  # WrongRecordId
+    1254045,  # FieldNameNotFound
+    1254060, 1254061, 1254062, 1254063, 1254064, 1254065, 1254066, 1254067,  # 列の型変換エラー
+)
 
 # Client setup
 client = lark.Client.builder() \
     .app_id(LARK_APP_ID) \
     .app_secret(LARK_APP_SECRET) \
-    .domain("https://open.larksuite.com") \
+    .domain(LARK_DOMAIN) \
     .build()
+metrics.instrument(client.bitable.v1.app_table_record, "lark_crm", ["batch_create", "batch_update", "list"])
+metrics.instrument(client.bitable.v1.app_table, "lark_crm", ["list"])
 
 def get_table_id():
     """
@@ -46,6 +76,267 @@ def get_table_id():
         print(f"❌ Failed to fetch tables: {resp.code}, {resp.msg}")
         return None
 
+def _request(kind, app_token, table_id, records, client_token=None):
+    """
+    batch_create / batch_update を1回呼ぶ（通信エラーは例外のまま返す）
+    """
+    if kind == "create":
+        req = BatchCreateAppTableRecordRequest.builder() \
+            .app_token(app_token) \
+            .table_id(table_id) \
+            .client_token(client_token or str(uuid.uuid4())) \
+            .request_body(BatchCreateAppTableRecordRequestBody.builder() \
+                .records(records) \
+                .build()) \
+            .build()
+        return client.bitable.v1.app_table_record.batch_create(req)
+    req = BatchUpdateAppTableRecordRequest.builder() \
+        .app_token(app_token) \
+        .table_id(table_id) \
+        .request_body(BatchUpdateAppTableRecordRequestBody.builder() \
+            .records(records) \
+            .build()) \
+        .build()
+    return client.bitable.v1.app_table_record.batch_update(req)
+
+def _split_send(send, records):
+    """
+    send(records) で送り、レコードの内容が原因のエラー（LARK_RECORD_ERROR_CODES）なら半分に分けて送り直す
+    （どのレコードが原因か分からないので二分探索で絞り込む。成功した側は送り直さない）
+    send の戻り値: Larkのレスポンス（届いたか分からない場合は None）
+    戻り値: [(レコード, レスポンス), ...] 分けたまとまりごとの最終結果
+    """
+    resp = send(records)
+    if resp is None or resp.success() or len(records) == 1 or resp.code not in LARK_RECORD_ERROR_CODES:
+        return [(records, resp)]
+    half = len(records) // 2
+    return _split_send(send, records[:half]) + _split_send(send, records[half:])
+
+class BitableBatchWriter:
+    """
+    Bitableへのレコード追加・更新をテーブルごとに溜めて、batch_create / batch_update でまとめて送る
+    - LARK_BATCH_WINDOW 秒ごと（または500件溜まった時点）に送信
+    - 同じレコードへの更新は送信前に1件にまとめる
+    - 失敗したリクエストは一時的なエラーなら再送し、レコードの内容が原因なら分割して失敗したレコードだけを特定する
+    - 再送に回した追加は client_token ごと1つのまとまりとして持ち続ける
+      （タイムアウトしたが実際には届いていたリクエストを再送しても二重登録にならない）
+    """
+
+    def __init__(self, window=LARK_BATCH_WINDOW):
+        self.window = window
+        self._creates = {}  # { (app_token, table_id): [fields, ...] }
+        self._updates = {}  # { (app_token, table_id): { record_id: fields } }
+        self._retries = []  # [(app_token, table_id, [fields, ...], client_token), ...]
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        self.stats = {"created": 0, "updated": 0, "failed": 0, "api_calls": 0}
+
+    def add(self, app_token, table_id, fields):
+        """
+        レコード追加を予約する
+        """
+        self._start()
+        with self._lock:
+            records = self._creates.setdefault((app_token, table_id), [])
+            records.append(fields)
+            if len(records) >= LARK_BATCH_MAX_RECORDS:
+                self._ready.set()
+
+    def update(self, app_token, table_id, record_id, fields):
+        """
+        レコード更新を予約する（送信前の同じレコードへの更新は1件にまとめる）
+        """
+        self._start()
+        with self._lock:
+            records = self._updates.setdefault((app_token, table_id), {})
+            records.setdefault(record_id, {}).update(fields)
+            if len(records) >= LARK_BATCH_MAX_RECORDS:
+                self._ready.set()
+
+    def flush(self):
+        """
+        溜まっている書き込みをすべて送信する
+        """
+        with self._flush_lock:
+            with self._lock:
+                creates, self._creates = self._creates, {}
+                updates, self._updates = self._updates, {}
+                retries, self._retries = self._retries, []
+
+            # 前回送れなかった追加は、前回と同じ内容・同じ client_token で送り直す
+            for app_token, table_id, fields, client_token in retries:
+                chunk = [AppTableRecord.builder().fields(f).build() for f in fields]
+                self._count("created", self._send("create", app_token, table_id, chunk, client_token))
+
+            for (app_token, table_id), records in creates.items():
+                for i in range(0, len(records), LARK_BATCH_MAX_RECORDS):
+                    chunk = [AppTableRecord.builder().fields(f).build() for f in records[i:i + LARK_BATCH_MAX_RECORDS]]
+                    self._count("created", self._send("create", app_token, table_id, chunk))
+
+            for (app_token, table_id), records in updates.items():
+                items = list(records.items())
+                for i in range(0, len(items), LARK_BATCH_MAX_RECORDS):
+                    chunk = [AppTableRecord.builder().record_id(rid).fields(f).build()
+                             for rid, f in items[i:i + LARK_BATCH_MAX_RECORDS]]
+                    self._count("updated", self._send("update", app_token, table_id, chunk))
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def _count(self, key, n=1):
+        # stats は送信スレッドと呼び出し元の両方から更新されるのでロックを取る
+        with self._lock:
+            self.stats[key] += n
+
+    def _send(self, kind, app_token, table_id, records, client_token=None):
+        """
+        1回分のリクエストを送る。戻り値: 書き込めたレコード数
+        client_token: 再送時は前回と同じ値を渡す（同じ内容には同じ client_token を使い、二重登録を防ぐ）
+        """
+        def send(chunk):
+            # 分けて送り直す分は内容が変わるので新しい client_token にする
+            return self._attempt(kind, app_token, table_id, chunk, client_token if chunk is records else None)
+
+        written = 0
+        for chunk, resp in _split_send(send, records):
+            if resp is None:
+                # 次回の送信に回した
+                continue
+            if resp.success():
+                written += len(chunk)
+                continue
+            print(f"❌ CRM書き込み失敗 ({kind}, {len(chunk)}件): {resp.code}, {resp.msg}, {chunk[0].fields}")
+            if resp.code == 1254002: # Field not found
+                print("   (Baseの列名が一致していない可能性があります)")
+            self._count("failed", len(chunk))
+        return written
+
+    def _attempt(self, kind, app_token, table_id, records, client_token=None):
+        """
+        リクエストを送り、一時的なエラーなら同じ内容・同じ client_token で再送する
+        戻り値: Larkのレスポンス。一時的なエラーが続いた場合は次回の送信に回して None
+        """
+        client_token = client_token or str(uuid.uuid4())
+        for attempt in range(LARK_MAX_RETRIES + 1):
+            self._count("api_calls")
+            try:
+                resp = _request(kind, app_token, table_id, records, client_token)
+            except Exception as e:
+                # 通信エラー（タイムアウトなど）は届いたかどうか分からないので、一時的なエラーと同じ扱い
+                resp, error = None, f"{e}"
+            else:
+                error = f"{resp.code}, {resp.msg}"
+
+            if resp is not None and (resp.success() or resp.code not in LARK_RETRY_CODES):
+                return resp
+            if attempt == LARK_MAX_RETRIES:
+                # 一時的なエラーが続く場合は次回の送信に回す
+                print(f"⚠️ CRM書き込みを次回に再送します ({kind}, {len(records)}件): {error}")
+                self._requeue(kind, app_token, table_id, records, client_token)
+                return None
+            time.sleep(2 ** attempt)
+
+    def _requeue(self, kind, app_token, table_id, records, client_token):
+        with self._lock:
+            if kind == "create":
+                self._retries.append((app_token, table_id, [r.fields for r in records], client_token))
+            else:
+                pending = self._updates.setdefault((app_token, table_id), {})
+                for r in records:
+                    # 再送待ちの間に入った新しい更新を優先する
+                    pending[r.record_id] = {**r.fields, **pending.get(r.record_id, {})}
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._loop, name="bitable-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _loop(self):
+        while True:
+            self._ready.wait(self.window)
+            self._ready.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"❌ CRM一括書き込みエラー: {e}")
+
+
+# プロセス共通のまとめ書き込み
+writer = BitableBatchWriter()
+
+def create_records(table_id, fields_list, client_token=None):
+    """
+    レコードをまとめて追加し、Larkが書き込みを確認するまで待つ（バッファを通さない）
+    送信キュー（reservation_sync）から使う。失敗した分は呼び出し側で再試行する
+    内容が原因のエラーは分割して送り直し、原因のレコードだけを失敗にする
+    client_token: 再試行時は前回と同じ値を渡す（届いていたリクエストを二重に登録しない）
+    戻り値: fields_list と同じ並びの結果のリスト
+            成功: (True, record_id)、失敗: (False, エラーメッセージ)
+    """
+    results = [None] * len(fields_list)
+    errors = {}
+
+    def send(indexes):
+        records = [AppTableRecord.builder().fields(fields_list[i]).build() for i in indexes]
+        try:
+            return _request("create", LARK_BASE_APP_TOKEN, table_id, records,
+                            client_token if len(indexes) == len(fields_list) else None)
+        except Exception as e:
+            errors[indexes[0]] = f"{e}"
+            return None
+
+    for indexes, resp in _split_send(send, list(range(len(fields_list)))):
+        if resp is not None and resp.success():
+            created = (resp.data.records or []) if resp.data else []
+            for k, i in enumerate(indexes):
+                results[i] = (True, created[k].record_id if k < len(created) else None)
+            continue
+        error = errors.get(indexes[0]) if resp is None else f"{resp.code}, {resp.msg}"
+        print(f"❌ CRM書き込み失敗 ({len(indexes)}件): {error}")
+        if resp is not None and resp.code == 1254002: # Field not found
+            print("   (Baseの列名が一致していない可能性があります)")
+        for i in indexes:
+            results[i] = (False, error)
+    return results
+
+def update_records(table_id, updates):
+    """
+    レコードをまとめて更新し、Larkが書き込みを確認するまで待つ（バッファを通さない）
+    updates: [(record_id, fields), ...]
+    戻り値: 成功なら True
+    """
+    records = [AppTableRecord.builder().record_id(rid).fields(f).build() for rid, f in updates]
+    resp = _request("update", LARK_BASE_APP_TOKEN, table_id, records)
+    if not resp.success():
+        print(f"❌ CRM更新失敗 ({len(records)}件): {resp.code}, {resp.msg}")
+        return False
+    return True
+
+def reservation_fields(line_user_id, reservation_date, reservation_time, menu="カット"):
+    return {
+        "LINE UserID": line_user_id,
+        "予約日": reservation_date,      # YYYY-MM-DD
+        "予約時間": reservation_time,    # HH:MM
+        "メニュー": menu,
+        "ステータス": "予約中"
+    }
+
+def sales_fields(line_user_id, amount, menu="その他", recorded_at=None):
+    return {
+        "日時": recorded_at or int(time.time() * 1000), # DateTime列はミリ秒
+        "メニュー区分": menu,
+        "売上金額": float(amount),
+        "登録者LINE ID": line_user_id
+    }
+
 def add_reservation_record(line_user_id, reservation_date, reservation_time, menu="カット"):
     """
     予約が入った際に、顧客管理テーブル（または来店履歴テーブル）にレコードを追加する
@@ -57,32 +348,38 @@ def add_reservation_record(line_user_id, reservation_date, reservation_time, men
         return False
 
     # 登録するデータ
-    fields = {
-        "LINE UserID": line_user_id,
-        "予約日": reservation_date,      # YYYY-MM-DD
-        "予約時間": reservation_time,    # HH:MM
-        "メニュー": menu,
-        "ステータス": "予約中"
-    }
+    fields = reservation_fields(line_user_id, reservation_date, reservation_time, menu)
 
-    # Bitable APIを使ってレコード作成
-    # https://open.larksuite.com/document/server-docs/docs/bitable-v1/app-table-record/create
-    req = CreateAppTableRecordRequest.builder() \
-        .app_token(LARK_BASE_APP_TOKEN) \
-        .table_id(table_id) \
-        .request_body(AppTableRecord.builder() \
-            .fields(fields) \
-            .build()) \
-        .build()
+    # Bitable APIを使ってレコード作成（batch_createでまとめて送信）
+    # https://open.larksuite.com/document/server-docs/docs/bitable-v1/app-table-record/batch_create
+    writer.add(LARK_BASE_APP_TOKEN, table_id, fields)
+    print(f"✅ CRM保存予約: {line_user_id} - {reservation_date} {reservation_time}")
+    return True
 
-    resp = client.bitable.v1.app_table_record.create(req)
+def add_sales_record(line_user_id, amount, menu="その他", recorded_at=None):
+    """
+    売上管理テーブル（Sales）に売上を追加する
+    recorded_at: 売上の日時（ミリ秒）。省略時は現在時刻
+    """
+    if not LARK_BASE_APP_TOKEN or not TABLE_SALES:
+        print("⚠️ Lark Baseの設定（APP_TOKEN, TABLE_SALES）が足りていません。売上保存をスキップします。")
+        return False
 
-    if resp.success():
-        print(f"✅ CRM保存成功: {line_user_id} - {reservation_date} {reservation_time}")
-        return True
-    else:
-        print(f"❌ CRM保存失敗: {resp.code}, {resp.msg}, {resp.error}")
-        # フィールド名が間違っている可能性が高いのでヒントを表示
-        if resp.code == 1254002: # Field not found
-            print("   (Baseの列名が一致していない可能性があります。「LINE UserID」「予約日」「予約時間」「メニュー」「ステータス」の列があるか確認してください)")
+    writer.add(LARK_BASE_APP_TOKEN, TABLE_SALES, sales_fields(line_user_id, amount, menu, recorded_at))
+    return True
+
+def add_inventory_log(item_name, quantity, line_user_id=None):
+    """
+    在庫変動ログ（InventoryLogs）に使用記録を追加する（使用はマイナス）
+    """
+    if not LARK_BASE_APP_TOKEN or not TABLE_INVENTORY_LOGS:
+        print("⚠️ Lark Baseの設定（APP_TOKEN, TABLE_INVENTORY_LOGS）が足りていません。在庫ログ保存をスキップします。")
         return False
+
+    writer.add(LARK_BASE_APP_TOKEN, TABLE_INVENTORY_LOGS, {
+        "日時": int(time.time() * 1000),
+        "商品名": item_name,
+        "変動数": -int(quantity),
+        "登録者LINE ID": line_user_id or ""
+    })
+    return True
@@ -0,0 +1,81 @@
+import os
+import atexit
+import threading
+from dotenv import load_dotenv
+import metrics
+
+from linebot.v3.messaging import (
+    Configuration,
+    ApiClient,
+    MessagingApi
+)
+
+load_dotenv()
+
+# --- CONFIGURATION ---
+CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
+# LINE APIホストに対して保持するkeep-alive接続数（同時送信数の上限にもなる）
+LINE_POOL_SIZE = int(os.getenv('LINE_POOL_SIZE', '10'))
+# APIのホスト（未設定ならSDKの既定値。ベンチマーク時はローカルのスタブサーバーに向ける）
+LINE_API_HOST = os.getenv('LINE_API_HOST')
+
+# プロセス共通のクライアント（gunicornのfork後、初回利用時に作成する）
+_lock = threading.Lock()
+_api_client = None
+_messaging_api = None
+
+def get_messaging_api():
+    """
+    プロセス共通の MessagingApi を返す
+    接続プールを使い回すので、イベントごとのTLSハンドシェイクが不要になる（スレッドセーフ）
+    """
+    global _api_client, _messaging_api
+    if _messaging_api is None:
+        with _lock:
+            if _messaging_api is None:
+                configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN, host=LINE_API_HOST)
+                configuration.connection_pool_maxsize = LINE_POOL_SIZE
+                _api_client = ApiClient(configuration)
+                _messaging_api = metrics.instrument(
+                    MessagingApi(_api_client), "line", ["reply_message", "push_message", "multicast"]
+                )
+    return _messaging_api
+
+def _connection_pools():
+    if _api_client is None:
+        return []
+    pools = _api_client.rest_client.pool_manager.pools
+    return [pools.get(key) for key in pools.keys()]
+
+def get_stats():
+    """
+    接続の再利用状況を返す
+    connections_opened: 新規に張った接続数 / connections_reused: 既存接続を使い回したリクエスト数
+    """
+    opened = 0
+    requests = 0
+    for pool in _connection_pools():
+        if pool is None:
+            continue
+        opened += pool.num_connections
+        requests += pool.num_requests
+    return {
+        "pool_size": LINE_POOL_SIZE,
+        "requests": requests,
+        "connections_opened": opened,
+        "connections_reused": max(0, requests - opened)
+    }
+
+def shutdown():
+    """
+    接続プールを閉じる（ワーカー終了時に呼ばれる）
+    """
+    global _api_client, _messaging_api
+    with _lock:
+        if _api_client is not None:
+            _api_client.rest_client.pool_manager.clear()
+            _api_client.close()
+        _api_client = None
+        _messaging_api = None
+
+atexit.register(shutdown)
@@ -17,6 +17,9 @@ from lark_oapi.api.bitable.v1 import *
 import scheduler
 import lark_calendar
 import google_sheets  # Added
+from lark_crm import add_inventory_log  # Bitableへはまとめて書き込む
+import reservation_store
+import reservation_sync
 
 # Load environment variables
 from dotenv import load_dotenv
@@ -55,7 +58,10 @@ def handle_message(event):
             parts = text.split()
             amount = parts[1]
             menu = parts[2] if len(parts) > 2 else "その他"
-            add_sales_record(event.source.user_id, amount, menu)
+            # 売上はローカルに記録し、Lark Baseへは reservation_sync が反映する
+            reservation_store.get_store().record_sale(event.source.user_id, amount, menu)
+            reservation_sync.start()
+            reservation_sync.wake()
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"✅ 売上登録完了\n金額: ¥{amount}\nメニュー: {menu}"))
         except:
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ フォーマットエラー"))
@@ -65,6 +71,7 @@ def handle_message(event):
             parts = text.split()
             item_name = parts[1]
             qty = int(parts[2]) if len(parts) > 2 else 1
+            add_inventory_log(item_name, qty, event.source.user_id)
             is_low, alert = update_inventory(item_name, qty)
             msgs = [TextSendMessage(text=f"✅ 在庫更新完了: {item_name} -{qty}")]
             if is_low: msgs.append(TextSendMessage(text=alert))
@@ -0,0 +1,119 @@
+import os
+import re
+import json
+import math
+import time
+import threading
+import unicodedata
+
+import scheduler
+
+# --- CONFIGURATION ---
+# メニュー定義ファイル（所要時間・料金・担当できる役職・別名）
+MENU_CATALOG_PATH = os.getenv(
+    'MENU_CATALOG_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'menu_catalog.json')
+)
+# ファイルの更新を確認する間隔（秒）。更新されていれば再起動なしで読み直す
+MENU_RELOAD_INTERVAL = float(os.getenv('MENU_RELOAD_INTERVAL', '5'))
+
+
+def normalize(text):
+    """
+    照合用に表記ゆれをそろえる（全角英数・半角カナ・大文字小文字・空白）
+    """
+    return re.sub(r"\s+", "", unicodedata.normalize("NFKC", text or "")).lower()
+
+
+class MenuCatalog:
+    """
+    読み込み済みのメニュー一覧
+    - by_name: 正規化したメニュー名・別名 → メニュー（完全一致はこの辞書1回で引く）
+    - pattern: 名前・別名を長い順に並べた1本の正規表現（「カラー(リタッチ)」のような入力の部分一致用）
+    """
+
+    def __init__(self, menus, version):
+        self.menus = menus
+        self.version = version
+        self.by_name = {}
+        for menu in menus:
+            for name in [menu["name"]] + menu["aliases"]:
+                self.by_name.setdefault(normalize(name), menu)
+        names = sorted(self.by_name, key=len, reverse=True)
+        self.pattern = re.compile("|".join(re.escape(n) for n in names)) if names else None
+        self.default = next((m for m in menus if m.get("default")), menus[0] if menus else None)
+
+    def lookup(self, text):
+        key = normalize(text)
+        menu = self.by_name.get(key)
+        if menu is None and self.pattern is not None:
+            match = self.pattern.search(key)
+            menu = self.by_name[match.group(0)] if match else None
+        return menu
+
+
+def _to_menu(item):
+    minutes = int(item["minutes"])
+    return {
+        "name": item["name"],
+        "emoji": item.get("emoji", ""),
+        "minutes": minutes,
+        "price": item.get("price"),
+        # 担当できる役職（空なら誰でも担当できる）
+        "roles": list(item.get("roles") or []),
+        "aliases": list(item.get("aliases") or []),
+        "default": bool(item.get("default")),
+        # 予約枠の数（SLOT_UNIT_MINUTES 単位に切り上げ）
+        "slots": max(1, math.ceil(minutes / scheduler.SLOT_UNIT_MINUTES)),
+    }
+
+
+def load(path=MENU_CATALOG_PATH, version=0):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    return MenuCatalog([_to_menu(item) for item in data["menus"]], version)
+
+
+_catalog = None
+_mtime = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def get_catalog():
+    """
+    現在のメニュー一覧を返す（ファイルが更新されていれば読み直す）
+    読み直しに失敗した場合は前回の一覧を使い続ける
+    """
+    global _catalog, _mtime, _checked_at
+    now = time.monotonic()
+    if _catalog is not None and now - _checked_at < MENU_RELOAD_INTERVAL:
+        return _catalog
+
+    with _lock:
+        if _catalog is not None and now - _checked_at < MENU_RELOAD_INTERVAL:
+            return _catalog
+        _checked_at = now
+        try:
+            mtime = os.stat(MENU_CATALOG_PATH).st_mtime_ns
+            if mtime != _mtime:
+                version = _catalog.version + 1 if _catalog is not None else 1
+                _catalog = load(MENU_CATALOG_PATH, version)
+                _mtime = mtime
+                print(f"📋 メニューを読み込みました: {', '.join(m['name'] for m in _catalog.menus)}")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"❌ メニューの読み込みに失敗しました ({MENU_CATALOG_PATH}): {e}")
+            if _catalog is None:
+                _catalog = MenuCatalog([], 0)
+        return _catalog
+
+
+def find_menu(text):
+    """
+    入力（「カラー」「ヘアカラー」「ｶｯﾄ」など）に当たるメニューを返す。見つからなければ None
+    """
+    return get_catalog().lookup(text)
+
+
+def default_menu():
+    return get_catalog().default
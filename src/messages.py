@@ -1,13 +1,105 @@
 from linebot.v3.messaging import (
     FlexMessage,
-    FlexContainer
+    FlexContainer,
+    TextMessage
 )
+import os
 import json
+import threading
+from collections import OrderedDict
+
+import menu_catalog
+
+# 引数つきの雛形から作ったメッセージを保持する件数（古いものから捨てる）
+TEMPLATE_CACHE_SIZE = int(os.getenv('MESSAGE_TEMPLATE_CACHE_SIZE', '256'))
+
+
+class TemplateRegistry:
+    """
+    返信メッセージの雛形を名前で登録し、作ったメッセージオブジェクトを使い回す
+    - 引数なしの雛形は初回に1回だけ作って検証し、以後は同じオブジェクトを返す
+    - 引数つきの雛形は引数の組ごとにメモ化する
+    - catalog=True の雛形はメニュー一覧が変わったら作り直す
+    """
+
+    def __init__(self, max_entries=TEMPLATE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._builders = {}
+        self._cache = OrderedDict()
+        self._catalog_version = None
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0}
+
+    def register(self, name, builder, catalog=False):
+        self._builders[name] = (builder, catalog)
+        return builder
+
+    def template(self, name, catalog=False):
+        """
+        デコレーター版の register
+        """
+        return lambda builder: self.register(name, builder, catalog)
+
+    def get(self, name, **params):
+        builder, catalog = self._builders[name]
+        key = (name, tuple(sorted(params.items())))
+        version = menu_catalog.get_catalog().version if catalog else None
+        with self._lock:
+            if catalog and version != self._catalog_version:
+                self._invalidate_catalog()
+                self._catalog_version = version
+            message = self._cache.get(key)
+            if message is not None:
+                self._cache.move_to_end(key)
+                self._stats["hits"] += 1
+                return message
+            self._stats["misses"] += 1
+
+        # 組み立てとモデルの検証はロックの外で行う（同時に作られても結果は同じ）
+        message = builder(**params)
+        with self._lock:
+            self._cache[key] = message
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return message
+
+    def _invalidate_catalog(self):
+        for key in [key for key in self._cache if self._builders[key[0]][1]]:
+            del self._cache[key]
+
+    def invalidate(self, name=None):
+        with self._lock:
+            for key in [key for key in self._cache if name in (None, key[0])]:
+                del self._cache[key]
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, cached=len(self._cache), templates=len(self._builders))
+
+
+templates = TemplateRegistry()
+
+def _menu_button(menu):
+    return {
+        "type": "button",
+        "action": {
+            "type": "message",
+            "label": f"{menu['emoji']} {menu['name']} ({menu['minutes']}分)".strip(),
+            "text": f"メニュー: {menu['name']}"
+        },
+        "style": "secondary",
+        "height": "sm"
+    }
 
 def get_menu_flex_message():
     """
-    予約メニュー選択用のFlex Messageを生成する
+    予約メニュー選択用のFlex Messageを返す（メニュー一覧から生成してキャッシュする）
     """
+    return templates.get("menu_select")
+
+@templates.template("menu_select", catalog=True)
+def _build_menu_flex_message():
+    catalog = menu_catalog.get_catalog()
     flex_json = {
         "type": "bubble",
         "hero": {
@@ -49,36 +141,7 @@ def get_menu_flex_message():
                     "margin": "xxl",
                     "spacing": "sm",
                     "contents": [
-                        {
-                            "type": "button",
-                            "action": {
-                                "type": "message",
-                                "label": "✂️ カット (60分)",
-                                "text": "メニュー: カット"
-                            },
-                            "style": "secondary",
-                            "height": "sm"
-                        },
-                        {
-                            "type": "button",
-                            "action": {
-                                "type": "message",
-                                "label": "🎨 カラー (90分)",
-                                "text": "メニュー: カラー"
-                            },
-                            "style": "secondary",
-                            "height": "sm"
-                        },
-                        {
-                            "type": "button",
-                            "action": {
-                                "type": "message",
-                                "label": "💆 ヘッドスパ (30分)",
-                                "text": "メニュー: ヘッドスパ"
-                            },
-                            "style": "secondary",
-                            "height": "sm"
-                        }
+                        _menu_button(menu) for menu in catalog.menus
                     ]
                 }
             ]
@@ -102,3 +165,39 @@ def get_menu_flex_message():
     }
 
     return FlexMessage(alt_text="メニュー選択", contents=FlexContainer.from_dict(flex_json))
+
+
+# --- 定型の返信 ---
+@templates.template("menu_not_found")
+def _menu_not_found():
+    return TextMessage(text="そのメニューは見つかりませんでした。一覧から選択してください。")
+
+@templates.template("menu_selected")
+def _menu_selected(menu_name):
+    return TextMessage(text=(
+        f"【選択: {menu_name}】\n"
+        "ご希望の日付を入力してください。\n"
+        "例: 2/10, 2月10日, 明日\n"
+        "（「空き」と送ると直近の空き時間を表示します）"
+    ))
+
+@templates.template("date_invalid")
+def _date_invalid():
+    return TextMessage(text="日付を正しく認識できませんでした。「2/10」のように入力してください。")
+
+@templates.template("no_cancellable")
+def _no_cancellable():
+    return TextMessage(text=(
+        "ℹ️ キャンセル可能な予約が見つかりませんでした。\n"
+        "（既にキャンセル済みか、もし過去の予約の場合は店舗へ直接ご連絡ください）"
+    ))
+
+@templates.template("store_info")
+def _store_info():
+    return TextMessage(text=(
+        "【 Salon Antigravity 】\n\n"
+        "📍 住所\n東京都渋谷区神宮前1-2-3\n\n"
+        "🕘 営業時間\n09:00 - 20:00 (最終受付 19:00)\n\n"
+        "定休日: 火曜日\n\n"
+        "皆様のご来店を心よりお待ちしております✨"
+    ))
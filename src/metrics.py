@@ -0,0 +1,214 @@
+import os
+import time
+import bisect
+import threading
+import contextvars
+from functools import wraps
+
+# --- CONFIGURATION ---
+# 0 にすると計測用のラッパー自体を付けない（オーバーヘッドなし）
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '1').lower() in ('1', 'true', 'yes')
+# これより時間のかかったWebhook処理は内訳をログに出す（秒）
+SLOW_SPAN_SECONDS = float(os.getenv('METRICS_SLOW_SPAN_SECONDS', '3'))
+# ヒストグラムのバケット（秒）
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """
+    Prometheus形式のヒストグラム（ラベルの組ごとにバケット数・合計・件数を持つ）
+    """
+
+    def __init__(self, name, help_text, label_names, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}  # { labels: [bucket_counts, sum, count] }
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(labels, list(s[0]), s[1], s[2]) for labels, s in sorted(self._series.items())]
+        for labels, bucket_counts, total, count in items:
+            base = _format_labels(self.label_names, labels)
+            cumulative = 0
+            for bound, n in zip(self.buckets, bucket_counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{base},le="{bound:g}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{base}}} {total:.6f}")
+            lines.append(f"{self.name}_count{{{base}}} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{{{_format_labels(self.label_names, labels)}}} {value}")
+        return lines
+
+
+def _format_labels(names, values):
+    return ",".join(f'{n}="{v}"' for n, v in zip(names, values))
+
+
+# 外部API呼び出し（service: line / lark_calendar / lark_crm / google_sheets）
+call_seconds = Histogram("salon_external_call_seconds", "Latency of external API calls.", ("service", "operation"))
+call_errors = Counter("salon_external_call_errors_total", "Failed external API calls.", ("service", "operation"))
+# Webhookイベント1件の処理時間と、そのうち各サービスの待ち時間
+span_seconds = Histogram("salon_webhook_seconds", "Time to handle one webhook event.", ("handler",))
+span_service_seconds = Histogram("salon_webhook_service_seconds", "Time spent per service within one webhook event.", ("handler", "service"))
+route_seconds = Histogram("salon_route_seconds", "Time to handle one text message, by route.", ("route",))
+
+_current_span = contextvars.ContextVar("salon_span", default=None)
+
+
+class Span:
+    """
+    Webhookイベント1件分の計測。処理中の外部API呼び出しを記録する
+    （fanout のスレッドにも contextvars で引き継がれる）
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.calls = []  # [(service, operation, 秒, ok)]
+        self._lock = threading.Lock()
+
+    def record(self, service, operation, elapsed, ok):
+        with self._lock:
+            self.calls.append((service, operation, elapsed, ok))
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current_span.reset(self._token)
+        elapsed = time.perf_counter() - self._started
+        span_seconds.observe((self.handler,), elapsed)
+        with self._lock:
+            calls = list(self.calls)
+        per_service = {}
+        for service, _, seconds, _ in calls:
+            per_service[service] = per_service.get(service, 0.0) + seconds
+        for service, seconds in per_service.items():
+            span_service_seconds.observe((self.handler, service), seconds)
+        if elapsed >= SLOW_SPAN_SECONDS:
+            breakdown = ", ".join(f"{s}.{o} {t:.2f}s{'' if ok else ' (失敗)'}" for s, o, t, ok in calls)
+            print(f"🐢 Webhook処理が遅延しました ({self.handler}, {elapsed:.2f}s): {breakdown or '外部呼び出しなし'}")
+        return False
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+def span(handler):
+    """
+    Webhookイベント1件の処理を囲む with ブロック用
+    """
+    if not METRICS_ENABLED:
+        return _NO_SPAN
+    return Span(handler)
+
+
+def _failed(result):
+    # 戻り値で失敗を表すAPI（Larkのレスポンス、False）も失敗として数える
+    if result is False:
+        return True
+    success = getattr(result, "success", None)
+    return callable(success) and not success()
+
+
+def timed(service, operation):
+    """
+    関数呼び出しの所要時間とエラーを記録するデコレーター
+    """
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            ok = False
+            try:
+                result = func(*args, **kwargs)
+                ok = not _failed(result)
+                return result
+            finally:
+                elapsed = time.perf_counter() - started
+                labels = (service, operation)
+                call_seconds.observe(labels, elapsed)
+                if not ok:
+                    call_errors.inc(labels)
+                current = _current_span.get()
+                if current is not None:
+                    current.record(service, operation, elapsed, ok)
+        # 計測済みの印（__wrapped__ は他のデコレーターも付けるので使わない）
+        wrapper._salon_timed = True
+        return wrapper
+    return decorator
+
+
+def instrument(obj, service, operations):
+    """
+    クライアントオブジェクトの指定メソッドを計測付きに置き換える（インスタンス単位）
+    例: instrument(messaging_api, "line", ["reply_message", "push_message"])
+    """
+    if not METRICS_ENABLED or obj is None:
+        return obj
+    for operation in operations:
+        method = getattr(obj, operation, None)
+        if method is not None and not getattr(method, "_salon_timed", False):
+            setattr(obj, operation, timed(service, operation)(method))
+    return obj
+
+
+def render(gauges=None):
+    """
+    /metrics 用のPrometheusテキスト形式を返す
+    gauges: { メトリクス名: 値 } の追加の現在値
+    """
+    lines = []
+    for metric in (call_seconds, call_errors, span_seconds, span_service_seconds, route_seconds):
+        lines.extend(metric.render())
+    for name, value in (gauges or {}).items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
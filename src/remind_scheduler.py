@@ -1,27 +1,137 @@
 import os
 import sys
+import time
+import uuid
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 # ローカルモジュールのインポート設定
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import google_sheets
+import line_client
+import reminder_ledger
 
 # LINE BOT SDK v3
 from linebot.v3.messaging import (
-    Configuration,
-    ApiClient,
-    MessagingApi,
     PushMessageRequest,
+    MulticastRequest,
     TextMessage
 )
-from linebot.v3.exceptions import ApiException
+from linebot.v3.messaging.exceptions import ApiException
 
 # Load env variables (for local run)
 load_dotenv()
 
 CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
+# 同時に送信するリクエスト数
+REMINDER_CONCURRENCY = int(os.getenv('REMINDER_CONCURRENCY', '8'))
+# 1秒あたりのAPI呼び出し上限
+REMINDER_RATE_PER_SECOND = float(os.getenv('REMINDER_RATE_PER_SECOND', '20'))
+# 429/5xx の再送回数
+REMINDER_MAX_RETRIES = 3
+# multicast 1回あたりの最大送信先（APIの上限）
+MULTICAST_MAX_RECIPIENTS = 500
+
+class TokenBucket:
+    """
+    APIの呼び出しレートを制限するトークンバケット（スレッドセーフ）
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+def _retry_after(e, attempt):
+    # 429の場合は Retry-After ヘッダーに従い、無ければ指数的に待つ
+    headers = e.headers or {}
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float(2 ** attempt)
+
+def _send_with_retry(send, bucket):
+    """
+    レート制限しながら送信する。429（と5xx）は待ってから再送する
+    同じ X-Line-Retry-Key を使うので、再送しても二重送信にはならない
+    """
+    retry_key = str(uuid.uuid4())
+    for attempt in range(REMINDER_MAX_RETRIES + 1):
+        bucket.acquire()
+        try:
+            send(retry_key)
+            return
+        except ApiException as e:
+            # 409: 同じRetry-Keyのリクエストが既に受理済み
+            if e.status == 409:
+                return
+            if attempt == REMINDER_MAX_RETRIES or not (e.status == 429 or (e.status or 0) >= 500):
+                raise
+            time.sleep(_retry_after(e, attempt))
+
+def dispatch_messages(line_bot_api, messages):
+    """
+    リマインドをまとめて送信する
+    messages: [(user_id, message_text), ...]
+    - 同じ文面の送信先が複数あれば multicast（最大500人ずつ）にまとめる
+    - それ以外は push を並行送信する（同時実行数・レートを制限）
+    戻り値: 送信できた (user_id, message_text) の集合, API呼び出し回数
+    """
+    groups = {}
+    for user_id, text in messages:
+        recipients = groups.setdefault(text, [])
+        if user_id not in recipients:
+            recipients.append(user_id)
+
+    jobs = []
+    for text, recipients in groups.items():
+        if len(recipients) == 1:
+            user_id = recipients[0]
+            jobs.append(([user_id], text, lambda key, u=user_id, t=text: line_bot_api.push_message(
+                PushMessageRequest(to=u, messages=[TextMessage(text=t)]),
+                x_line_retry_key=key
+            )))
+        else:
+            for i in range(0, len(recipients), MULTICAST_MAX_RECIPIENTS):
+                chunk = recipients[i:i + MULTICAST_MAX_RECIPIENTS]
+                jobs.append((chunk, text, lambda key, c=chunk, t=text: line_bot_api.multicast(
+                    MulticastRequest(to=c, messages=[TextMessage(text=t)]),
+                    x_line_retry_key=key
+                )))
+
+    bucket = TokenBucket(REMINDER_RATE_PER_SECOND)
+    delivered = set()
+    with ThreadPoolExecutor(max_workers=REMINDER_CONCURRENCY) as executor:
+        futures = {executor.submit(_send_with_retry, send, bucket): (recipients, text) for recipients, text, send in jobs}
+        for future, (recipients, text) in futures.items():
+            target = recipients[0] if len(recipients) == 1 else f"{len(recipients)}名 (multicast)"
+            try:
+                future.result()
+                delivered.update((user_id, text) for user_id in recipients)
+                print(f"✅ リマインド送信成功: {target}")
+            except ApiException as e:
+                print(f"❌ LINE API送信エラー ({target}): {e}")
+            except Exception as e:
+                print(f"❌ 予期せぬエラー ({target}): {e}")
+    return delivered, len(jobs)
 
 def send_reminders(target_type=None):
     """
@@ -37,12 +147,6 @@ def send_reminders(target_type=None):
         print("❌ Error: LINE_CHANNEL_ACCESS_TOKEN is not set.")
         return
 
-    # Google Sheetsから予約全件取得
-    reservations = google_sheets.get_all_reservations()
-    if not reservations:
-        print("📭 予約データがありません。")
-        return
-
     # 日付計算
     today = datetime.now().date()
     tomorrow = today + timedelta(days=1)
@@ -53,20 +157,32 @@ def send_reminders(target_type=None):
     print(f"🔄 リマインド確認開始 (Type: {target_type})")
     print(f"   Today: {today_str}, Tomorrow: {tomorrow_str}")
 
-    # LINE API設定
-    configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
-    
-    count = 0
-    with ApiClient(configuration) as api_client:
-        line_bot_api = MessagingApi(api_client)
+    # Google Sheetsから対象日の予約だけを順に読み込む（全件は取得しない）
+    window_start = tomorrow_str if target_type == 'tomorrow' else today_str
+    window_end = today_str if target_type == 'today' else tomorrow_str
+    reservations = google_sheets.iter_reservations(window_start, window_end)
+
+    # LINE API設定（プロセス共通の接続プールを使う）
+    line_bot_api = line_client.get_messaging_api()
 
+    started = time.monotonic()
+    ledger = reminder_ledger.ReminderLedger()
+    run_key = f"{today_str}:{target_type or 'all'}"
+
+    # 前回の実行が途中で終わっていれば、保存した送信計画から再開する（シートは読み直さない）
+    plan = ledger.load_checkpoint(run_key)
+    if plan is not None:
+        print(f"↩️ 中断した実行を再開します ({len(plan)}件)")
+    else:
+        plan = []
         for res in reservations:
             user_id = res['user_id']
             res_date = res['date']   # YYYY-MM-DD
             res_time = res['time']
             menu = res['menu']
-            
+        
             message_text = ""
+            reminder_type = None
 
             # --- 明日の予約（前日リマインド） ---
             # 「tomorrow」指定 または 指定なしの場合に実行
@@ -78,7 +194,8 @@ def send_reminders(target_type=None):
                     f"ご来店をお待ちしております✨\n"
                     f"変更やキャンセルがある場合は、お早めにご連絡ください。"
                 )
-            
+                reminder_type = 'tomorrow'
+        
             # --- 今日の予約（当日リマインド） ---
             # 「today」指定 または 指定なしの場合に実行
             elif res_date == today_str and (target_type == 'today' or target_type is None):
@@ -88,24 +205,54 @@ def send_reminders(target_type=None):
                     f"📝 メニュー: {menu}\n\n"
                     f"お気をつけてお越しくださいませ💇‍♀️"
                 )
+                reminder_type = 'today'
 
-            # メッセージがあれば送信
+            # メッセージがあれば送信計画に追加
             if message_text:
-                try:
-                    line_bot_api.push_message(
-                        PushMessageRequest(
-                            to=user_id,
-                            messages=[TextMessage(text=message_text)]
-                        )
-                    )
-                    print(f"✅ リマインド送信成功: {user_id} ({res_date} {res_time})")
-                    count += 1
-                except ApiException as e:
-                    print(f"❌ LINE API送信エラー ({user_id}): {e}")
-                except Exception as e:
-                    print(f"❌ 予期せぬエラー ({user_id}): {e}")
-
-    print(f"🏁 リマインド処理完了: {count}件送信")
+                plan.append({
+                    "key": reminder_ledger.reservation_key(res),
+                    "type": reminder_type,
+                    "user_id": user_id,
+                    "text": message_text
+                })
+        ledger.save_checkpoint(run_key, plan)
+
+    # 送信済み・他の実行が送信中のものを除く（この実行が落ちる前に確保した分は取り直す）
+    claimed = []
+    already_sent = 0
+    busy = 0
+    for item in plan:
+        if ledger.claim(item["key"], item["type"], owner=run_key):
+            claimed.append(item)
+        elif ledger.is_sent(item["key"], item["type"]):
+            already_sent += 1
+        else:
+            busy += 1
+    if already_sent:
+        print(f"⏭️ 送信済みのためスキップ: {already_sent}件")
+    if busy:
+        print(f"⏳ 他の実行が送信中のためスキップ: {busy}件（この実行は完了扱いにせず、次回の再開で確認します）")
+
+    if not claimed:
+        if not busy:
+            ledger.finish_run(run_key)
+            print("📭 リマインド対象の予約がありません。")
+        return
+
+    outgoing = [(item["user_id"], item["text"]) for item in claimed]
+    delivered, api_calls = dispatch_messages(line_bot_api, outgoing)
+    for item in claimed:
+        if (item["user_id"], item["text"]) in delivered:
+            ledger.mark_sent(item["key"], item["type"])
+        else:
+            ledger.release(item["key"], item["type"])
+    # 計画した分がすべて送信済みか取り消し済み（次回の実行で再送）になった場合だけ完了にする
+    if not busy:
+        ledger.finish_run(run_key)
+    ledger.prune()
+    elapsed = time.monotonic() - started
+
+    print(f"🏁 リマインド処理完了: {len(delivered)}件送信 (API呼び出し{api_calls}回, {elapsed:.1f}秒)")
 
 if __name__ == "__main__":
     # コマンドライン引数の解析
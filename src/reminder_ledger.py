@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# --- CONFIGURATION ---
+REMINDER_LEDGER_PATH = os.getenv('REMINDER_LEDGER_PATH', 'reminder_ledger.db')
+# 送信中のまま残った印（送信途中でプロセスが落ちた場合）を取り直せるようになるまでの秒数
+CLAIM_TTL_SECONDS = int(os.getenv('REMINDER_CLAIM_TTL', '600'))
+# 送信済み記録を保持する日数
+LEDGER_RETENTION_DAYS = 30
+
+
+def reservation_key(reservation):
+    """
+    予約を一意に表すキー（シートの行番号は削除でずれるので使わない）
+    """
+    return f"{reservation['date']}|{reservation['time']}|{reservation['user_id']}|{reservation['menu']}"
+
+
+class ReminderLedger:
+    """
+    リマインドの送信済み台帳（SQLite）
+    - (予約キー, 種類) を主キーにして、送信前に O(1) で確認・確保する
+    - 実行ごとの送信計画をチェックポイントとして保存し、落ちた実行を途中から再開できる
+    """
+
+    def __init__(self, path=REMINDER_LEDGER_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sent ("
+                " reservation_key TEXT NOT NULL,"
+                " reminder_type TEXT NOT NULL,"
+                " status TEXT NOT NULL,"  # claimed / sent
+                " owner TEXT,"            # 確保した実行（run_key）
+                " updated_at REAL NOT NULL,"
+                " PRIMARY KEY (reservation_key, reminder_type))"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(sent)")}
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE sent ADD COLUMN owner TEXT")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS runs ("
+                " run_key TEXT PRIMARY KEY,"
+                " plan TEXT NOT NULL,"
+                " status TEXT NOT NULL,"  # running / done
+                " updated_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        # sqlite3の接続はスレッドごとに持つ
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def is_sent(self, key, reminder_type):
+        row = self._connect().execute(
+            "SELECT 1 FROM sent WHERE reservation_key = ? AND reminder_type = ? AND status = 'sent'",
+            (key, reminder_type)
+        ).fetchone()
+        return row is not None
+
+    def claim(self, key, reminder_type, owner=None):
+        """
+        送信権を確保する。既に送信済み、または他の実行が送信中なら False
+        （重なって動いた実行同士でも、同じリマインドを送るのは一方だけになる）
+        owner: 確保する実行の run_key。落ちた実行を再開した場合、自分が確保したまま残った分は
+               CLAIM_TTL_SECONDS を待たずに取り直せる
+        """
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute(
+                "INSERT INTO sent (reservation_key, reminder_type, status, owner, updated_at) VALUES (?, ?, 'claimed', ?, ?)"
+                " ON CONFLICT (reservation_key, reminder_type) DO UPDATE"
+                " SET owner = excluded.owner, updated_at = excluded.updated_at"
+                " WHERE sent.status = 'claimed' AND (sent.updated_at < ? OR sent.owner = excluded.owner)",
+                (key, reminder_type, owner, now, now - CLAIM_TTL_SECONDS)
+            )
+            return cur.rowcount == 1
+
+    def mark_sent(self, key, reminder_type):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sent (reservation_key, reminder_type, status, updated_at) VALUES (?, ?, 'sent', ?)",
+                (key, reminder_type, time.time())
+            )
+
+    def release(self, key, reminder_type):
+        """
+        送信に失敗したので確保を取り消す（次回の実行で再送される）
+        """
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM sent WHERE reservation_key = ? AND reminder_type = ? AND status = 'claimed'",
+                (key, reminder_type)
+            )
+
+    def load_checkpoint(self, run_key):
+        """
+        終わっていない実行の送信計画を返す（無ければ None）
+        """
+        row = self._connect().execute(
+            "SELECT plan FROM runs WHERE run_key = ? AND status = 'running'", (run_key,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_checkpoint(self, run_key, plan):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO runs (run_key, plan, status, updated_at) VALUES (?, ?, 'running', ?)",
+                (run_key, json.dumps(plan, ensure_ascii=False), time.time())
+            )
+
+    def finish_run(self, run_key):
+        with self._connect() as conn:
+            conn.execute("UPDATE runs SET status = 'done', updated_at = ? WHERE run_key = ?", (time.time(), run_key))
+
+    def prune(self, days=LEDGER_RETENTION_DAYS):
+        """
+        古い記録を削除する
+        """
+        cutoff = time.time() - days * 86400
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sent WHERE updated_at < ?", (cutoff,))
+            conn.execute("DELETE FROM runs WHERE updated_at < ?", (cutoff,))
@@ -0,0 +1,230 @@
+import os
+import sys
+import time
+import heapq
+import itertools
+import threading
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+
+# ローカルモジュールのインポート設定
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import google_sheets
+import line_client
+import reminder_ledger
+import reservation_store
+import remind_scheduler
+
+load_dotenv()
+
+# --- CONFIGURATION ---
+# 予約の何時間前にリマインドを送るか（例: "24,2" -> 24時間前と2時間前）
+REMINDER_OFFSET_HOURS = [float(h) for h in os.getenv('REMINDER_OFFSET_HOURS', '24,2').split(',') if h.strip()]
+# シートから予約を読み直す間隔（秒）。他のワーカーや手作業での変更に追従するため
+REMINDER_RELOAD_INTERVAL = int(os.getenv('REMINDER_RELOAD_INTERVAL', '3600'))
+# 起動・再読み込み時に、送信時刻を過ぎていても送るリマインドの猶予（秒）
+REMINDER_GRACE_SECONDS = int(os.getenv('REMINDER_GRACE_SECONDS', '1800'))
+
+# 予定中のリマインド（送信時刻順のヒープ）
+# [(送信時刻, 連番, 予約キー, 種類)]。キャンセルされた予約の分は取り出した時に捨てる
+_heap = []
+_counter = itertools.count()
+# 直近の予約 { 予約キー: 予約 }
+_reservations = {}
+_cond = threading.Condition()
+_start_lock = threading.Lock()
+_stop = threading.Event()
+_thread = None
+_ledger = None
+_stats = {"scheduled": 0, "sent": 0, "skipped": 0, "cancelled": 0, "failed": 0}
+
+
+def _reminder_type(hours):
+    return f"{hours:g}h"
+
+
+def _start_datetime(reservation):
+    try:
+        return datetime.strptime(f"{reservation['date']} {reservation['time']}", "%Y-%m-%d %H:%M")
+    except (KeyError, ValueError):
+        return None
+
+
+def build_message(reservation, hours):
+    """
+    リマインドの文面を作る（前日分は予約確認、当日分は来店案内）
+    """
+    start = _start_datetime(reservation)
+    if hours >= 12:
+        return (
+            f"こんばんは！{start.strftime('%Y-%m-%d')} のご予約確認です。\n\n"
+            f"⏰ 時間: {reservation['time']}〜\n"
+            f"📝 メニュー: {reservation['menu']}\n\n"
+            f"ご来店をお待ちしております✨\n"
+            f"変更やキャンセルがある場合は、お早めにご連絡ください。"
+        )
+    return (
+        f"本日 {reservation['time']} からのご予約です☀️\n\n"
+        f"📝 メニュー: {reservation['menu']}\n\n"
+        f"お気をつけてお越しくださいませ💇‍♀️"
+    )
+
+
+def _schedule(reservation, grace_seconds):
+    # _cond を保持した状態で呼ぶ
+    start = _start_datetime(reservation)
+    if start is None:
+        return
+    key = reminder_ledger.reservation_key(reservation)
+    _reservations[key] = reservation
+    now = time.time()
+    for hours in REMINDER_OFFSET_HOURS:
+        fire_at = (start - timedelta(hours=hours)).timestamp()
+        if fire_at >= now - grace_seconds and start.timestamp() > now:
+            heapq.heappush(_heap, (fire_at, next(_counter), key, hours))
+            _stats["scheduled"] += 1
+
+
+def add_reservation(reservation):
+    """
+    予約が入った時に呼ぶ。送信時刻を過ぎたリマインドは送らない
+    reservation: {"date": "YYYY-MM-DD", "time": "HH:MM", "user_id": ..., "menu": ...}
+    """
+    if _thread is None:
+        return
+    with _cond:
+        _schedule(reservation, grace_seconds=0)
+        _cond.notify()
+
+
+def remove_reservation(reservation):
+    """
+    キャンセル時に呼ぶ（ヒープ上の分は送信時に捨てる）
+    """
+    if _thread is None:
+        return
+    with _cond:
+        _reservations.pop(reminder_ledger.reservation_key(reservation), None)
+
+
+def reload():
+    """
+    直近の予約を読み込み直し、ヒープを作り直す
+    ローカルの予約ストアを正とし、ストア導入前の予約はシートから補う
+    """
+    today = datetime.now().date()
+    horizon = today + timedelta(hours=max(REMINDER_OFFSET_HOURS, default=0) + 24)
+    store = reservation_store.get_store()
+    local = store.reservations_between(today, horizon)
+    cancelled = {reminder_ledger.reservation_key(r) for r in store.reservations_between(today, horizon, status="cancelled")}
+    skip = cancelled | {reminder_ledger.reservation_key(r) for r in local}
+    reservations = local + [
+        r for r in google_sheets.iter_reservations(today.strftime('%Y-%m-%d'), horizon.strftime('%Y-%m-%d'))
+        if reminder_ledger.reservation_key(r) not in skip
+    ]
+    with _cond:
+        _heap.clear()
+        _reservations.clear()
+        for reservation in reservations:
+            _schedule(reservation, grace_seconds=REMINDER_GRACE_SECONDS)
+        _cond.notify()
+    print(f"🔄 リマインド予定を読み込みました: 予約{len(_reservations)}件 / リマインド{len(_heap)}件")
+
+
+def _fire(due):
+    """
+    送信時刻になったリマインドを送る（台帳で確保できたものだけ）
+    """
+    ledger = _ledger
+    # キャンセルは受け付けたプロセスのヒープからしか消えないので、送る直前にストアで状態を確かめる
+    # （ストア導入前のシートだけの予約は ID が無いので確かめない）
+    statuses = reservation_store.get_store().statuses({r["id"] for _, _, r in due if r.get("id")})
+    claimed = []
+    for key, hours, reservation in due:
+        if reservation.get("id") and statuses.get(reservation["id"]) != "confirmed":
+            _stats["cancelled"] += 1
+            continue
+        if ledger.claim(key, _reminder_type(hours)):
+            claimed.append((key, hours, reservation, build_message(reservation, hours)))
+        else:
+            _stats["skipped"] += 1
+    if not claimed:
+        return
+
+    outgoing = [(reservation["user_id"], text) for _, _, reservation, text in claimed]
+    delivered, _ = remind_scheduler.dispatch_messages(line_client.get_messaging_api(), outgoing)
+    for key, hours, reservation, text in claimed:
+        if (reservation["user_id"], text) in delivered:
+            ledger.mark_sent(key, _reminder_type(hours))
+            _stats["sent"] += 1
+        else:
+            ledger.release(key, _reminder_type(hours))
+            _stats["failed"] += 1
+
+
+def _run():
+    next_reload = 0.0
+    while not _stop.is_set():
+        now = time.time()
+        if now >= next_reload:
+            try:
+                reload()
+            except Exception as e:
+                print(f"❌ リマインド予定の読み込みエラー: {e}")
+            next_reload = now + REMINDER_RELOAD_INTERVAL
+
+        due = []
+        with _cond:
+            while _heap and _heap[0][0] <= now:
+                _, _, key, hours = heapq.heappop(_heap)
+                if key in _reservations:
+                    due.append((key, hours, _reservations[key]))
+            if not due:
+                # 次の送信時刻か再読み込みの時刻まで待つ（予約追加時は notify で起こされる）
+                wake_at = min(_heap[0][0], next_reload) if _heap else next_reload
+                _cond.wait(timeout=max(0.1, wake_at - now))
+                continue
+
+        try:
+            _fire(due)
+        except Exception as e:
+            print(f"❌ リマインド送信エラー: {e}")
+
+
+def start():
+    """
+    バックグラウンドでスケジューラーを起動する（Botプロセス内で使う場合）
+    """
+    global _thread, _ledger
+    if _thread is not None:
+        return
+    with _start_lock:
+        if _thread is not None:
+            return
+        _ledger = reminder_ledger.ReminderLedger()
+        _thread = threading.Thread(target=_run, name="reminder-service", daemon=True)
+        _thread.start()
+
+
+def stop():
+    _stop.set()
+    with _cond:
+        _cond.notify()
+
+
+def get_stats():
+    with _cond:
+        stats = dict(_stats)
+        stats["pending"] = len(_heap)
+        stats["reservations"] = len(_reservations)
+    return stats
+
+
+if __name__ == "__main__":
+    # 専用ワーカーとして常駐させる場合
+    start()
+    try:
+        while _thread.is_alive():
+            _thread.join(1)
+    except KeyboardInterrupt:
+        stop()
@@ -0,0 +1,407 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from datetime import datetime
+
+import scheduler
+
+# --- CONFIGURATION ---
+RESERVATION_DB_PATH = os.getenv('RESERVATION_DB_PATH', 'reservations.db')
+# 同期が終わった送信キューの記録を保持する日数
+OUTBOX_RETENTION_DAYS = 14
+
+# 予約の複製先（送信キューの target）
+TARGET_CALENDAR = "calendar"
+TARGET_SHEETS = "sheets"
+TARGET_CRM = "crm"
+
+
+def _to_reservation(row):
+    reservation = dict(row)
+    reservation["start"] = datetime.fromtimestamp(reservation["start_ts"])
+    reservation["end"] = datetime.fromtimestamp(reservation["end_ts"])
+    return reservation
+
+
+def _staff_filter(staff_id, include_unassigned):
+    """
+    担当スタッフ（席）で絞り込む条件。staff_id が None なら全員分
+    include_unassigned: 担当未設定の予約（複数スタッフ化する前の予約）も含める
+    """
+    if staff_id is None:
+        return "", ()
+    return " AND (staff_id = ? OR (staff_id IS NULL AND ?))", (staff_id, int(include_unassigned))
+
+
+class ReservationStore:
+    """
+    予約・キャンセル・売上の記録先（SQLite, WAL）
+    - 予約の確定はこのファイルへの書き込みだけで完了する（リモートAPIを待たない）
+    - 同じトランザクションで送信キュー（outbox）に複製作業を積み、reservation_sync が順に外部へ反映する
+    """
+
+    def __init__(self, path=RESERVATION_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS reservations ("
+                " id TEXT PRIMARY KEY,"
+                " user_id TEXT NOT NULL,"
+                " menu TEXT NOT NULL,"
+                " date TEXT NOT NULL,"           # YYYY-MM-DD
+                " time TEXT NOT NULL,"           # HH:MM
+                " start_ts REAL NOT NULL,"
+                " end_ts REAL NOT NULL,"
+                " status TEXT NOT NULL,"         # confirmed / cancelled
+                " calendar_event_id TEXT,"
+                " staff_id TEXT,"                # 担当スタッフ（席）
+                " calendar_id TEXT,"             # 担当スタッフのLarkカレンダー（None なら LARK_CALENDAR_ID）
+                " targets TEXT,"                 # 複製先（カンマ区切り。キャンセルも同じ先に反映する）
+                " crm_record_id TEXT,"           # Lark Base に登録したレコードのID
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(reservations)")}
+            for column in ("staff_id TEXT", "calendar_id TEXT", "targets TEXT", "crm_record_id TEXT"):
+                if column.split()[0] not in columns:
+                    conn.execute(f"ALTER TABLE reservations ADD COLUMN {column}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_date ON reservations(date, status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_user ON reservations(user_id, status, start_ts)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sales ("
+                " id TEXT PRIMARY KEY,"
+                " user_id TEXT NOT NULL,"
+                " amount REAL NOT NULL,"
+                " menu TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " sync_key TEXT NOT NULL,"       # target:対象ID（同じキーの作業は seq 順に処理する）
+                " target TEXT NOT NULL,"
+                " action TEXT NOT NULL,"         # create / cancel / sale
+                " payload TEXT NOT NULL,"
+                " status TEXT NOT NULL,"         # pending / done / conflict / failed / skipped
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " next_attempt_at REAL NOT NULL,"
+                " locked_until REAL,"
+                " last_error TEXT,"
+                " updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox(status, next_attempt_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_key ON outbox(sync_key, seq)")
+
+    def _connect(self):
+        # sqlite3の接続はスレッドごとに持つ
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10.0)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _enqueue(self, conn, target, action, object_id, payload):
+        now = time.time()
+        conn.execute(
+            "INSERT INTO outbox (sync_key, target, action, payload, status, next_attempt_at, updated_at)"
+            " VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+            (f"{target}:{object_id}", target, action, json.dumps(payload, ensure_ascii=False), now, now)
+        )
+
+    # --- 予約 ---
+    def _conflicts(self, conn, date_str, start_ts, end_ts, external_events,
+                   staff_id=None, include_unassigned=True):
+        """
+        枠が空いているかをローカルの情報だけで判定する（同じトランザクション内で呼ぶ）
+        - 確定済みの予約（staff_id を指定した場合はそのスタッフの分だけ）
+        - external_events: 呼び出し側が持っているカレンダーの予定（日別キャッシュ）。
+          ローカルでキャンセル済みの予約の予定は除く
+        """
+        clause, params = _staff_filter(staff_id, include_unassigned)
+        row = conn.execute(
+            "SELECT 1 FROM reservations WHERE date = ? AND start_ts < ? AND end_ts > ?"
+            " AND status = 'confirmed'" + clause + " LIMIT 1",
+            (date_str, end_ts, start_ts) + params
+        ).fetchone()
+        if row is not None:
+            return True
+        if not external_events:
+            return False
+        cancelled = {r[0] for r in conn.execute(
+            "SELECT calendar_event_id FROM reservations WHERE date = ? AND status = 'cancelled'"
+            " AND calendar_event_id IS NOT NULL", (date_str,)
+        )}
+        return any(
+            e["start"].timestamp() < end_ts and e["end"].timestamp() > start_ts and e.get("event_id") not in cancelled
+            for e in external_events
+        )
+
+    def create_reservation(self, user_id, menu, start_dt, end_dt, targets=(TARGET_CALENDAR, TARGET_SHEETS),
+                           external_events=None, staff=None):
+        """
+        枠を押さえて確定する。枠が埋まっていた場合は None
+        staff: 複数スタッフ（席）の場合の候補 [{"id", "calendar_id", "events", "primary"}, ...]。
+               並び順に空いている1人を割り当てる（primary のスタッフは担当未設定の既存予約も受け持つ）
+               空のリスト（担当できるスタッフがいない）なら None
+        空き確認と書き込みを1つの短いトランザクションで行う（同じ枠を同時に押さえられるのは1人だけ）
+        BEGIN IMMEDIATE はデータベース全体の書き込みロックなので、別の日の予約も順番に通る。
+        トランザクション内ではローカルのSQLiteの読み書きだけを行い（外部APIは呼ばない）、保持時間を短くする
+        """
+        if not scheduler.is_valid_start(start_dt, end_dt):
+            raise ValueError(f"予約できない時間です: {start_dt.strftime('%Y-%m-%d %H:%M')}")
+        now = time.time()
+        reservation = {
+            "id": uuid.uuid4().hex,
+            "user_id": user_id,
+            "menu": menu,
+            "date": start_dt.strftime('%Y-%m-%d'),
+            "time": start_dt.strftime('%H:%M'),
+            "start_ts": start_dt.timestamp(),
+            "end_ts": end_dt.timestamp(),
+            "status": "confirmed",
+            "calendar_event_id": None,
+            "staff_id": None,
+            "calendar_id": None,
+            "targets": ",".join(targets),
+            "crm_record_id": None,
+            "created_at": now,
+            "updated_at": now
+        }
+        # staff=None は複数スタッフを使わない呼び出し（従来どおりの1席）
+        # 空のリストはメニューを担当できるスタッフがいないということなので、予約を受けない
+        if staff is None:
+            candidates = [{"id": None, "calendar_id": None, "events": external_events}]
+        elif not staff:
+            return None
+        else:
+            candidates = staff
+
+        conn = self._connect()
+        # BEGIN IMMEDIATE で書き込みロックを先に取り、他プロセスとの確認→書き込みの割り込みを防ぐ
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for i, member in enumerate(candidates):
+                if not self._conflicts(conn, reservation["date"], reservation["start_ts"], reservation["end_ts"],
+                                       member["events"], member["id"], member.get("primary", i == 0)):
+                    reservation["staff_id"] = member["id"]
+                    reservation["calendar_id"] = member["calendar_id"]
+                    break
+            else:
+                conn.rollback()
+                return None
+            conn.execute(
+                "INSERT INTO reservations (id, user_id, menu, date, time, start_ts, end_ts, status,"
+                " calendar_event_id, staff_id, calendar_id, targets, crm_record_id, created_at, updated_at)"
+                " VALUES (:id, :user_id, :menu, :date, :time, :start_ts, :end_ts, :status,"
+                " :calendar_event_id, :staff_id, :calendar_id, :targets, :crm_record_id,"
+                " :created_at, :updated_at)",
+                reservation
+            )
+            for target in targets:
+                self._enqueue(conn, target, "create", reservation["id"], {"reservation_id": reservation["id"]})
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        reservation["start"] = start_dt
+        reservation["end"] = end_dt
+        return reservation
+
+    def get_reservation(self, reservation_id):
+        row = self._connect().execute("SELECT * FROM reservations WHERE id = ?", (reservation_id,)).fetchone()
+        return _to_reservation(row) if row else None
+
+    def statuses(self, reservation_ids):
+        """
+        予約の現在の状態をまとめて返す: { 予約ID: status }（見つからない予約は含まない）
+        """
+        ids = list(reservation_ids)
+        if not ids:
+            return {}
+        rows = self._connect().execute(
+            f"SELECT id, status FROM reservations WHERE id IN ({','.join('?' * len(ids))})", ids
+        ).fetchall()
+        return {row["id"]: row["status"] for row in rows}
+
+    def cancel_latest(self, user_id, targets=None):
+        """
+        指定ユーザーの今日以降の予約のうち一番新しいものをキャンセルする（無ければ None）
+        まだ外部に送っていない登録作業は、送らずに取り消す
+        targets: キャンセルを反映する先（省略時は予約時と同じ複製先）
+        """
+        today_str = datetime.now().strftime('%Y-%m-%d')
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM reservations WHERE user_id = ? AND status = 'confirmed' AND date >= ?"
+                " ORDER BY start_ts DESC LIMIT 1",
+                (user_id, today_str)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE reservations SET status = 'cancelled', updated_at = ? WHERE id = ?", (now, row["id"])
+            )
+            if targets is None:
+                # 複製先を記録する前の予約は、従来どおりカレンダーとシート
+                targets = row["targets"].split(",") if row["targets"] else (TARGET_CALENDAR, TARGET_SHEETS)
+            for target in targets:
+                skipped = conn.execute(
+                    "UPDATE outbox SET status = 'skipped', updated_at = ?"
+                    " WHERE sync_key = ? AND action = 'create' AND status = 'pending'"
+                    " AND attempts = 0 AND (locked_until IS NULL OR locked_until < ?)",
+                    (now, f"{target}:{row['id']}", now)
+                ).rowcount
+                if not skipped:
+                    self._enqueue(conn, target, "cancel", row["id"], {"reservation_id": row["id"]})
+        reservation = _to_reservation(row)
+        reservation["status"] = "cancelled"
+        return reservation
+
+    def set_calendar_event_id(self, reservation_id, event_id):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE reservations SET calendar_event_id = ?, updated_at = ? WHERE id = ?",
+                (event_id, time.time(), reservation_id)
+            )
+
+    def set_crm_record_id(self, reservation_id, record_id):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE reservations SET crm_record_id = ?, updated_at = ? WHERE id = ?",
+                (record_id, time.time(), reservation_id)
+            )
+
+    def reservations_between(self, start_date, end_date, status="confirmed", staff_id=None, include_unassigned=True):
+        """
+        start_date〜end_date（両端含む）の予約を返す
+        """
+        clause, params = _staff_filter(staff_id, include_unassigned)
+        rows = self._connect().execute(
+            "SELECT * FROM reservations WHERE date >= ? AND date <= ? AND status = ?" + clause + " ORDER BY start_ts",
+            (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'), status) + params
+        ).fetchall()
+        return [_to_reservation(row) for row in rows]
+
+    def local_changes(self, start_date, end_date, staff_id=None, include_unassigned=True):
+        """
+        まだカレンダーに同期されていないローカルの変更
+        戻り値: (ローカルでキャンセル済みの予約の予定IDの集合,
+                 カレンダー未登録の予約の予定リスト（staff_id を指定した場合はそのスタッフの分）)
+        """
+        cancelled = {
+            r["calendar_event_id"] for r in self.reservations_between(start_date, end_date, status="cancelled")
+            if r["calendar_event_id"]
+        }
+        pending = [
+            {"event_id": None, "summary": r["menu"], "status": "confirmed", "start": r["start"], "end": r["end"]}
+            for r in self.reservations_between(start_date, end_date, "confirmed", staff_id, include_unassigned)
+            if not r["calendar_event_id"]
+        ]
+        return cancelled, pending
+
+    # --- 売上 ---
+    def record_sale(self, user_id, amount, menu):
+        now = time.time()
+        sale_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO sales (id, user_id, amount, menu, created_at) VALUES (?, ?, ?, ?, ?)",
+                (sale_id, user_id, float(amount), menu, now)
+            )
+            self._enqueue(conn, TARGET_CRM, "sale", sale_id, {
+                "user_id": user_id, "amount": float(amount), "menu": menu, "recorded_at": int(now * 1000)
+            })
+        return sale_id
+
+    # --- 送信キュー ---
+    def claim_outbox(self, limit, lease_seconds):
+        """
+        処理できる送信作業を確保して返す
+        同じキーの作業は、前の作業が終わるまで取り出さない（登録→キャンセルの順序を守る）
+        """
+        now = time.time()
+        conn = self._connect()
+        rows = conn.execute(
+            "SELECT * FROM outbox o WHERE o.status = 'pending' AND o.next_attempt_at <= ?"
+            " AND (o.locked_until IS NULL OR o.locked_until < ?)"
+            " AND NOT EXISTS (SELECT 1 FROM outbox p WHERE p.sync_key = o.sync_key"
+            "                 AND p.seq < o.seq AND p.status = 'pending')"
+            " ORDER BY o.seq LIMIT ?",
+            (now, now, limit)
+        ).fetchall()
+        claimed = []
+        for row in rows:
+            # 他のワーカーと取り合いになっても、確保できるのは一方だけ
+            with conn:
+                cur = conn.execute(
+                    "UPDATE outbox SET locked_until = ?, attempts = attempts + 1, updated_at = ?"
+                    " WHERE seq = ? AND status = 'pending' AND (locked_until IS NULL OR locked_until < ?)",
+                    (now + lease_seconds, now, row["seq"], now)
+                )
+            if cur.rowcount == 1:
+                item = dict(row)
+                item["attempts"] += 1
+                item["payload"] = json.loads(item["payload"])
+                claimed.append(item)
+        return claimed
+
+    def finish_outbox(self, seq, status="done", error=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE outbox SET status = ?, last_error = ?, locked_until = NULL, updated_at = ? WHERE seq = ?",
+                (status, error, time.time(), seq)
+            )
+
+    def retry_outbox(self, seq, error, delay):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE outbox SET last_error = ?, next_attempt_at = ?, locked_until = NULL, updated_at = ?"
+                " WHERE seq = ?",
+                (error, now + delay, now, seq)
+            )
+
+    def requeue_failed(self):
+        """
+        諦めた送信作業をもう一度キューに戻す（外部サービスの復旧後に手動で呼ぶ）
+        """
+        now = time.time()
+        with self._connect() as conn:
+            return conn.execute(
+                "UPDATE outbox SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = ?"
+                " WHERE status = 'failed'",
+                (now, now)
+            ).rowcount
+
+    def outbox_stats(self):
+        rows = self._connect().execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def prune(self, days=OUTBOX_RETENTION_DAYS):
+        cutoff = time.time() - days * 86400
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM outbox WHERE status IN ('done', 'skipped', 'conflict') AND updated_at < ?", (cutoff,)
+            )
+
+
+# プロセス共通のストア（初回利用時に作成する）
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ReservationStore()
+    return _store
@@ -0,0 +1,259 @@
+import os
+import time
+import uuid
+import threading
+
+import lark_calendar
+import lark_crm
+import google_sheets
+import reservation_store
+from reservation_store import TARGET_CALENDAR, TARGET_SHEETS, TARGET_CRM
+
+# --- CONFIGURATION ---
+# 送信キューを確認する間隔（秒）。予約が入った時は wake() ですぐに処理する
+SYNC_INTERVAL_SECONDS = float(os.getenv('RESERVATION_SYNC_INTERVAL', '5'))
+# 1回に確保する作業数
+SYNC_BATCH_SIZE = int(os.getenv('RESERVATION_SYNC_BATCH', '20'))
+# 再試行の上限（超えたら failed にして requeue_failed() を待つ）
+SYNC_MAX_ATTEMPTS = int(os.getenv('RESERVATION_SYNC_MAX_ATTEMPTS', '8'))
+# 再試行の待ち時間（秒）: 5, 10, 20, ... 最大600
+SYNC_BASE_BACKOFF = 5
+SYNC_MAX_BACKOFF = 600
+# 確保した作業を他のワーカーに渡さない時間（処理中に落ちた場合はこの後に再処理される）
+SYNC_LEASE_SECONDS = 120
+# 古い記録を掃除する間隔（秒）
+PRUNE_INTERVAL_SECONDS = 3600
+
+_wake = threading.Event()
+_thread = None
+_start_lock = threading.Lock()
+_stats = {"done": 0, "conflict": 0, "skipped": 0, "retried": 0, "failed": 0}
+_stats_lock = threading.Lock()
+
+
+class SyncError(Exception):
+    """
+    一時的な失敗（後で再試行する）
+    """
+
+
+def _overlapping(events, start, end):
+    return [e for e in events if e["start"] < end and e["end"] > start]
+
+
+# --- 複製先ごとの処理（戻り値: done / conflict / skipped、再試行する場合は SyncError） ---
+def _calendar_create(store, reservation, payload):
+    if reservation["status"] == "cancelled":
+        # 登録前にキャンセルされた（後続のキャンセル作業は何もしない）
+        return "skipped"
+    if reservation["calendar_event_id"]:
+        return "done"
+
+    # 担当スタッフのカレンダーに、店側が直接入れた予定などと重なっていないか確認する（日別キャッシュ経由）
+    calendar_id = reservation["calendar_id"]
+    remote = lark_calendar.get_day_events(reservation["start"].date(), calendar_id) or []
+    conflicts = _overlapping(remote, reservation["start"], reservation["end"])
+
+    summary = f"【LINE予約】{reservation['menu']} - {reservation['user_id'][:5]}...様"
+    description = f"LINEからの自動予約\nメニュー: {reservation['menu']}\n希望時間: {reservation['time']}"
+    result = lark_calendar.create_calendar_event(summary, reservation["start"], reservation["end"], description,
+                                                 calendar_id)
+    if not result:
+        raise SyncError("Lark Calendarへの登録に失敗しました")
+    if isinstance(result, str):
+        store.set_calendar_event_id(reservation["id"], result)
+
+    if conflicts:
+        print(f"⚠️ ダブルブッキングの可能性: {reservation['date']} {reservation['time']} "
+              f"({', '.join(e.get('summary') or '予定' for e in conflicts)})")
+        return "conflict"
+    return "done"
+
+
+def _calendar_cancel(store, reservation, payload):
+    event_id = reservation["calendar_event_id"]
+    if not event_id:
+        return "skipped"
+    if not lark_calendar.delete_calendar_event(event_id, reservation["calendar_id"]):
+        raise SyncError("Lark Calendarの予定削除に失敗しました")
+    return "done"
+
+
+def _sheets_create(store, reservation, payload):
+    if not google_sheets.get_client():
+        return "skipped"
+    if not google_sheets.add_reservation_to_sheet(
+            reservation["user_id"], reservation["date"], reservation["time"], reservation["menu"]):
+        raise SyncError("Google Sheetへの追加に失敗しました")
+    return "done"
+
+
+def _sheets_cancel(store, reservation, payload):
+    if not google_sheets.get_client():
+        return "skipped"
+    if google_sheets.cancel_reservation(reservation["user_id"], reservation["date"], reservation["time"]):
+        return "done"
+    # 見つからなかったのか失敗したのかを、その日の行を読んで確かめる
+    for row in google_sheets.iter_reservations(reservation["date"], reservation["date"]):
+        if row["user_id"] == reservation["user_id"] and row["time"] == reservation["time"]:
+            raise SyncError("Google Sheetの行削除に失敗しました")
+    return "done"
+
+
+def _crm_table():
+    table_id = lark_crm.get_table_id()
+    if not lark_crm.LARK_BASE_APP_TOKEN or not table_id:
+        raise SyncError("Lark Baseの設定（APP_TOKEN, TABLE_ID）が足りていません")
+    return table_id
+
+
+def _crm_cancel(store, reservation, payload):
+    if not reservation["crm_record_id"]:
+        # 登録前にキャンセルされた・登録できなかった
+        return "skipped"
+    if not lark_crm.update_records(_crm_table(), [(reservation["crm_record_id"], {"ステータス": "キャンセル"})]):
+        raise SyncError("Lark Baseのステータス更新に失敗しました")
+    return "done"
+
+
+# CRM（Lark Base）への追加は、確保した作業をテーブルごとに batch_create 1回で書き込む
+# 戻り値: (テーブルID, レコードの内容)、書き込まない場合は skipped
+# 設定が足りない場合も、設定されるまで作業を残すため SyncError
+def _crm_create(store, reservation, payload):
+    if reservation["status"] == "cancelled":
+        # 登録前にキャンセルされた（後続のキャンセル作業は何もしない）
+        return "skipped"
+    return _crm_table(), lark_crm.reservation_fields(
+        reservation["user_id"], reservation["date"], reservation["time"], reservation["menu"])
+
+
+def _crm_sale(store, reservation, payload):
+    if not lark_crm.LARK_BASE_APP_TOKEN or not lark_crm.TABLE_SALES:
+        raise SyncError("Lark Baseの設定（APP_TOKEN, TABLE_SALES）が足りていません")
+    return lark_crm.TABLE_SALES, lark_crm.sales_fields(
+        payload["user_id"], payload["amount"], payload["menu"], recorded_at=payload["recorded_at"])
+
+
+HANDLERS = {
+    (TARGET_CALENDAR, "create"): _calendar_create,
+    (TARGET_CALENDAR, "cancel"): _calendar_cancel,
+    (TARGET_SHEETS, "create"): _sheets_create,
+    (TARGET_SHEETS, "cancel"): _sheets_cancel,
+    (TARGET_CRM, "cancel"): _crm_cancel,
+}
+
+CRM_HANDLERS = {
+    (TARGET_CRM, "create"): _crm_create,
+    (TARGET_CRM, "sale"): _crm_sale,
+}
+
+
+def _count(status):
+    with _stats_lock:
+        _stats[status] += 1
+
+
+def sync_once(store=None):
+    """
+    処理できる送信作業を1回分まとめて外部に反映する
+    戻り値: 処理した作業数
+    """
+    store = store or reservation_store.get_store()
+    items = store.claim_outbox(SYNC_BATCH_SIZE, SYNC_LEASE_SECONDS)
+    crm = {}  # { テーブルID: [(作業, レコードの内容), ...] }
+    for item in items:
+        key = (item["target"], item["action"])
+        handler = HANDLERS.get(key) or CRM_HANDLERS.get(key)
+        reservation = None
+        if "reservation_id" in item["payload"]:
+            reservation = store.get_reservation(item["payload"]["reservation_id"])
+        if handler is None or ("reservation_id" in item["payload"] and reservation is None):
+            store.finish_outbox(item["seq"], "failed", "unknown work item")
+            _count("failed")
+            continue
+
+        try:
+            result = handler(store, reservation, item["payload"])
+        except Exception as e:
+            _retry(store, item, e)
+            continue
+        if key in CRM_HANDLERS and not isinstance(result, str):
+            table_id, fields = result
+            crm.setdefault(table_id, []).append((item, fields))
+        else:
+            store.finish_outbox(item["seq"], result)
+            _count(result)
+
+    for table_id, entries in crm.items():
+        # 同じ作業の組み合わせを再送する時は同じ client_token になる（届いていた分を二重に登録しない）
+        seqs = ",".join(str(item["seq"]) for item, _ in entries)
+        client_token = str(uuid.uuid5(uuid.NAMESPACE_OID, f"salon-outbox:{seqs}"))
+        results = lark_crm.create_records(table_id, [fields for _, fields in entries], client_token)
+        for (item, _), (ok, value) in zip(entries, results):
+            # Larkが書き込みを確認した分だけ完了にし、失敗した分だけ再試行する
+            if ok:
+                if item["action"] == "create" and value:
+                    # キャンセル時にステータスを更新できるよう、レコードIDを残す
+                    store.set_crm_record_id(item["payload"]["reservation_id"], value)
+                store.finish_outbox(item["seq"], "done")
+                _count("done")
+            else:
+                _retry(store, item, SyncError(f"Lark Baseへの書き込みに失敗しました: {value}"))
+    return len(items)
+
+
+def _retry(store, item, e):
+    error = str(e)
+    if item["attempts"] >= SYNC_MAX_ATTEMPTS:
+        print(f"❌ 同期を中止しました ({item['target']}/{item['action']}, {item['attempts']}回失敗): {error}")
+        store.finish_outbox(item["seq"], "failed", error)
+        _count("failed")
+    else:
+        delay = min(SYNC_MAX_BACKOFF, SYNC_BASE_BACKOFF * 2 ** (item["attempts"] - 1))
+        print(f"⚠️ 同期を{delay}秒後に再試行します ({item['target']}/{item['action']}): {error}")
+        store.retry_outbox(item["seq"], error, delay)
+        _count("retried")
+
+
+def _loop():
+    store = reservation_store.get_store()
+    next_prune = 0.0
+    while True:
+        _wake.wait(SYNC_INTERVAL_SECONDS)
+        _wake.clear()
+        try:
+            while sync_once(store) >= SYNC_BATCH_SIZE:
+                pass
+            if time.time() >= next_prune:
+                store.prune()
+                next_prune = time.time() + PRUNE_INTERVAL_SECONDS
+        except Exception as e:
+            print(f"❌ 予約同期エラー: {e}")
+
+
+def start():
+    """
+    バックグラウンドの同期スレッドを起動する（gunicornのfork後に呼ぶ）
+    """
+    global _thread
+    if _thread is not None:
+        return
+    with _start_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_loop, name="reservation-sync", daemon=True)
+            _thread.start()
+            _wake.set()
+
+
+def wake():
+    """
+    新しい作業を積んだので、待たずに同期させる
+    """
+    _wake.set()
+
+
+def get_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["outbox"] = reservation_store.get_store().outbox_stats()
+    return stats
@@ -0,0 +1,106 @@
+import re
+import time
+
+import metrics
+
+
+class Context:
+    """
+    1イベント分の情報（セッションの読み込みはイベントごとに1回だけ）
+    """
+    __slots__ = ("event", "text", "user_id", "session", "api", "match")
+
+    def __init__(self, event, session, api):
+        self.event = event
+        self.text = event.message.text
+        self.user_id = event.source.user_id
+        self.session = session
+        self.api = api
+        self.match = None
+
+
+class Router:
+    """
+    テキストメッセージの振り分け（上から順に試す）
+    1. exact:   完全一致のコマンド（辞書を1回引くだけ）
+    2. prefix:  「メニュー:」のような前置きつきのコマンド（前置きをまとめた正規表現1本で照合）
+    3. state:   セッションの状態（step）ごとのハンドラ（日付入力待ちなど）
+    4. pattern: 状態に関係なく形で判定する入力（時刻など）
+    5. fallback
+    ハンドラごとの処理時間は salon_route_seconds に記録する
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._prefixes = {}
+        self._prefix_re = None
+        self._states = {}
+        self._patterns = []
+        self._fallback = None
+
+    def exact(self, *texts):
+        def decorator(func):
+            for text in texts:
+                self._exact[text] = func
+            return func
+        return decorator
+
+    def prefix(self, prefix):
+        def decorator(func):
+            self._prefixes[prefix] = func
+            # 長い前置きを先に試す
+            names = sorted(self._prefixes, key=len, reverse=True)
+            self._prefix_re = re.compile("|".join(re.escape(name) for name in names))
+            return func
+        return decorator
+
+    def state(self, step):
+        def decorator(func):
+            self._states[step] = func
+            return func
+        return decorator
+
+    def pattern(self, regex):
+        def decorator(func):
+            self._patterns.append((re.compile(regex), func))
+            return func
+        return decorator
+
+    def fallback(self, func):
+        self._fallback = func
+        return func
+
+    def resolve(self, text, session):
+        """
+        入力と状態に当たるハンドラを返す: (ハンドラ, 正規表現のマッチ)
+        """
+        stripped = text.strip()
+        func = self._exact.get(stripped)
+        if func is not None:
+            return func, None
+        if self._prefix_re is not None:
+            match = self._prefix_re.match(stripped)
+            if match:
+                return self._prefixes[match.group(0)], match
+        func = self._states.get(session.get("step")) if session else None
+        if func is not None:
+            return func, None
+        for regex, func in self._patterns:
+            match = regex.fullmatch(stripped)
+            if match:
+                return func, match
+        return self._fallback, None
+
+    def dispatch(self, ctx):
+        func, ctx.match = self.resolve(ctx.text, ctx.session)
+        if func is None:
+            return None
+        if not metrics.METRICS_ENABLED:
+            func(ctx)
+            return func.__name__
+        started = time.perf_counter()
+        try:
+            func(ctx)
+        finally:
+            metrics.route_seconds.observe((func.__name__,), time.perf_counter() - started)
+        return func.__name__
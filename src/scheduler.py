@@ -1,3 +1,4 @@
+from array import array
 from datetime import datetime, timedelta, time
 
 # サロンの基本設定
@@ -5,61 +6,248 @@ SLOT_UNIT_MINUTES = 30 # 30分単位
 OPEN_TIME = time(9, 0) # 開店 9:00
 CLOSE_TIME = time(20, 0) # 閉店 20:00
 
-def generate_slots(target_date):
+def _slot_starts(target_date):
     """
-    指定された日付における30分刻みの予約枠候補を生成する
+    指定日の各スロットの開始時刻を返す（最後のスロットの終了時刻が閉店時刻以内のもの）
     """
-    slots = []
+    unit = timedelta(minutes=SLOT_UNIT_MINUTES)
     current_dt = datetime.combine(target_date, OPEN_TIME)
     close_dt = datetime.combine(target_date, CLOSE_TIME)
+    starts = []
+    while current_dt + unit <= close_dt:
+        starts.append(current_dt)
+        current_dt += unit
+    return starts
 
-    while current_dt + timedelta(minutes=SLOT_UNIT_MINUTES) <= close_dt:
-        start_time = current_dt
-        end_time = current_dt + timedelta(minutes=SLOT_UNIT_MINUTES)
-        
+def generate_slots(target_date):
+    """
+    指定された日付における30分刻みの予約枠候補を生成する
+    """
+    unit = timedelta(minutes=SLOT_UNIT_MINUTES)
+    slots = []
+    for start_time in _slot_starts(target_date):
+        end_time = start_time + unit
         slots.append({
             "start": start_time,
             "end": end_time,
             "display": f"{start_time.strftime('%H:%M')} - {end_time.strftime('%H:%M')}"
         })
-        
-        # 次の枠は現在の終了時間から開始
-        current_dt = end_time
-
     return slots
 
+def is_valid_start(start_dt, end_dt):
+    """
+    予約の開始時刻が枠の区切り（開店から SLOT_UNIT_MINUTES 単位）で、営業時間内に収まるか
+    """
+    open_dt = datetime.combine(start_dt.date(), OPEN_TIME)
+    close_dt = datetime.combine(start_dt.date(), CLOSE_TIME)
+    offset = start_dt - open_dt
+    return (open_dt <= start_dt < end_dt <= close_dt
+            and offset % timedelta(minutes=SLOT_UNIT_MINUTES) == timedelta(0))
+
+class DayOccupancy:
+    """
+    1日・1リソース分の枠の埋まり具合
+    - busy: スロットごとのビット（i ビット目 = i 番目のスロットに予定がある）
+    - joins: 直前のスロットから続けて使えるスロットのビット（空いていて、境界に長さ0の予定が無い）
+    予定ごとの重なり数も持っているので、予定の追加・取り消しをその予定の範囲だけの更新で反映できる
+    """
+    __slots__ = ("date", "size", "_open", "_unit", "_counts", "_breaks", "busy", "joins")
+
+    def __init__(self, target_date, events=()):
+        self.date = target_date
+        self.size = len(_slot_starts(target_date))
+        self._open = datetime.combine(target_date, OPEN_TIME)
+        self._unit = timedelta(minutes=SLOT_UNIT_MINUTES)
+        # 取り消しで数を戻せるように、ビットとは別に重なっている予定の数を持つ
+        self._counts = array('H', bytes(2 * self.size))
+        self._breaks = array('H', bytes(2 * self.size))
+        self.busy = 0
+        self.joins = (1 << self.size) - 1
+        if events:
+            self._build(events)
+
+    def _build(self, events):
+        # まとめて作る場合は差分配列で数え、ビットは最後に1回だけ付ける
+        diff = [0] * (self.size + 1)
+        for event in events:
+            first, last, boundary = self._span(event)
+            if boundary is not None:
+                self._breaks[boundary] += 1
+            elif first is not None:
+                diff[first] += 1
+                diff[last + 1] -= 1
+        count = 0
+        busy = joins = 0
+        for i in range(self.size):
+            count += diff[i]
+            self._counts[i] = count
+            if count:
+                busy |= 1 << i
+            elif not self._breaks[i]:
+                joins |= 1 << i
+        self.busy, self.joins = busy, joins
+
+    def copy(self):
+        other = DayOccupancy.__new__(DayOccupancy)
+        other.date, other.size, other._open, other._unit = self.date, self.size, self._open, self._unit
+        other._counts = array('H', self._counts)
+        other._breaks = array('H', self._breaks)
+        other.busy, other.joins = self.busy, self.joins
+        return other
+
+    def _span(self, event):
+        """
+        予定がふさぐスロットの範囲と、ふさぐスロット境界を返す: (first, last, boundary)
+        - 長さのある予定は、少しでも重なるスロットをふさぐ
+        - 長さ0の予定は、スロットの途中ならそのスロットを、境界ちょうどならその境界をまたぐ枠だけをふさぐ
+        """
+        start, end = event['start'], event['end']
+        if start > end:
+            return None, None, None
+        slot, rest = divmod(start - self._open, self._unit)
+        if start == end:
+            if rest:
+                return (slot, slot, None) if 0 <= slot < self.size else (None, None, None)
+            return None, None, slot if 0 < slot < self.size else None
+        first = max(0, slot)
+        last = min(self.size - 1, -((self._open - end) // self._unit) - 1)
+        return (first, last, None) if first <= last else (None, None, None)
+
+    def _update(self, event, delta):
+        first, last, boundary = self._span(event)
+        # 入っていない予定の取り消しは数を負にしない
+        if boundary is not None:
+            self._breaks[boundary] = max(0, self._breaks[boundary] + delta)
+        elif first is not None:
+            counts = self._counts
+            for i in range(first, last + 1):
+                counts[i] = max(0, counts[i] + delta)
+        else:
+            return
+        # 変わった範囲のビットだけ付け直す
+        low, high = (boundary, boundary) if boundary is not None else (first, last)
+        for i in range(low, high + 1):
+            bit = 1 << i
+            if self._counts[i]:
+                self.busy |= bit
+            else:
+                self.busy &= ~bit
+            if self._counts[i] or self._breaks[i]:
+                self.joins &= ~bit
+            else:
+                self.joins |= bit
+
+    def add(self, event):
+        self._update(event, 1)
+
+    def remove(self, event):
+        """
+        add した予定を取り消す（同じ開始・終了の予定を渡す）
+        """
+        self._update(event, -1)
+
+    def starts_mask(self, required_slots):
+        """
+        required_slots 個連続で空いている開始スロットのビット
+        i ビット目が立つ条件: スロット i が空いていて、i+1 〜 i+k-1 がそれぞれ直前から続けて使える
+        """
+        if required_slots < 1 or required_slots > self.size:
+            return 0
+        mask = ~self.busy & ((1 << (self.size - required_slots + 1)) - 1)
+        for j in range(1, required_slots):
+            mask &= self.joins >> j
+        return mask
+
+
+def occupancy_by_day(start_date, days, events):
+    """
+    期間の予定を日ごとの DayOccupancy にする（日をまたぐ予定は関係する日すべてに入れる）
+    """
+    by_day = [[] for _ in range(days)]
+    for event in events:
+        first = max(0, (event['start'].date() - start_date).days)
+        last = min(days - 1, (event['end'].date() - start_date).days)
+        for offset in range(first, last + 1):
+            by_day[offset].append(event)
+    return [DayOccupancy(start_date + timedelta(days=offset), day_events) for offset, day_events in enumerate(by_day)]
+
+def _to_available(candidate_start, candidate_end):
+    return {
+        "start_time": candidate_start,
+        "end_time": candidate_end,
+        "label": f"{candidate_start.strftime('%H:%M')}開始 (〜{candidate_end.strftime('%H:%M')})"
+    }
+
+def _iter_bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def _available_from_mask(required_slots, occupancy, mask):
+    duration = occupancy._unit * required_slots
+    for i in _iter_bits(mask):
+        start = occupancy._open + occupancy._unit * i
+        yield i, _to_available(start, start + duration)
+
 def check_availability(required_slots, target_date, existing_events):
     """
     空き状況判定エンジン
     required_slots: メニューに必要なスロット数（例：カットなら1、カラーなら2）
     existing_events: Larkカレンダーから取得した既存の予定リスト [{'start': dt, 'end': dt}, ...]
     """
-    all_slots = generate_slots(target_date)
-    available_start_times = []
-
-    # 連続したスロットが必要な場合を考慮して探索
-    # 例: 2スロット必要なら、Slot[i]とSlot[i+1]が両方空いている必要がある
-    
-    for i in range(len(all_slots) - required_slots + 1):
-        # 連続案候補のスロット群
-        candidate_slots = all_slots[i : i + required_slots]
-        
-        # 候補全体の開始と終了
-        candidate_start = candidate_slots[0]['start']
-        candidate_end = candidate_slots[-1]['end']
-        
-        is_conflict = False
-        for event in existing_events:
-            # 衝突判定: (StartA < EndB) and (EndA > StartB)
-            if (candidate_start < event['end']) and (candidate_end > event['start']):
-                is_conflict = True
-                break
-        
-        if not is_conflict:
-            available_start_times.append({
-                "start_time": candidate_start,
-                "end_time": candidate_end,
-                "label": f"{candidate_start.strftime('%H:%M')}開始 (〜{candidate_end.strftime('%H:%M')})"
-            })
-            
-    return available_start_times
+    occupancy = DayOccupancy(target_date, existing_events)
+    mask = occupancy.starts_mask(required_slots)
+    return [available for _, available in _available_from_mask(required_slots, occupancy, mask)]
+
+def find_next_available(required_slots, start_date, days, existing_events, limit=8, not_before=None):
+    """
+    start_date から days 日間で、最も早い空き開始時刻を最大 limit 件返す
+    existing_events: 期間全体の既存予定リスト
+    not_before: これより前に始まる枠は除外する（当日の過ぎた時間など）
+    """
+    return next_capacity_from_occupancy(
+        required_slots, [[o] for o in occupancy_by_day(start_date, days, existing_events)], limit, not_before,
+        capacity=False
+    )
+
+def capacity_from_occupancy(required_slots, occupancies, capacity=True):
+    """
+    同じ日の各リソースの DayOccupancy から空き枠を求める
+    1人の予約は1つのリソースが通しで担当するので、リソースごとの開始ビットの和集合が空き枠になる
+    戻り値: check_availability と同じ形に、受けられるリソース数（capacity）とその添字（resources）を加えたもの
+    """
+    if not occupancies:
+        return []
+    masks = [o.starts_mask(required_slots) for o in occupancies]
+    combined = 0
+    for mask in masks:
+        combined |= mask
+    results = []
+    for i, available in _available_from_mask(required_slots, occupancies[0], combined):
+        if capacity:
+            bit = 1 << i
+            available["resources"] = [r for r, mask in enumerate(masks) if mask & bit]
+            available["capacity"] = len(available["resources"])
+        results.append(available)
+    return results
+
+def check_capacity(required_slots, target_date, events_by_resource):
+    """
+    複数の席・スタッフがいる場合の空き状況判定
+    """
+    return capacity_from_occupancy(required_slots, [DayOccupancy(target_date, events) for events in events_by_resource])
+
+def next_capacity_from_occupancy(required_slots, occupancies_by_day, limit=8, not_before=None, capacity=True):
+    """
+    日ごとの [リソースごとの DayOccupancy, ...] から、早い順に最大 limit 件の空き枠を返す
+    """
+    results = []
+    for occupancies in occupancies_by_day:
+        for available in capacity_from_occupancy(required_slots, occupancies, capacity):
+            if not_before and available["start_time"] < not_before:
+                continue
+            results.append(available)
+            if len(results) >= limit:
+                return results
+    return results
@@ -0,0 +1,155 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+
+# --- CONFIGURATION ---
+# memory: プロセス内LRU / sqlite: 複数ワーカーで共有できるファイル
+SESSION_BACKEND = os.getenv('SESSION_BACKEND', 'memory')
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.db')
+# 最後の操作からセッションを保持する秒数（放置された会話は破棄する）
+SESSION_TTL_SECONDS = int(os.getenv('SESSION_TTL', '1800'))
+# 保持するセッション数の上限（超えたら古いものから破棄する）
+SESSION_MAX_ENTRIES = int(os.getenv('SESSION_MAX', '10000'))
+# SQLiteで期限切れの掃除を行う書き込み間隔
+PURGE_EVERY_WRITES = 100
+
+
+class MemorySessionStore:
+    """
+    プロセス内のLRUセッションストア（TTLと件数上限つき）
+    """
+
+    def __init__(self, ttl=SESSION_TTL_SECONDS, max_entries=SESSION_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # { user_id: (expires_at, session) }
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is None:
+                return None
+            expires_at, session = item
+            if expires_at < time.time():
+                del self._data[user_id]
+                return None
+            self._data.move_to_end(user_id)
+            return dict(session)
+
+    def set(self, user_id, session):
+        with self._lock:
+            self._data[user_id] = (time.time() + self.ttl, dict(session))
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def size(self):
+        with self._lock:
+            return len(self._data)
+
+
+def _encode(session):
+    # date型はJSONにできないので印をつけて保存する
+    def default(value):
+        if isinstance(value, datetime):
+            return {"__datetime__": value.isoformat()}
+        if isinstance(value, date):
+            return {"__date__": value.isoformat()}
+        raise TypeError(f"Unsupported session value: {value!r}")
+    return json.dumps(session, default=default, ensure_ascii=False)
+
+
+def _decode(text):
+    def hook(obj):
+        if "__datetime__" in obj:
+            return datetime.fromisoformat(obj["__datetime__"])
+        if "__date__" in obj:
+            return date.fromisoformat(obj["__date__"])
+        return obj
+    return json.loads(text, object_hook=hook)
+
+
+class SQLiteSessionStore:
+    """
+    SQLiteファイルに保存するセッションストア
+    gunicornの複数ワーカー（同一ホスト）で会話状態を共有できる
+    """
+
+    def __init__(self, path=SESSION_DB_PATH, ttl=SESSION_TTL_SECONDS, max_entries=SESSION_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " user_id TEXT PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires_at)")
+
+    def _connect(self):
+        # sqlite3の接続はスレッドごとに持つ
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, user_id):
+        row = self._connect().execute(
+            "SELECT data FROM sessions WHERE user_id = ? AND expires_at >= ?",
+            (user_id, time.time())
+        ).fetchone()
+        return _decode(row[0]) if row else None
+
+    def set(self, user_id, session):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (user_id, data, expires_at) VALUES (?, ?, ?)",
+                (user_id, _encode(session), time.time() + self.ttl)
+            )
+        self._writes += 1
+        if self._writes % PURGE_EVERY_WRITES == 0:
+            self.purge()
+
+    def delete(self, user_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    def purge(self):
+        """
+        期限切れのセッションと、上限を超えた古いセッションを削除する
+        """
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE expires_at < ?", (time.time(),))
+            conn.execute(
+                "DELETE FROM sessions WHERE user_id IN ("
+                " SELECT user_id FROM sessions ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def size(self):
+        return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def create_store(backend=SESSION_BACKEND):
+    """
+    環境変数 SESSION_BACKEND に応じたセッションストアを作る
+    """
+    if backend == "sqlite":
+        return SQLiteSessionStore()
+    return MemorySessionStore()
@@ -0,0 +1,128 @@
+import os
+import time
+import threading
+
+import lark_calendar
+import lark_crm
+from lark_oapi.api.bitable.v1 import ListAppTableRecordRequest
+
+# --- CONFIGURATION ---
+# 予約を受けるスタッフ（または席）とそのLarkカレンダー: "名前:カレンダーID[:役職],名前:カレンダーID[:役職]"
+# 未設定なら Lark Base のスタッフ管理テーブル（TABLE_STAFF）の「カレンダーID」列から読む
+STAFF_CALENDARS = os.getenv('STAFF_CALENDARS', '')
+TABLE_STAFF = os.getenv('TABLE_STAFF')
+# スタッフ一覧を読み直す間隔（秒）
+STAFF_CACHE_TTL = int(os.getenv('STAFF_CACHE_TTL', '600'))
+
+# どちらも無い場合は、LARK_CALENDAR_ID の1つだけを受け付けるリソースとする（従来どおりの1席）
+DEFAULT_STAFF = {"id": "default", "name": "", "calendar_id": None, "role": None}
+
+_cache = {"fetched_at": None, "staff": None}
+_cache_lock = threading.Lock()
+
+
+def _from_env():
+    staff = []
+    for part in filter(None, (p.strip() for p in STAFF_CALENDARS.split(","))):
+        fields = part.split(":")
+        if len(fields) == 1:
+            fields.insert(0, "")
+        name, calendar_id, role = (fields + [None])[:3]
+        staff.append({"id": name or calendar_id, "name": name, "calendar_id": calendar_id, "role": role or None})
+    return staff
+
+
+def _text(value):
+    # Bitable のテキスト列は [{"text": ..., "type": "text"}] の形で返ってくることがある
+    if isinstance(value, list):
+        return "".join(v.get("text", "") if isinstance(v, dict) else str(v) for v in value)
+    return str(value or "")
+
+
+def _from_base():
+    if not TABLE_STAFF:
+        return []
+
+    staff = []
+    page_token = None
+    while True:
+        builder = ListAppTableRecordRequest.builder() \
+            .app_token(lark_crm.LARK_BASE_APP_TOKEN) \
+            .table_id(TABLE_STAFF) \
+            .page_size(100)
+        if page_token:
+            builder = builder.page_token(page_token)
+        resp = lark_crm.client.bitable.v1.app_table_record.list(builder.build())
+        if not resp.success():
+            print(f"❌ Failed to load staff: {resp.code}, {resp.msg}")
+            return None
+
+        for item in (resp.data.items or []) if resp.data else []:
+            fields = item.fields or {}
+            calendar_id = _text(fields.get("カレンダーID")).strip()
+            # 予約受付にチェックが入っていないスタッフ・カレンダー未設定のスタッフは除く
+            # （Bitable はチェックの無いチェックボックス列をレコードに含めないので、列が無ければ未チェック）
+            if not calendar_id or not fields.get("予約受付"):
+                continue
+            staff.append({
+                "id": _text(fields.get("スタッフID")) or item.record_id,
+                "name": _text(fields.get("氏名")),
+                "calendar_id": calendar_id,
+                "role": _text(fields.get("役職")) or None,
+            })
+        if not (resp.data and resp.data.has_more):
+            return staff
+        page_token = resp.data.page_token
+
+
+def get_staff(roles=None):
+    """
+    予約を受けるスタッフ（席）の一覧を返す
+    roles: メニューを担当できる役職（指定すると、その役職か役職未設定のスタッフだけに絞る）
+    戻り値: [{"id", "name", "calendar_id", "role", "primary"}, ...]
+            （primary は全体の先頭のスタッフで、担当未設定の既存予約も受け持つ）
+            担当できるスタッフがいなければ空のリスト（満席と同じ扱いになる）
+    """
+    staff = _load()
+    if roles:
+        staff = [s for s in staff if s["role"] is None or s["role"] in roles]
+    return staff
+
+
+def _load():
+    with _cache_lock:
+        if _cache["staff"] is not None and time.monotonic() - _cache["fetched_at"] < STAFF_CACHE_TTL:
+            return _cache["staff"]
+
+    staff = _from_env()
+    if not staff:
+        staff = _from_base()
+        if staff is None:
+            # 取得に失敗した場合は前回の一覧を使い続ける
+            with _cache_lock:
+                return _cache["staff"] or [dict(DEFAULT_STAFF, primary=True)]
+    staff = [dict(s, primary=(i == 0)) for i, s in enumerate(staff or [DEFAULT_STAFF])]
+
+    with _cache_lock:
+        _cache["staff"] = staff
+        _cache["fetched_at"] = time.monotonic()
+    return staff
+
+
+def day_events(target_date, staff=None):
+    """
+    スタッフ全員のカレンダーから指定日の予定をまとめて取得する
+    戻り値: スタッフの並び順どおりの予定リストのリスト（カレンダーを取得できなかったスタッフは None）
+    """
+    staff = get_staff() if staff is None else staff
+    by_calendar = lark_calendar.get_day_events_multi(target_date, [s["calendar_id"] for s in staff])
+    return [by_calendar[s["calendar_id"] or lark_calendar.CALENDAR_ID] for s in staff]
+
+
+def range_events(start_date, days, staff=None):
+    """
+    day_events の期間版
+    """
+    staff = get_staff() if staff is None else staff
+    by_calendar = lark_calendar.get_range_events_multi(start_date, days, [s["calendar_id"] for s in staff])
+    return [by_calendar[s["calendar_id"] or lark_calendar.CALENDAR_ID] for s in staff]